@@ -1,26 +1,140 @@
 import logging
+import time
 
 from config import check_env_vars, config
-from stuf.stuf_0204 import get_Lv01
+from contract import check_admin_token, get_batch_bag_ids, get_batch_priority
+from stuf.metrics import http_request_seconds, http_response_bytes
+from stuf.profiler import get_profiler
+from stuf.render_0204 import dumps_info, dumps_results, is_pretty
+from stuf.scheduler import PRIORITIES
+from stuf.startup import record_loaded, record_response, warm_up
+from stuf.stuf_0204 import get_Lv01_metrics, lookup_Lv01, lookup_Lv01_with_fallback, purge_Lv01
 
-from flask import Flask, jsonify
+from flask import Flask, Response, g, jsonify, request
+from werkzeug.http import http_date
 from flask_cors import CORS
 
 
 app = Flask(__name__)
 log_handler = logging.StreamHandler()
 app.logger.addHandler(log_handler)
-CORS(app)
+# Cross-origin requests are allowed for anything but the admin endpoints
+CORS(app, resources=r"^(?!/admin/).*")
+
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+    profiler = get_profiler(config)
+    if profiler is not None:
+        route = request.url_rule.rule if request.url_rule else "unknown"
+        g.trace = profiler.start(f"{request.method} {route}")
+
+
+@app.after_request
+def record_metrics(response):
+    route = request.url_rule.rule if request.url_rule else "unknown"
+    g.status = response.status_code
+    http_request_seconds.observe(time.perf_counter() - g.start, route, request.method, str(response.status_code))
+    http_response_bytes.observe(response.content_length or 0, route)
+    first_response = record_response()
+    if first_response is not None:
+        app.logger.info(f"First response {first_response:.3f} seconds after the start of the process")
+    return response
+
+
+@app.teardown_request
+def finish_trace(exception):
+    trace = g.pop("trace", None)
+    if trace is None:
+        return
+    # Without a status the request failed with an exception
+    slow_request = get_profiler(config).finish(trace, status=g.get("status", 500))
+    if slow_request is not None:
+        stages = ", ".join(f"{stage['stage']} {stage['seconds']:.3f}" for stage in slow_request["stages"])
+        app.logger.warning(f"Slow request {slow_request['name']} {slow_request['seconds']:.3f} seconds: {stages}")
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(get_Lv01_metrics(config), mimetype="text/plain; version=0.0.4")
+
+
+def _check_admin_token():
+    denied = check_admin_token(config, request.headers.get("Authorization", ""))
+    if denied is None:
+        return None
+    status, data, headers = denied
+    response = jsonify(data)
+    response.status_code = status
+    for name, value in headers.items():
+        response.headers[name] = value
+    return response
+
+
+@app.route("/admin/slow_requests", methods=["GET"])
+def get_slow_requests():
+    denied = _check_admin_token()
+    if denied is not None:
+        return denied
+    profiler = get_profiler(config)
+    if profiler is None:
+        response = jsonify({"error": "Profiling is uitgeschakeld"})
+        response.status_code = 404
+        return response
+    return jsonify({"threshold": profiler.threshold, "slow_requests": profiler.slow_requests()})
 
 
 @app.route("/brp_brandweer/<string:bag_id>", methods=["GET"])
 def get_bag_id_info(bag_id):
-    info = get_Lv01(bag_id, config)[0]
-    response = jsonify(info)
-    response.status_code = 404 if info.get("error") else 200
+    lookup = lookup_Lv01_with_fallback(bag_id, config)
+    info = lookup.results[0]
+    response = Response(dumps_info(info, is_pretty(request.headers)), status=404 if info.error else 200,
+                        mimetype="application/json")
+    response.headers["X-BRP-Source"] = lookup.source
+    if lookup.age is not None:
+        response.headers["Age"] = str(int(lookup.age))
+    if lookup.source == "snapshot":
+        response.headers["Last-Modified"] = http_date(time.time() - lookup.age)
     return response
 
 
+@app.route("/brp_brandweer/cache/<string:bag_id>", methods=["DELETE"])
+def purge_bag_id_info(bag_id):
+    purge_Lv01(bag_id, config)
+    return "", 204
+
+
+@app.route("/brp_brandweer", methods=["POST"])
+def get_bag_ids_info():
+    body = request.get_json(silent=True)
+    bag_ids = get_batch_bag_ids(body)
+    if bag_ids is None:
+        response = jsonify({"error": "Verwacht een lijst van BAG ids"})
+        response.status_code = 400
+        return response
+
+    priority = get_batch_priority(body)
+    if priority is None:
+        response = jsonify({"error": f"Verwacht een prioriteit: {', '.join(PRIORITIES)}"})
+        response.status_code = 400
+        return response
+
+    if len(bag_ids) > config["max_batch_size"]:
+        response = jsonify({"error": f"Maximaal {config['max_batch_size']} BAG ids per verzoek"})
+        response.status_code = 413
+        return response
+
+    lookups = lookup_Lv01(bag_ids, dict(config, priority=priority))
+    return Response(dumps_results(lookups, is_pretty(request.headers)), mimetype="application/json")
+
+
+if config["warmup"]:
+    # Loaded by the uWSGI master the warm-up is shared by the workers, see stuf.startup
+    warm_up(config)
+record_loaded()
+
+
 if __name__ == "__main__":
     check_env_vars()
     app.run(port=8000)
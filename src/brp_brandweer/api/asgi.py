@@ -0,0 +1,234 @@
+"""
+
+This module contains the asyncio (ASGI) counterpart of app.py
+
+It serves the same routes with the same JSON contract and headers, but BRP is requested with an async client
+so that a single worker process can have many requests to BRP in flight.
+
+    uvicorn asgi:app --port 8000
+
+"""
+
+import asyncio
+import json
+import os
+import re
+import time
+from collections import namedtuple
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import http_date
+
+from config import config
+from contract import check_admin_token, get_batch_bag_ids, get_batch_priority
+from stuf.async_0204 import close_clients, lookup_Lv01, lookup_Lv01_with_fallback
+from stuf.metrics import http_request_seconds, http_response_bytes
+from stuf.profiler import get_profiler
+from stuf.render_0204 import dumps, dumps_info, dumps_results, is_pretty
+from stuf.scheduler import PRIORITIES
+from stuf.startup import record_loaded, record_response, warm_up
+from stuf.stuf_0204 import get_Lv01_metrics, purge_Lv01
+
+_static_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+
+# The methods that cross-origin requests may use, the default of Flask-Cors in app.py
+_cors_methods = "DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT"
+
+# A request, the headers are case-insensitive. The argument of the handlers after the path parameters.
+Request = namedtuple("Request", ["method", "path", "headers", "body"])
+
+
+def _json_response(request, data, status=200, headers=None):
+    # Same output as flask.jsonify, data may also be a rendered body
+    body = data if isinstance(data, bytes) else dumps(data, is_pretty(request.headers))
+    return status, dict(headers or {}, **{"Content-Type": "application/json"}), body
+
+
+def _lookup_headers(lookup):
+    headers = {"X-BRP-Source": lookup.source}
+    if lookup.age is not None:
+        headers["Age"] = str(int(lookup.age))
+    if lookup.source == "snapshot":
+        headers["Last-Modified"] = http_date(time.time() - lookup.age)
+    return headers
+
+
+async def get_bag_id_info(bag_id, request):
+    lookup = await lookup_Lv01_with_fallback(bag_id, config)
+    info = lookup.results[0]
+    return _json_response(request, dumps_info(info, is_pretty(request.headers)), 404 if info.error else 200,
+                          _lookup_headers(lookup))
+
+
+async def purge_bag_id_info(bag_id, request):
+    # The cache backend may block
+    await asyncio.get_event_loop().run_in_executor(None, purge_Lv01, bag_id, config)
+    return 204, {}, b""
+
+
+async def get_bag_ids_info(request):
+    try:
+        body = json.loads(request.body.decode("utf-8"))
+    except ValueError:
+        body = None
+    bag_ids = get_batch_bag_ids(body)
+    if bag_ids is None:
+        return _json_response(request, {"error": "Verwacht een lijst van BAG ids"}, 400)
+
+    priority = get_batch_priority(body)
+    if priority is None:
+        return _json_response(request, {"error": f"Verwacht een prioriteit: {', '.join(PRIORITIES)}"}, 400)
+
+    if len(bag_ids) > config["max_batch_size"]:
+        return _json_response(request, {"error": f"Maximaal {config['max_batch_size']} BAG ids per verzoek"}, 413)
+
+    lookups = await lookup_Lv01(bag_ids, dict(config, priority=priority))
+    return _json_response(request, dumps_results(lookups, is_pretty(request.headers)))
+
+
+async def get_static(name, request):
+    path = os.path.join(_static_folder, name)
+    if os.path.dirname(os.path.abspath(path)) != _static_folder or not os.path.isfile(path):
+        return _json_response(request, {"error": "Not Found"}, 404)
+    with open(path, "rb") as file:
+        return 200, {"Content-Type": "application/yaml" if name.endswith(".yaml") else "text/plain"}, file.read()
+
+
+async def get_metrics(request):
+    return 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}, \
+        get_Lv01_metrics(config).encode("utf-8")
+
+
+async def get_slow_requests(request):
+    denied = check_admin_token(config, request.headers.get("Authorization", ""))
+    if denied is not None:
+        status, data, headers = denied
+        return _json_response(request, data, status, headers)
+    profiler = get_profiler(config)
+    if profiler is None:
+        return _json_response(request, {"error": "Profiling is uitgeschakeld"}, 404)
+    return _json_response(request, {"threshold": profiler.threshold, "slow_requests": profiler.slow_requests()})
+
+
+# The method, the rule (as in app.py, used in the metrics), the path pattern and the handler per route
+routes = [
+    ("GET", "/metrics", re.compile(r"^/metrics$"), get_metrics),
+    ("GET", "/admin/slow_requests", re.compile(r"^/admin/slow_requests$"), get_slow_requests),
+    ("DELETE", "/brp_brandweer/cache/<string:bag_id>", re.compile(r"^/brp_brandweer/cache/([^/]+)$"),
+     purge_bag_id_info),
+    ("GET", "/brp_brandweer/<string:bag_id>", re.compile(r"^/brp_brandweer/([^/]+)$"), get_bag_id_info),
+    ("POST", "/brp_brandweer", re.compile(r"^/brp_brandweer$"), get_bag_ids_info),
+    ("GET", "/static/<path:filename>", re.compile(r"^/static/([^/]+)$"), get_static),
+]
+
+
+def _options(methods):
+    # The answer to an OPTIONS request (like a CORS preflight), like Flask
+    return 200, {"Allow": ", ".join(sorted(set(methods) | {"OPTIONS"}))}, b""
+
+
+async def _dispatch(request):
+    allowed = []
+    for route_method, rule, pattern, handler in routes:
+        match = pattern.match(request.path)
+        if match is None:
+            continue
+        if route_method == request.method:
+            return rule, await handler(*match.groups(), request)
+        allowed.append((route_method, rule))
+    if allowed and request.method == "OPTIONS":
+        return allowed[0][1], _options([method for method, _ in allowed])
+    if allowed:
+        return allowed[0][1], _json_response(request, {"error": "Method Not Allowed"}, 405)
+    return "unknown", _json_response(request, {"error": "Not Found"}, 404)
+
+
+def _cors_headers(request):
+    """Get the CORS headers for the response to a request, like Flask-Cors in app.py
+
+    Cross-origin requests are allowed for anything but the admin endpoints.
+
+    Args:
+        request (Request): the request
+
+    Returns:
+        dict: the headers
+
+    """
+    if request.path.startswith("/admin/"):
+        return {}
+    origin = request.headers.get("Origin")
+    if not origin:
+        return {"Access-Control-Allow-Origin": "*"}
+    headers = {"Access-Control-Allow-Origin": origin, "Vary": "Origin"}
+    if request.method == "OPTIONS" and "Access-Control-Request-Method" in request.headers:
+        # A preflight request
+        headers["Access-Control-Allow-Methods"] = _cors_methods
+        requested = [name.strip() for name in request.headers.get("Access-Control-Request-Headers", "").split(",")]
+        if any(requested):
+            headers["Access-Control-Allow-Headers"] = ", ".join(sorted(name for name in requested if name))
+    return headers
+
+
+async def _read_body(receive, limit):
+    # The body, or None when it is larger than limit bytes
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if len(body) > limit:
+            return None
+        if not message.get("more_body"):
+            return body
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await close_clients()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """The ASGI application
+
+    Args:
+        scope (dict): the connection scope
+        receive (callable): awaitable that returns the next message from the client
+        send (callable): awaitable that sends a message to the client
+
+    Returns:
+        None
+
+    """
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+
+    start = time.perf_counter()
+    headers = Headers([(name.decode("latin-1"), value.decode("latin-1")) for name, value in scope["headers"]])
+    request = Request(scope["method"], scope["path"], headers, await _read_body(receive, config["max_body_size"]))
+    if request.body is None:
+        rule, (status, headers, content) = "unknown", _json_response(request, {"error": "Verzoek is te groot"}, 413)
+    else:
+        rule, (status, headers, content) = await _dispatch(request)
+    headers = dict(headers, **_cors_headers(request), **{"Content-Length": str(len(content))})
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers.items()],
+    })
+    await send({"type": "http.response.body", "body": content})
+
+    http_request_seconds.observe(time.perf_counter() - start, rule, scope["method"], str(status))
+    http_response_bytes.observe(len(content), rule)
+    record_response()
+
+
+if config["warmup"]:
+    # The async client connects to BRP on the first request
+    warm_up(config, connect=False)
+record_loaded()
@@ -0,0 +1,35 @@
+"""
+
+Micro-benchmark of rendering the indicatoren of an address
+
+Compares computing the ages and rendering the indicatoren for every request with reusing the indicatoren that
+were rendered for the same birthdates until the next change of an age category.
+
+    cd src/brp_brandweer/api
+    python -m benchmarks.bench_indicatoren
+
+"""
+
+import timeit
+
+from stuf.parse_0204 import _get_ages, _get_indicatoren, get_indicatoren
+
+birthdates = [19620412, 19650101, 19991231, 20120229]
+
+
+def render_indicatoren():
+    return _get_indicatoren(_get_ages(birthdates))
+
+
+def reuse_indicatoren():
+    return get_indicatoren(birthdates)
+
+
+def main(number=100000):
+    for name, fn in [("render", render_indicatoren), ("reuse", reuse_indicatoren)]:
+        seconds = min(timeit.repeat(fn, number=number, repeat=5))
+        print(f"{name:10} {seconds / number * 1e6:8.2f} us per address")
+
+
+if __name__ == "__main__":
+    main()
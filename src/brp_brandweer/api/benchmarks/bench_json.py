@@ -0,0 +1,61 @@
+"""
+
+Micro-benchmark of serializing the responses
+
+Compares flask.jsonify of the response objects with rendering the same bytes from pre-rendered fragments
+(stuf.render_0204), for a single address and for a batch of 100 addresses. Both include building the
+response object, as in the app. The responses are pretty-printed, like jsonify of the pinned Flask 0.12 does by
+default.
+
+    cd src/brp_brandweer/api
+    python -m benchmarks.bench_json
+
+"""
+
+import random
+import timeit
+
+from flask import Flask, Response, jsonify
+
+from stuf import render_0204
+from stuf.parse_0204 import AddressInfo
+from stuf.stuf_0204 import Lookup
+
+_rnd = random.Random(0)
+infos = [AddressInfo(f"0363200000{_rnd.randint(0, 999999):06}", tuple(_rnd.randint(0, 12) for _ in range(3)))
+         for _ in range(100)]
+info = infos[0]
+lookups = [Lookup([info], "cache", 12.5, None) for info in infos]
+
+
+def jsonify_info():
+    return jsonify(info.as_dict()).get_data()
+
+
+def render_info():
+    return Response(render_0204.dumps_info(info), mimetype="application/json").get_data()
+
+
+def jsonify_results():
+    return jsonify({"results": [
+        dict(info.as_dict(), age=int(lookup.age), source=lookup.source, status=404 if info.error else 200)
+        for lookup in lookups for info in lookup.results
+    ]}).get_data()
+
+
+def render_results():
+    return Response(render_0204.dumps_results(lookups), mimetype="application/json").get_data()
+
+
+def main(number=10000):
+    print(f"orjson {'installed' if render_0204.orjson is not None else 'not installed'}")
+    # jsonify of Flask 0.12 reads JSONIFY_PRETTYPRINT_REGULAR and whether the request is an XMLHttpRequest
+    with Flask(__name__).test_request_context():
+        for name, fn in [("jsonify", jsonify_info), ("render", render_info),
+                         ("jsonify 100", jsonify_results), ("render 100", render_results)]:
+            seconds = min(timeit.repeat(fn, number=number, repeat=5))
+            print(f"{name:12} {seconds / number * 1e6:8.2f} us per response")
+
+
+if __name__ == "__main__":
+    main()
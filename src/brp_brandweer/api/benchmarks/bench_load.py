@@ -0,0 +1,198 @@
+"""
+
+Load benchmark of the lookups against a local stand-in for BRP
+
+Starts benchmarks.fake_brp in a separate process, so that the reported CPU time and memory are those of the
+lookups only. Then sends --requests lookups for distinct BAG ids, --concurrency at a time, either by calling
+get_Lv01 or as HTTP requests to the Flask app. Reports the latency percentiles, throughput, CPU time and the
+maximum resident set size, and saves them as JSON with --output to compare them between commits.
+
+    cd src/brp_brandweer/api
+    python -m benchmarks.bench_load --target flask --concurrency 16 --output results/after.json
+    python -m benchmarks.compare results/before.json results/after.json
+
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from benchmarks.fake_brp import add_arguments
+from config import config
+from stuf.stuf_0204 import get_Lv01
+
+_api_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_percentile(values, percentile):
+    """Get a percentile of the sorted values, like stuf.resilience.LatencyTracker
+
+    Args:
+        values (list(float)): the values in increasing order
+        percentile (float): the percentile, between 0 and 100
+
+    Returns:
+        float: the value at the percentile
+
+    """
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+
+def start_fake_brp(args):
+    """Start the stand-in for BRP in a separate process
+
+    Args:
+        args (argparse.Namespace): the arguments for benchmarks.fake_brp
+
+    Returns:
+        tuple: the process and the url of the stand-in
+
+    """
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.fake_brp", "--latency", str(args.latency), "--jitter", str(args.jitter),
+         "--error-rate", str(args.error_rate), "--addresses", str(args.addresses),
+         "--residents", str(args.residents), "--deceased", str(args.deceased), "--malformed", str(args.malformed),
+         "--seed", str(args.seed)],
+        cwd=_api_folder, stdout=subprocess.PIPE, universal_newlines=True)
+    return process, process.stdout.readline().strip()
+
+
+def lookup_target():
+    """Get a function that looks up a BAG id by calling get_Lv01"""
+    def lookup(bag_id):
+        return not any(info.get("error") for info in get_Lv01([bag_id], config))
+    return lookup, lambda: None
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def flask_target():
+    """Get a function that looks up a BAG id by a HTTP request to the Flask app"""
+    from app import app
+
+    server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=_QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/brp_brandweer/"
+    sessions = threading.local()
+
+    def lookup(bag_id):
+        if not hasattr(sessions, "session"):
+            sessions.session = requests.Session()
+        return sessions.session.get(url + bag_id).status_code == 200
+    return lookup, server.shutdown
+
+
+targets = {"get_Lv01": lookup_target, "flask": flask_target}
+
+
+def run(lookup, bag_ids, concurrency):
+    """Lookup the BAG ids and measure the latencies, errors, elapsed time and CPU time
+
+    Args:
+        lookup (callable): a function that looks up a BAG id and returns whether it succeeded
+        bag_ids (list(str)): the BAG ids
+        concurrency (int): the number of concurrent lookups
+
+    Returns:
+        dict: the results
+
+    """
+    def call(bag_id):
+        start = time.perf_counter()
+        success = lookup(bag_id)
+        return time.perf_counter() - start, success
+
+    cpu_start = sum(os.times()[:2])
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        calls = list(executor.map(call, bag_ids))
+    seconds = time.perf_counter() - start
+    cpu_seconds = sum(os.times()[:2]) - cpu_start
+
+    latencies = sorted(latency for latency, _ in calls)
+    return {
+        "requests": len(calls),
+        "errors": sum(1 for _, success in calls if not success),
+        "seconds": seconds,
+        "throughput": len(calls) / seconds,
+        "latency": {
+            "mean": sum(latencies) / len(latencies),
+            "p50": get_percentile(latencies, 50),
+            "p95": get_percentile(latencies, 95),
+            "p99": get_percentile(latencies, 99),
+            "max": latencies[-1],
+        },
+        "cpu_seconds": cpu_seconds,
+        "cpu_utilization": cpu_seconds / seconds,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def _get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=_api_folder,
+                                       universal_newlines=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _print(results):
+    latency = results["latency"]
+    print(f"{results['requests']} requests, {results['errors']} errors in {results['seconds']:.2f} s, "
+          f"{results['throughput']:.1f} requests/s")
+    print(f"latency p50 {latency['p50'] * 1000:.1f} ms, p95 {latency['p95'] * 1000:.1f} ms, "
+          f"p99 {latency['p99'] * 1000:.1f} ms, max {latency['max'] * 1000:.1f} ms")
+    print(f"cpu {results['cpu_seconds']:.2f} s ({results['cpu_utilization'] * 100:.0f}%), "
+          f"max rss {results['max_rss_kb'] / 1024:.1f} MB")
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Load benchmark of the lookups against a stand-in for BRP")
+    parser.add_argument("--target", choices=sorted(targets), default="get_Lv01", help="what to benchmark")
+    parser.add_argument("--requests", type=int, default=1000, help="number of lookups")
+    parser.add_argument("--warmup", type=int, default=50, help="number of lookups before measuring")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of concurrent lookups")
+    parser.add_argument("--output", help="JSON file to save the results in")
+    add_arguments(parser)
+    args = parser.parse_args(args)
+
+    process, url = start_fake_brp(args)
+    config["host"] = url
+    lookup, stop = targets[args.target]()
+    try:
+        bag_ids = [f"0363200{number:09}" for number in range(args.warmup + args.requests)]
+        run(lookup, bag_ids[:args.warmup], args.concurrency)
+        results = run(lookup, bag_ids[args.warmup:], args.concurrency)
+    finally:
+        stop()
+        process.terminate()
+        process.wait()
+
+    _print(results)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as file:
+            json.dump({
+                "benchmark": "load",
+                "commit": _get_commit(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "parameters": vars(args),
+                "results": results,
+            }, file, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
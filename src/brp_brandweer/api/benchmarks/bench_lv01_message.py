@@ -0,0 +1,39 @@
+"""
+
+Micro-benchmark of building Lv01 messages
+
+Compares rendering the full message for every request with building it from the precompiled template.
+
+    cd src/brp_brandweer/api
+    python -m benchmarks.bench_lv01_message
+
+"""
+
+import timeit
+
+from config import config
+from stuf.stuf_0204 import _get_Lv01_message, get_Lv01_template
+
+
+def render_message():
+    data = _get_Lv01_message(
+        bag_id="0363200000399540",
+        zender=config["zender"],
+        ontvanger=config["ontvanger"]
+    ).encode("utf-8")
+    return data, str(len(data))
+
+
+def build_message(template=get_Lv01_template(config)):
+    data = template.build("0363200000399540")
+    return data, str(len(data))
+
+
+def main(number=100000):
+    for name, fn in [("render", render_message), ("template", build_message)]:
+        seconds = min(timeit.repeat(fn, number=number, repeat=5))
+        print(f"{name:10} {seconds / number * 1e6:8.2f} us per message")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+
+Benchmark of the memory that is used per cached address
+
+Compares the birthdates per address as nested lists of int objects and the address informations as dicts with
+the packed birthdates (PackedAddresses) and the slotted address informations (AddressInfo) that are used now.
+The memory is measured with tracemalloc for many synthetic BAG ids, as it is held by the cache and by a batch
+of lookups.
+
+    cd src/brp_brandweer/api
+    python -m benchmarks.bench_memory --bag-ids 10000 --residents 4
+
+"""
+
+import argparse
+import datetime
+import random
+import tracemalloc
+
+from stuf.parse_0204 import PackedAddresses, get_address_info, get_info
+
+_reference_date = datetime.date(2020, 1, 1)
+
+
+def get_addresses(n_bag_ids, residents, seed=0):
+    """Get random birthdates per address per BAG id
+
+    Args:
+        n_bag_ids (int): the number of BAG ids
+        residents (int): the number of persons per address
+        seed (int): the seed
+
+    Returns:
+        list(list(list(int))): the birthdates per address per BAG id, a single address per BAG id
+
+    """
+    rnd = random.Random(seed)
+    first = datetime.date(1920, 1, 1).toordinal()
+    last = _reference_date.toordinal()
+    return [
+        [[int(datetime.date.fromordinal(rnd.randint(first, last)).strftime("%Y%m%d")) for _ in range(residents)]]
+        for _ in range(n_bag_ids)
+    ]
+
+
+def measure(fn):
+    """Measure the memory that is held by the result of a function
+
+    Args:
+        fn (callable): the function
+
+    Returns:
+        tuple: the result and the number of bytes that was allocated for it
+
+    """
+    tracemalloc.start()
+    try:
+        result = fn()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, size
+
+
+def values_lists(addresses):
+    # Copies, so that the int objects are not shared with the input
+    return [[[int(str(birthdate)) for birthdate in address] for address in birthdates] for birthdates in addresses]
+
+
+def values_packed(addresses):
+    return [PackedAddresses(birthdates) for birthdates in addresses]
+
+
+def results_dicts(addresses):
+    return [get_info(str(i), address) for i, birthdates in enumerate(addresses) for address in birthdates]
+
+
+def results_slots(addresses):
+    return [get_address_info(str(i), address) for i, birthdates in enumerate(addresses) for address in birthdates]
+
+
+def run(n_bag_ids, residents):
+    """Measure the memory per BAG id of both representations
+
+    Args:
+        n_bag_ids (int): the number of BAG ids
+        residents (int): the number of persons per address
+
+    Returns:
+        dict: the bytes per BAG id of the cached birthdates and of the address informations, as lists and dicts
+            and as packed and slotted objects
+
+    """
+    addresses = get_addresses(n_bag_ids, residents)
+    results = {}
+    for name, fn in [("values_lists", values_lists), ("values_packed", values_packed),
+                     ("results_dicts", results_dicts), ("results_slots", results_slots)]:
+        # Warm up the memoized counts and indicatoren, so that only the memory per BAG id is measured
+        fn(addresses)
+        _, size = measure(lambda: fn(addresses))
+        results[name] = size / n_bag_ids
+    results["before"] = results["values_lists"] + results["results_dicts"]
+    results["after"] = results["values_packed"] + results["results_slots"]
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Measure the memory per cached address")
+    parser.add_argument("--bag-ids", type=int, default=10000, help="number of BAG ids, default 10000")
+    parser.add_argument("--residents", type=int, default=4, help="persons per address, default 4")
+    args = parser.parse_args(args)
+
+    results = run(args.bag_ids, args.residents)
+    for name, size in results.items():
+        print(f"{name:15} {size:8.0f} bytes per BAG id")
+    print(f"{'':15} {results['before'] / results['after']:8.1f}x smaller")
+
+
+if __name__ == "__main__":
+    main()
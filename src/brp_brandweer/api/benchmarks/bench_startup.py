@@ -0,0 +1,98 @@
+"""
+
+Benchmark of the cold start of the app, with and without the warm-up (BRP_WARMUP)
+
+Every run starts a new process that loads app.py and looks up a BAG id against a local stand-in for BRP
+(benchmarks.fake_brp). Reported are the median time to load the app (including any warm-up), the duration of
+the first lookup and the time from the start of the process until the first response
+(brp_time_to_first_response_seconds). Under uWSGI the app is loaded once by the master, so the workers only
+pay for the first lookup.
+
+    cd src/brp_brandweer/api
+    python -m benchmarks.bench_startup --runs 10 --latency 0.05
+
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks.bench_load import start_fake_brp
+from benchmarks.fake_brp import add_arguments
+
+_api_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure():
+    """Load the app and look up a BAG id in this process, the process should not have loaded the app yet
+
+    Returns:
+        dict: the number of seconds until the app was loaded, of the first lookup and until the first response
+            since the start of the process
+
+    """
+    from stuf.startup import get_uptime
+
+    import app
+    loaded = get_uptime()
+    client = app.app.test_client()
+    start = time.perf_counter()
+    response = client.get("/brp_brandweer/0363200000399540")
+    first_lookup = time.perf_counter() - start
+    if response.status_code != 200:
+        raise RuntimeError(f"Lookup failed with status {response.status_code}")
+
+    from stuf.metrics import time_to_first_response_seconds
+    return {"load": loaded, "first_lookup": first_lookup, "first_response": time_to_first_response_seconds.get()}
+
+
+def run(url, warmup, runs):
+    """Measure the cold start in new processes
+
+    Args:
+        url (str): the url of the stand-in for BRP
+        warmup (bool): whether the app warms up when it is loaded
+        runs (int): the number of processes to start
+
+    Returns:
+        dict: the median number of seconds per measurement, see measure
+
+    """
+    env = dict(os.environ, BRP_HOST=url, BRP_WARMUP=str(warmup))
+    results = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, "-m", "benchmarks.bench_startup", "--measure"],
+                                         cwd=_api_folder, env=env, universal_newlines=True)
+        results.append(json.loads(output))
+    return {name: statistics.median(result[name] for result in results) for name in results[0]}
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the cold start of the app")
+    parser.add_argument("--runs", type=int, default=10, help="number of processes per variant")
+    parser.add_argument("--measure", action="store_true", help="measure this process, used by the benchmark")
+    add_arguments(parser)
+    args = parser.parse_args(args)
+
+    if args.measure:
+        print(json.dumps(measure()))
+        return
+
+    process, url = start_fake_brp(args)
+    try:
+        for warmup in [False, True]:
+            results = run(url, warmup, args.runs)
+            print(f"warmup {'on ' if warmup else 'off'}  load {results['load'] * 1000:7.1f} ms  "
+                  f"first lookup {results['first_lookup'] * 1000:7.1f} ms  "
+                  f"first response {results['first_response'] * 1000:7.1f} ms")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == "__main__":
+    main()
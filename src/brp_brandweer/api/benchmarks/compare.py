@@ -0,0 +1,89 @@
+"""
+
+Compare the results of two runs of benchmarks.bench_load
+
+Prints the results side by side with the relative change. Exits with status 1 when any result is more than
+--threshold percent worse, so that it can be used to detect regressions between commits.
+
+    cd src/brp_brandweer/api
+    python -m benchmarks.compare results/before.json results/after.json --threshold 10
+
+"""
+
+import argparse
+import json
+import sys
+
+# The results for which a higher value is better, for all other results a lower value is better
+_higher_is_better = {"throughput"}
+
+# The results that are not compared
+_ignored = {"requests", "seconds"}
+
+
+def flatten(results, prefix=""):
+    """Flatten nested results
+
+    Args:
+        results (dict): the results
+        prefix (str): the prefix for the names of the results
+
+    Returns:
+        dict: the results by dotted name, eg latency.p95
+
+    """
+    flat = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{name}."))
+        else:
+            flat[prefix + name] = value
+    return flat
+
+
+def compare(before, after, threshold=None):
+    """Compare two results
+
+    Args:
+        before (dict): the earlier results
+        after (dict): the later results
+        threshold (float): the percentage by which a result may get worse, None to not check
+
+    Returns:
+        tuple: the rows (name, before, after, change in percent) and the names of the results that got worse
+            by more than threshold percent
+
+    """
+    before, after = flatten(before), flatten(after)
+    rows = []
+    regressions = []
+    for name in sorted(set(before) & set(after) - _ignored):
+        change = (after[name] - before[name]) / before[name] * 100 if before[name] else 0
+        rows.append((name, before[name], after[name], change))
+        worse = -change if name in _higher_is_better else change
+        if threshold is not None and worse > threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Compare the results of two benchmark runs")
+    parser.add_argument("before", help="JSON file with the earlier results")
+    parser.add_argument("after", help="JSON file with the later results")
+    parser.add_argument("--threshold", type=float, help="percentage by which a result may get worse")
+    args = parser.parse_args(args)
+
+    with open(args.before) as file:
+        before = json.load(file)
+    with open(args.after) as file:
+        after = json.load(file)
+
+    rows, regressions = compare(before["results"], after["results"], args.threshold)
+    print(f"{'':20} {before.get('commit') or 'before':>12} {after.get('commit') or 'after':>12}")
+    for name, old, new, change in rows:
+        print(f"{name:20} {old:12.4f} {new:12.4f} {change:+7.1f}%{' !' if name in regressions else ''}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
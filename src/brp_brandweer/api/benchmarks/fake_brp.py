@@ -0,0 +1,127 @@
+"""
+
+Local stand-in for the BRP BGSynchroon service
+
+Answers every Lv01 request with a synthetic La01 message (see stuf.generate_0204) after a configurable latency
+(with jitter), and drops a configurable fraction of the requests without an answer.
+
+    cd src/brp_brandweer/api
+    python -m benchmarks.fake_brp --port 8001 --latency 0.05 --residents 4
+
+"""
+
+import argparse
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from stuf.generate_0204 import La01Generator
+
+# Larger messages are generated for every request instead of being kept in memory
+_max_cached_size = 1024 * 1024
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep connections alive, like BRP
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        server = self.server
+        delay = server.latency + server.random.uniform(-server.jitter, server.jitter)
+        time.sleep(max(0, delay))
+        if server.random.random() < server.error_rate:
+            # Drop the connection without an answer
+            self.close_connection = True
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml;charset=UTF-8")
+        self.send_header("Content-Length", str(server.size))
+        self.end_headers()
+        if server.message is None:
+            server.generator.write(self.wfile)
+        else:
+            self.wfile.write(server.message)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeBRP(ThreadingMixIn, HTTPServer):
+    """A threaded HTTP server that answers Lv01 requests with a synthetic La01 message
+
+    Args:
+        port (int): the port to listen on, 0 for any free port
+        latency (float): the mean number of seconds before an answer is sent
+        jitter (float): the maximum deviation of the latency in seconds
+        error_rate (float): the fraction of requests that is not answered
+        addresses (int): the number of addresses per message
+        residents (int): the number of residents per address
+        deceased (float): the fraction of deceased residents
+        malformed (float): the fraction of residents with a malformed or missing birthdate
+        seed (int): the seed for the message, latencies and errors
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.02, jitter=0.01, error_rate=0, addresses=1, residents=2, deceased=0,
+                 malformed=0, seed=0):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.generator = La01Generator(seed, addresses, residents, deceased, malformed)
+        self.size = self.generator.size()
+        self.message = self.generator.message() if self.size <= _max_cached_size else None
+        self.random = random.Random(seed)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        """Serve requests in a background thread
+
+        Returns:
+            str: the url of the server
+
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def add_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.02, help="mean latency of BRP in seconds")
+    parser.add_argument("--jitter", type=float, default=0.01, help="maximum deviation of the latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of unanswered requests")
+    parser.add_argument("--addresses", type=int, default=1, help="number of addresses per message")
+    parser.add_argument("--residents", type=int, default=2, help="number of residents per address")
+    parser.add_argument("--deceased", type=float, default=0, help="fraction of deceased residents")
+    parser.add_argument("--malformed", type=float, default=0, help="fraction of residents with a malformed birthdate")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the messages, latencies and errors")
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Local stand-in for the BRP BGSynchroon service")
+    parser.add_argument("--port", type=int, default=0, help="port to listen on, default any free port")
+    add_arguments(parser)
+    args = parser.parse_args(args)
+
+    server = FakeBRP(args.port, args.latency, args.jitter, args.error_rate, args.addresses, args.residents,
+                     args.deceased, args.malformed, args.seed)
+    print(server.url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -42,6 +42,66 @@ config = {
     "ontvanger": {
         "applicatie": get_var_value("BRP_ONTVANGER_APPLICATIE"),
         "organisatie": get_var_value("BRP_ONTVANGER_ORGANISATIE"),
+    },
+    "warmup": get_var_value("BRP_WARMUP") == "True",
+    "admin_token": get_var_value("BRP_ADMIN_TOKEN"),
+    "max_batch_size": int(get_var_value("BRP_MAX_BATCH_SIZE") or 50),
+    "max_body_size": int(get_var_value("BRP_MAX_BODY_SIZE") or 1024 * 1024),
+    "concurrency": int(get_var_value("BRP_CONCURRENCY") or 8),
+    "cache": {
+        "backend": get_var_value("BRP_CACHE_BACKEND") or "memory",
+        "path": get_var_value("BRP_CACHE_PATH") or "/tmp/brp_brandweer_cache.sqlite",
+        "url": get_var_value("BRP_CACHE_URL") or "redis://localhost:6379/0",
+        "ttl": float(get_var_value("BRP_CACHE_TTL") or 300),
+        "negative_ttl": float(get_var_value("BRP_CACHE_NEGATIVE_TTL") or 30),
+        "refresh": float(get_var_value("BRP_CACHE_REFRESH") or 240),
+        "stale_if_error": float(get_var_value("BRP_CACHE_STALE_IF_ERROR") or 3600),
+        "size": int(get_var_value("BRP_CACHE_SIZE") or 10000),
+        "memory": int(get_var_value("BRP_CACHE_MEMORY") or 16 * 1024 * 1024),
+        "mmap_size": int(get_var_value("BRP_CACHE_MMAP_SIZE") or 16 * 1024 * 1024),
+    },
+    "snapshot": {
+        "path": get_var_value("BRP_SNAPSHOT_PATH"),
+        "latency_budget": float(get_var_value("BRP_LATENCY_BUDGET") or 2),
+    },
+    "timeout": {
+        "connect": float(get_var_value("BRP_CONNECT_TIMEOUT") or 3.05),
+        "read": float(get_var_value("BRP_READ_TIMEOUT") or 10),
+        "deadline": float(get_var_value("BRP_DEADLINE") or 15),
+    },
+    "hedge": {
+        "percentile": float(get_var_value("BRP_HEDGE_PERCENTILE") or 95),
+        "min_samples": 20,
+    },
+    "breaker": {
+        "window": int(get_var_value("BRP_BREAKER_WINDOW") or 20),
+        "error_rate": float(get_var_value("BRP_BREAKER_ERROR_RATE") or 0.5),
+        "latency": float(get_var_value("BRP_BREAKER_LATENCY") or 5),
+        "reset_timeout": float(get_var_value("BRP_BREAKER_RESET_TIMEOUT") or 30),
+    },
+    "scheduler": {
+        "rate": float(get_var_value("BRP_RATE") or 50),
+        "min_rate": float(get_var_value("BRP_MIN_RATE") or 1),
+        "max_rate": float(get_var_value("BRP_MAX_RATE") or 100),
+        "latency": float(get_var_value("BRP_RATE_LATENCY") or 2),
+        "backend": get_var_value("BRP_SCHEDULER_BACKEND") or "memory",
+        "path": get_var_value("BRP_SCHEDULER_PATH") or "/tmp/brp_brandweer_scheduler.sqlite",
+    },
+    "range": {
+        "size": int(get_var_value("BRP_RANGE_SIZE") or 0),
+        "maximum": int(get_var_value("BRP_RANGE_MAXIMUM") or 100),
+        "retry": float(get_var_value("BRP_RANGE_RETRY") or 3600),
+    },
+    "profile": {
+        "threshold": float(get_var_value("BRP_PROFILE_THRESHOLD") or 0),
+        "size": int(get_var_value("BRP_PROFILE_SIZE") or 50),
+        "interval": float(get_var_value("BRP_PROFILE_INTERVAL") or 0.01),
+        "path": get_var_value("BRP_PROFILE_PATH"),
+    },
+    "pool": {
+        "size": int(get_var_value("BRP_POOL_SIZE") or 10),
+        "idle_timeout": float(get_var_value("BRP_POOL_IDLE_TIMEOUT") or 60),
+        "async_size": int(get_var_value("BRP_ASYNC_POOL_SIZE") or 100),
     }
 }
 
@@ -0,0 +1,63 @@
+"""
+
+This module contains the parts of the request handling that app.py (Flask) and asgi.py (ASGI) share
+
+It does not import Flask, so that the ASGI variant of the app can be loaded without it.
+
+"""
+
+import hmac
+
+from stuf.scheduler import INTERACTIVE, PRIORITIES
+
+
+def get_batch_bag_ids(body):
+    """Get the list of BAG ids from the body of a batch request
+
+    Args:
+        body: the JSON body, either a list of BAG ids or an object with a bag_ids property
+
+    Returns:
+        list(str): the BAG ids or None if the body is not valid
+
+    """
+    bag_ids = body.get("bag_ids") if isinstance(body, dict) else body
+    if not isinstance(bag_ids, list) or not all(isinstance(bag_id, str) and bag_id for bag_id in bag_ids):
+        return None
+    return bag_ids
+
+
+def get_batch_priority(body):
+    """Get the priority class of the requests to BRP for a batch request
+
+    Bulk clients should use the background priority, so that they do not delay the interactive lookups.
+
+    Args:
+        body: the JSON body, the priority is the priority property of an object
+
+    Returns:
+        str: the priority class, interactive if it is not given, None if it is not valid
+
+    """
+    priority = body.get("priority", INTERACTIVE) if isinstance(body, dict) else INTERACTIVE
+    return priority if priority in PRIORITIES else None
+
+
+def check_admin_token(config, authorization):
+    """Check the access to the admin endpoints
+
+    The admin endpoints are only available with BRP_ADMIN_TOKEN, as a bearer token in the Authorization header.
+
+    Args:
+        config (dict): the configuration of the app
+        authorization (str): the Authorization header of the request, empty if it has none
+
+    Returns:
+        tuple: the status, the JSON body and the headers of the response if the access is denied, otherwise None
+
+    """
+    if not config["admin_token"]:
+        return 404, {"error": "Beheer is uitgeschakeld"}, {}
+    if not hmac.compare_digest(authorization.encode("utf-8"), f"Bearer {config['admin_token']}".encode("utf-8")):
+        return 401, {"error": "Geen toegang"}, {"WWW-Authenticate": "Bearer"}
+    return None
@@ -0,0 +1,208 @@
+"""
+
+This module contains the bulk export of the indicatoren for a list of BAG ids
+
+The BAG ids are read line by line from a file or stdin and the results are written as JSON lines, one line per
+address, in the order of the BAG ids. At most --concurrency requests to BRP are in flight and at most --rate
+requests per second are sent.
+
+The birthdates per address can also be stored in a snapshot file, see stuf/snapshot.py.
+
+Progress is recorded in a checkpoint file. When the export is interrupted, running it again with the same
+arguments resumes after the last checkpoint.
+
+    python export.py --input bag_ids.txt --output indicatoren.jsonl --checkpoint indicatoren.checkpoint
+
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from config import check_env_vars, config
+from stuf.scheduler import BACKGROUND
+from stuf.snapshot import SnapshotWriter
+from stuf.stuf_0204 import lookup_Lv01
+
+
+class RateLimiter:
+    """Thread-safe limit on the number of calls per second
+
+    Args:
+        rate (float): the maximum number of calls per second, 0 for no limit
+
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        """Wait until the next call is allowed
+
+        Returns:
+            None
+
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(self._next, now) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def read_checkpoint(path):
+    """Read the checkpoint of an earlier export
+
+    Args:
+        path (str): the path of the checkpoint file, may be None
+
+    Returns:
+        dict: the number of processed input lines and the size of the output at the checkpoint
+
+    """
+    if path and os.path.exists(path):
+        with open(path) as file:
+            return json.load(file)
+    return {"lines": 0, "size": 0}
+
+
+def write_checkpoint(path, lines, output, snapshot=None):
+    """Write a checkpoint after the output and the snapshot have been written to disk
+
+    Args:
+        path (str): the path of the checkpoint file, may be None
+        lines (int): the number of processed input lines
+        output (file): the output file
+        snapshot (SnapshotWriter): the snapshot, may be None
+
+    Returns:
+        None
+
+    """
+    if snapshot is not None:
+        # The lines before the checkpoint are not exported again, their birthdates must have been stored
+        snapshot.commit()
+    output.flush()
+    if not path:
+        return
+    os.fsync(output.fileno())
+    with open(path + ".tmp", "w") as file:
+        json.dump({"lines": lines, "size": output.tell()}, file)
+    os.replace(path + ".tmp", path)
+
+
+def read_bag_ids(lines, skip):
+    """Read the BAG ids from the input lines
+
+    Args:
+        lines (iterable(str)): the input lines
+        skip (int): the number of lines that have already been processed
+
+    Yields:
+        tuple: the line number (starting at 1) and the BAG id, None for an empty line
+
+    """
+    for number, line in enumerate(lines, start=1):
+        if number > skip:
+            yield number, line.strip() or None
+
+
+def _lookup(bag_id, limiter, lookup_config):
+    if bag_id is None:
+        return None
+    limiter.wait()
+    return lookup_Lv01(bag_id, lookup_config)[0]
+
+
+def write_lookup(output, snapshot, bag_id, lookup):
+    """Write the address informations of a lookup as JSON lines and store its birthdates in the snapshot
+
+    Args:
+        output (file): the output file
+        snapshot (SnapshotWriter): the snapshot to store the birthdates per address in, may be None
+        bag_id (str): the BAG id
+        lookup (Lookup): the lookup, None for an empty input line
+
+    Returns:
+        None
+
+    """
+    if lookup is None:
+        return
+    for info in lookup.results:
+        output.write(json.dumps(info.as_dict(), sort_keys=True) + "\n")
+    if snapshot is not None and lookup.addresses is not None:
+        snapshot.put(bag_id, lookup.addresses, time.time() - (lookup.age or 0))
+
+
+def export(lines, output, checkpoint=None, concurrency=8, rate=10, interval=100, snapshot=None):
+    """Export the indicatoren for the BAG ids in the input lines
+
+    Args:
+        lines (iterable(str)): the input lines, one BAG id per line
+        output (file): the output file, positioned at the last checkpoint
+        checkpoint (str): the path of the checkpoint file
+        concurrency (int): the maximum number of concurrent requests
+        rate (float): the maximum number of requests per second
+        interval (int): the number of input lines between checkpoints
+        snapshot (SnapshotWriter): the snapshot to store the birthdates per address in
+
+    Returns:
+        int: the number of processed input lines
+
+    """
+    limiter = RateLimiter(rate)
+    lookup_config = dict(config, concurrency=1, priority=BACKGROUND)
+
+    def write(number, bag_id, future):
+        write_lookup(output, snapshot, bag_id, future.result())
+        if number % interval == 0:
+            write_checkpoint(checkpoint, number, output, snapshot)
+
+    number = read_checkpoint(checkpoint)["lines"]
+    pending = deque()   # the lookups in flight, in the order of the input lines
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for number, bag_id in read_bag_ids(lines, number):
+            pending.append((number, bag_id, executor.submit(_lookup, bag_id, limiter, lookup_config)))
+            if len(pending) >= 2 * concurrency:
+                write(*pending.popleft())
+        for item in pending:
+            write(*item)
+
+    write_checkpoint(checkpoint, number, output, snapshot)
+    return number
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Export the indicatoren for a list of BAG ids")
+    parser.add_argument("--input", default="-", help="file with one BAG id per line, default stdin")
+    parser.add_argument("--output", required=True, help="JSON lines output file")
+    parser.add_argument("--checkpoint", help="checkpoint file to resume an interrupted export")
+    parser.add_argument("--concurrency", type=int, default=8, help="maximum number of concurrent requests")
+    parser.add_argument("--rate", type=float, default=10, help="maximum number of requests per second")
+    parser.add_argument("--snapshot", help="snapshot file to store the birthdates per address in")
+    args = parser.parse_args(args)
+
+    check_env_vars()
+
+    snapshot = SnapshotWriter(args.snapshot) if args.snapshot else None
+    with open(args.output, "a" if args.checkpoint else "w") as output:
+        # Discard any output after the last checkpoint, it will be written again
+        output.truncate(read_checkpoint(args.checkpoint)["size"])
+        lines = sys.stdin if args.input == "-" else open(args.input)
+        with lines:
+            export(lines, output, args.checkpoint, args.concurrency, args.rate, snapshot=snapshot)
+    if snapshot is not None:
+        snapshot.close()
+
+
+if __name__ == "__main__":
+    main()
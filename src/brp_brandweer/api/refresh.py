@@ -0,0 +1,132 @@
+"""
+
+This module contains the incremental refresh of the information per BAG id
+
+Instead of refreshing all BAG ids, only the BAG ids that have changed in BRP are requested again. The changed
+BAG ids are dropped as files in a feed directory, one BAG id per line. Write a file under a name that starts with
+a dot or ends with .tmp and rename it when it is complete. Processed files are removed; BAG ids that could not be
+requested are written to a new file in the feed directory, to be tried again in the next run.
+
+The information for the changed BAG ids replaces the information in the cache (when its backend is shared with
+the API, see BRP_CACHE_BACKEND) and in the snapshot.
+
+The indicatoren of a BAG id also change when a person moves to another age category. The snapshot holds the next
+date at which that happens, on that date the indicatoren are recomputed from the birthdates in the snapshot
+without requesting BRP. The cache does not need this, its indicatoren are computed when they are read.
+
+All new and recomputed indicatoren are appended to the output as JSON lines, like export.py, for consumers that
+only want the changes.
+
+    python refresh.py --feed /var/spool/brp_brandweer --snapshot snapshot.sqlite --output changes.jsonl --watch 60
+
+"""
+
+import argparse
+import os
+import time
+
+from config import check_env_vars, config
+from export import write_lookup
+from stuf.scheduler import BACKGROUND
+from stuf.snapshot import SnapshotWriter
+from stuf.stuf_0204 import _get_lookup, _unreachable, refresh_Lv01
+
+
+def read_feed(path):
+    """Read the changed BAG ids from the feed directory
+
+    Args:
+        path (str): the path of the feed directory
+
+    Returns:
+        tuple: the paths of the complete files in the feed directory and the BAG ids in these files, without
+            duplicates
+
+    """
+    files = [os.path.join(path, name) for name in sorted(os.listdir(path))
+             if not name.startswith(".") and not name.endswith(".tmp")]
+    bag_ids = {}
+    for file in files:
+        with open(file) as lines:
+            bag_ids.update((line.strip(), None) for line in lines if line.strip())
+    return files, list(bag_ids)
+
+
+def write_feed(path, bag_ids):
+    """Add a file with BAG ids to the feed directory
+
+    Args:
+        path (str): the path of the feed directory
+        bag_ids (list(str)): the BAG ids
+
+    Returns:
+        None
+
+    """
+    name = f"retry-{time.time():.6f}"
+    with open(os.path.join(path, f".{name}.tmp"), "w") as file:
+        file.writelines(bag_id + "\n" for bag_id in bag_ids)
+    os.replace(os.path.join(path, f".{name}.tmp"), os.path.join(path, name))
+
+
+def refresh(bag_ids, output, snapshot=None, reference_date=None):
+    """Refresh the information for the changed BAG ids and recompute the indicatoren that changed with age
+
+    Args:
+        bag_ids (list(str)): the BAG ids that have changed in BRP
+        output (file): the output file
+        snapshot (SnapshotWriter): the snapshot to update, may be None
+        reference_date (datetime.date): the date up to which to recompute indicatoren, defaults to today
+
+    Returns:
+        list(str): the BAG ids that could not be requested
+
+    """
+    failed = []
+    for bag_id, lookup in zip(bag_ids, refresh_Lv01(bag_ids, dict(config, priority=BACKGROUND))):
+        if lookup.results[0].error == _unreachable:
+            failed.append(bag_id)
+        else:
+            write_lookup(output, snapshot, bag_id, lookup)
+
+    if snapshot is not None:
+        for bag_id, addresses, stored in snapshot.due(reference_date):
+            write_lookup(output, None, bag_id, _get_lookup(bag_id, addresses, "snapshot"))
+            # Schedule the next change
+            snapshot.put(bag_id, addresses, stored, reference_date)
+        snapshot.commit()
+
+    output.flush()
+    return failed
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Refresh the indicatoren for the changed BAG ids")
+    parser.add_argument("--feed", required=True, help="directory with files of changed BAG ids")
+    parser.add_argument("--output", required=True, help="JSON lines output file, new lines are appended")
+    parser.add_argument("--snapshot", help="snapshot file to update")
+    parser.add_argument("--watch", type=float, default=0, help="seconds between runs, default a single run")
+    args = parser.parse_args(args)
+
+    check_env_vars()
+
+    snapshot = SnapshotWriter(args.snapshot) if args.snapshot else None
+    while True:
+        files, bag_ids = read_feed(args.feed)
+        with open(args.output, "a") as output:
+            failed = refresh(bag_ids, output, snapshot)
+        if failed:
+            write_feed(args.feed, failed)
+        for file in files:
+            os.remove(file)
+
+        if not args.watch:
+            break
+        time.sleep(args.watch)
+
+    if snapshot is not None:
+        snapshot.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+"""
+
+This module contains the asyncio counterpart of stuf_0204, to send and receive Stuf messages
+
+Requests are sent over a pooled httpx.AsyncClient, so that many lookups can be in flight in a single process.
+The messages, the parsing, the cache, the snapshot, the circuit breaker and the scheduler are shared with
+stuf_0204.
+
+Requires the httpx package.
+
+"""
+
+import asyncio
+import time
+import xml.etree.ElementTree as ET
+
+import httpx
+from requests import RequestException, Timeout
+
+from .cache import get_cache
+from .config_0204 import soap_action
+from .metrics import request_seconds, response_bytes, stage_seconds
+from .parse_0204 import La01Parser
+from .resilience import CircuitOpenError, get_breaker, get_latencies, record_hedge
+from .scheduler import INTERACTIVE, get_scheduler
+from .snapshot import get_snapshot
+from .stuf_0204 import _check_fault, _check_status, _chunk_size, _get_error_lookup, _get_flight_key, _get_lookup, \
+    _lookup_snapshot, _unreachable, get_Lv01_template
+
+_clients = {}
+
+# Concurrent requests for the same BAG id share a single Lv01 request
+_flights = {}
+
+
+def get_client(config):
+    """Get the process-wide async client for the given configuration
+
+    The client should only be used from a single event loop
+
+    Args:
+        config (dict): the configuration to use for requesting messages
+
+    Returns:
+        httpx.AsyncClient: the client
+
+    """
+    key = config["host"]
+    if key not in _clients:
+        pool_config = config.get("pool", {})
+        timeout_config = config.get("timeout", {})
+        _clients[key] = httpx.AsyncClient(
+            cert=config["cert"],
+            verify=True if config["verify"] is None else config["verify"],
+            limits=httpx.Limits(
+                max_connections=pool_config.get("async_size", 100),
+                max_keepalive_connections=pool_config.get("async_size", 100),
+                keepalive_expiry=pool_config.get("idle_timeout", 60)
+            ),
+            timeout=httpx.Timeout(
+                timeout_config.get("read"),
+                connect=timeout_config.get("connect"),
+                pool=timeout_config.get("deadline")
+            )
+        )
+    return _clients[key]
+
+
+async def close_clients():
+    """Close all async clients
+
+    Returns:
+        None
+
+    """
+    while _clients:
+        _, client = _clients.popitem()
+        await client.aclose()
+
+
+async def _single_flight(key, fn):
+    future = _flights.get(key)
+    if future is not None:
+        return await asyncio.shield(future)
+
+    future = _flights[key] = asyncio.get_event_loop().create_future()
+    try:
+        result = await fn()
+        future.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        # The followers have not been cancelled, for them the request failed
+        future.set_exception(RequestException("Request cancelled"))
+        future.exception()
+        raise
+    except BaseException as err:
+        future.set_exception(err)
+        future.exception()  # mark the exception as retrieved, the caller handles it
+        raise
+    finally:
+        del _flights[key]
+
+
+async def _hedge(fn, delay, acquire=None):
+    # See resilience.hedge, acquire is a coroutine function
+    if delay is None:
+        return await fn()
+
+    tasks = {asyncio.ensure_future(fn())}
+    done, _ = await asyncio.wait(tasks, timeout=delay)
+    if not done and (acquire is None or await acquire()):
+        record_hedge()
+        tasks.add(asyncio.ensure_future(fn()))
+
+    while True:
+        done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        succeeded = [task for task in done if task.exception() is None]
+        if succeeded or not tasks:
+            for task in tasks:
+                # The remaining call completes in the background, ignore its outcome
+                task.add_done_callback(lambda task: task.exception())
+            return (succeeded or list(done))[0].result()
+
+
+async def _post_Lv01(bag_id, config, client, deadline):
+    """Send a single Lv01 request and parse the birthdates per address while the response is received
+
+    Args:
+        bag_id (str): the BAG id
+        config (dict): the configuration to use for requesting the message
+        client (httpx.AsyncClient): the client to send the request with
+        deadline (float): the time (time.monotonic()) at which the response should have been received
+
+    Returns:
+        list(list(int)): the birthdates of the living persons per address, see parse_birthdates
+
+    Raises:
+        RequestException: if the message cannot be retrieved before the deadline, or BRP answers with an HTTP
+            error or a SOAP fault
+        ET.ParseError: if the message cannot be parsed
+
+    """
+    with stage_seconds.time("message"):
+        data = get_Lv01_template(config).build(bag_id)
+
+    headers = {
+        "Content-Type": "text/xml;charset=UTF-8",
+        "SOAPAction": soap_action,
+        "Content-Length": str(len(data)),
+    }
+
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise Timeout("Deadline exceeded")
+
+    timeout = config.get("timeout", {})
+    start = time.perf_counter()
+    try:
+        async with client.stream(
+            "POST",
+            config["host"] + config["path"],
+            content=data,
+            headers=headers,
+            timeout=httpx.Timeout(min(timeout.get("read", remaining), remaining), connect=timeout.get("connect"))
+        ) as response:
+            stage_seconds.observe(time.perf_counter() - start, "server")
+            _check_status(response.status_code)
+            parser = La01Parser()
+            addresses = await _receive_addresses(response.aiter_bytes(_chunk_size), deadline, parser)
+    except httpx.HTTPError as err:
+        raise RequestException(str(err)) from err
+    _check_fault(parser)
+    return addresses
+
+
+async def _receive_addresses(chunks, deadline, parser=None):
+    """Parse the birthdates per address while the La01 message is being received
+
+    See stuf_0204._receive_addresses
+
+    """
+    parser = parser or La01Parser()
+    size = 0
+    parsing = 0
+    start = time.perf_counter()
+    async for chunk in chunks:
+        if time.monotonic() > deadline:
+            raise Timeout("Deadline exceeded")
+        parsed = time.perf_counter()
+        parser.feed(chunk)
+        parsing += time.perf_counter() - parsed
+        size += len(chunk)
+    parsed = time.perf_counter()
+    addresses = parser.close()
+    end = time.perf_counter()
+    parsing += end - parsed
+
+    stage_seconds.observe(end - start - parsing, "receive")
+    stage_seconds.observe(parsing, "parse")
+    response_bytes.observe(size)
+    return addresses
+
+
+async def _request_addresses(bag_id, config):
+    """Request the Lv01 message for a single BAG id and parse the birthdates per address
+
+    See stuf_0204._request_addresses
+
+    """
+    latencies = get_latencies(config)
+    hedge_config = config.get("hedge", {})
+    delay = latencies.percentile(hedge_config.get("percentile", 95), hedge_config.get("min_samples", 20)) \
+        if hedge_config.get("percentile") else None
+
+    client = get_client(config)
+    # See stuf_0204._acquire
+    seconds = config.get("timeout", {}).get("deadline", 30)
+    priority = config.get("priority", INTERACTIVE)
+    scheduler = get_scheduler(config)
+    deadline = time.monotonic() + seconds
+    await scheduler.acquire_async(priority, seconds if priority == INTERACTIVE else None)
+    if priority != INTERACTIVE:
+        deadline = time.monotonic() + seconds
+
+    # After the wait for the scheduler, so that a trial request of the breaker is sent right away
+    breaker = get_breaker(config)
+    if not breaker.allow():
+        raise CircuitOpenError("Circuit breaker is open")
+
+    start = time.monotonic()
+    try:
+        addresses = await _hedge(lambda: _post_Lv01(bag_id, config, client, deadline), delay,
+                                 lambda: scheduler.try_acquire_async(priority))
+    except RequestException:
+        breaker.record(False, time.monotonic() - start)
+        await scheduler.record_async(False, time.monotonic() - start)
+        raise
+    except BaseException:
+        # Any other failure, including cancellation, still ends a trial request of the breaker
+        breaker.record(False, time.monotonic() - start)
+        raise
+
+    latency = time.monotonic() - start
+    breaker.record(True, latency)
+    await scheduler.record_async(True, latency)
+    latencies.add(latency)
+    request_seconds.observe(latency)
+    return addresses
+
+
+async def _lookup_address_info(bag_id, config):
+    """Lookup the address informations for a single BAG id, from the cache or from BRP
+
+    Args:
+        bag_id (str): the BAG id
+        config (dict): the configuration to use for requesting the message
+
+    Returns:
+        Lookup: the address informations for the BAG id
+
+    """
+    async def fetch():
+        return await _single_flight(_get_flight_key(bag_id, config), lambda: _request_addresses(bag_id, config))
+
+    try:
+        addresses, age = await get_cache(config).lookup_async(bag_id, fetch)
+    except (ET.ParseError, RequestException) as err:
+        return _get_error_lookup(bag_id, err)
+
+    return _get_lookup(bag_id, addresses, "brp" if age is None else "cache", age)
+
+
+async def lookup_Lv01(bag_ids, config):
+    """Lookup the address informations for the given BAG ids
+
+    At most config["concurrency"] BAG ids are looked up at a time.
+    The lookups are returned in the order of the given BAG ids.
+
+    Args:
+        bag_ids (list(str)): any list of BAG ids
+        config (dict): the configuration to use for requesting the messages
+
+    Returns:
+        list(Lookup): a lookup per BAG id
+
+    """
+    if isinstance(bag_ids, str):
+        # Accept string arguments, automatically convert to list
+        bag_ids = [bag_ids]
+
+    semaphore = asyncio.Semaphore(max(1, config.get("concurrency", 1)))
+
+    async def lookup(bag_id):
+        async with semaphore:
+            return await _lookup_address_info(bag_id, config)
+
+    return list(await asyncio.gather(*[lookup(bag_id) for bag_id in bag_ids]))
+
+
+async def lookup_Lv01_with_fallback(bag_id, config):
+    """Lookup the address informations for a single BAG id, with a fallback on the snapshot
+
+    See stuf_0204.lookup_Lv01_with_fallback
+
+    Args:
+        bag_id (str): the BAG id
+        config (dict): the configuration to use for requesting the message
+
+    Returns:
+        Lookup: the address informations for the BAG id
+
+    """
+    snapshot = get_snapshot(config)
+    if snapshot is None:
+        return await _lookup_address_info(bag_id, config)
+
+    task = asyncio.ensure_future(_lookup_address_info(bag_id, config))
+    try:
+        lookup = await asyncio.wait_for(asyncio.shield(task), config["snapshot"].get("latency_budget") or None)
+        if lookup.results[0].error != _unreachable:
+            return lookup
+    except asyncio.TimeoutError:
+        pass
+
+    return _lookup_snapshot(bag_id, snapshot) or await task
@@ -0,0 +1,576 @@
+"""
+
+This module contains a cache of the information that is retrieved from BRP per BAG id
+
+Only the input for the indicatoren (the birthdates of the living persons at each address) is cached.
+The indicatoren themselves are computed on every read, so that the age categories are always up to date.
+
+Entries are served for at most ttl seconds, empty values (no addresses found) for at most negative_ttl seconds
+so that a new address is soon found. Entries that are older than refresh seconds are still served, but they
+are refreshed in the background (stale-while-revalidate) so that the caller never has to wait. The refreshes
+run on a small pool of threads, one refresh per key at a time.
+Expired entries are still served for stale_if_error seconds when they cannot be fetched again, for example
+when the circuit breaker towards BRP is open.
+
+The entries are stored in a backend:
+
+- memory: a LRU cache per process, limited by the number of entries and their estimated memory size
+- sqlite: a file that is shared by all processes (uWSGI workers) on a node, read through a memory map so that
+  the processes share its pages in the OS page cache instead of copying them
+- redis: a Redis (protocol compatible) server that is shared by all processes that connect to it
+
+Values are stored as JSON in the shared backends, so they should be (nested) lists of simple values or objects
+with a tolist method (like array.array), which are read back as lists. The memory backend stores the values
+as they are.
+
+"""
+
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _to_json(value):
+    # The JSON representation of values that are not lists of simple values, see json.dumps(default=)
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _sizeof(value):
+    """Get an estimate of the memory size of a cached value
+
+    Args:
+        value: any (nested) list of values
+
+    Returns:
+        int: the estimated number of bytes
+
+    """
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_sizeof(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class CacheBackend(ABC):
+    """The interface of a cache backend
+
+    Each entry consists of a value and the time (time.time()) at which it was stored
+
+    """
+
+    # Whether the calls of the backend do I/O, see Cache.lookup_async
+    blocking = True
+
+    @abstractmethod
+    def get(self, key):
+        """Get an entry
+
+        Args:
+            key (str): the key of the entry
+
+        Returns:
+            tuple: the value and the time at which it was stored, or None if the key is not present
+
+        """
+
+    @abstractmethod
+    def set(self, key, value, stored):
+        """Store an entry
+
+        Args:
+            key (str): the key of the entry
+            value: the value
+            stored (float): the time at which the value was stored
+
+        Returns:
+            None
+
+        """
+
+    @abstractmethod
+    def delete(self, key):
+        """Remove an entry
+
+        Args:
+            key (str): the key of the entry
+
+        Returns:
+            bool: True if the key was present
+
+        """
+
+    @abstractmethod
+    def clear(self):
+        """Remove all entries
+
+        Returns:
+            None
+
+        """
+
+    def stats(self):
+        """Get the statistics of the backend
+
+        Returns:
+            dict: any backend specific statistics
+
+        """
+        return {}
+
+
+class MemoryBackend(CacheBackend):
+    """A thread-safe LRU cache backend for a single process
+
+    Args:
+        size (int): the maximum number of entries
+        memory (int): the maximum estimated memory size of all entries in bytes
+
+    """
+
+    blocking = False
+
+    def __init__(self, size=10000, memory=16 * 1024 * 1024):
+        self.size = size
+        self.memory = memory
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key => (value, stored, size)
+        self._memory_used = 0
+        self._evictions = 0
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._memory_used -= size
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[:2]
+
+    def set(self, key, value, stored):
+        size = _sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, stored, size)
+            self._memory_used += size
+            while self._entries and (len(self._entries) > self.size or self._memory_used > self.memory):
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._remove(key)
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._memory_used = 0
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "memory": self._memory_used, "evictions": self._evictions}
+
+
+class SQLiteBackend(CacheBackend):
+    """A cache backend in a SQLite file that can be shared by all processes on a node
+
+    When the file holds more than size entries, the oldest entries are removed. The number of entries is counted
+    once every size / 100 stores of a process, so the file may briefly hold a few more entries. The file is read
+    through a memory map of at most mmap_size bytes.
+
+    Args:
+        path (str): the path of the SQLite file
+        size (int): the maximum number of entries
+        mmap_size (int): the maximum number of bytes of the file to map into memory, 0 disables the memory map
+
+    """
+
+    def __init__(self, path, size=10000, mmap_size=16 * 1024 * 1024):
+        self.path = path
+        self.size = size
+        self.mmap_size = mmap_size
+
+        self._local = threading.local()
+        self._stores = itertools.count(1)
+        self._prune_interval = max(1, size // 100)
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, stored REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_stored ON entries (stored)")
+
+    def _connection(self):
+        # Connections can neither be shared between threads nor between processes
+        if getattr(self._local, "pid", None) != os.getpid():
+            import sqlite3
+
+            self._local.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._local.connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def get(self, key):
+        row = self._connection().execute("SELECT value, stored FROM entries WHERE key = ?", (key,)).fetchone()
+        return None if row is None else (json.loads(row[0]), row[1])
+
+    def set(self, key, value, stored):
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO entries (key, value, stored) VALUES (?, ?, ?)",
+            (key, json.dumps(value, separators=(",", ":"), default=_to_json), stored))
+        if next(self._stores) % self._prune_interval == 0:
+            self._prune(connection)
+
+    def _prune(self, connection):
+        # Remove the oldest entries when there are more than size
+        excess = connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0] - self.size
+        if excess > 0:
+            connection.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY stored LIMIT ?)", (excess,))
+
+    def delete(self, key):
+        return self._connection().execute("DELETE FROM entries WHERE key = ?", (key,)).rowcount > 0
+
+    def clear(self):
+        self._connection().execute("DELETE FROM entries")
+
+    def stats(self):
+        return {"entries": self._connection().execute("SELECT COUNT(*) FROM entries").fetchone()[0]}
+
+
+class RedisBackend(CacheBackend):
+    """A cache backend on a Redis (protocol compatible) server
+
+    Requires the redis package. Entries expire after ttl seconds on the server.
+
+    Args:
+        url (str): the url of the server, eg redis://localhost:6379/0
+        ttl (float): the number of seconds after which entries expire
+        prefix (str): the prefix for all keys
+
+    """
+
+    def __init__(self, url, ttl, prefix="brp_brandweer:"):
+        import redis
+
+        self.ttl = ttl
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, key):
+        entry = self._redis.get(self.prefix + key)
+        return None if entry is None else tuple(json.loads(entry))
+
+    def set(self, key, value, stored):
+        entry = json.dumps([value, stored], separators=(",", ":"), default=_to_json)
+        self._redis.set(self.prefix + key, entry, px=max(1, int(self.ttl * 1000)))
+
+    def delete(self, key):
+        return self._redis.delete(self.prefix + key) > 0
+
+    def clear(self):
+        for key in self._redis.scan_iter(match=self.prefix + "*"):
+            self._redis.delete(key)
+
+
+# The background refreshes of all caches, see Cache.lookup
+_refresh_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="brp_cache_refresh")
+
+
+class Cache:
+    """A thread-safe TTL cache with stale-while-revalidate
+
+    Args:
+        backend (CacheBackend): the backend to store the entries in
+        ttl (float): the number of seconds that an entry may be served, 0 disables the cache
+        refresh (float): the age in seconds after which an entry is refreshed in the background
+        stale_if_error (float): the number of seconds after expiry during which an entry is still served
+            when it cannot be fetched again
+        negative_ttl (float): the number of seconds that an empty value may be served, defaults to ttl
+        max_refreshes (int): the maximum number of pending refreshes, more stale entries are not refreshed until
+            one of them has been refreshed
+
+    """
+
+    def __init__(self, backend=None, ttl=300, refresh=240, stale_if_error=0, negative_ttl=None, max_refreshes=100):
+        self.backend = MemoryBackend() if backend is None else backend
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else min(negative_ttl, ttl)
+        self.refresh = refresh
+        self.stale_if_error = stale_if_error
+        self.max_refreshes = max_refreshes
+
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._stats = {name: 0 for name in ["hits", "misses", "stale_hits", "refreshes", "stale_if_error"]}
+
+    def _get(self, key):
+        entry = self.backend.get(key)
+        if entry is None:
+            return None
+        value, stored = entry
+        return value, max(0, time.time() - stored)
+
+    def _is_expired(self, entry, grace=0):
+        # Whether an entry (value, age) may no longer be served, grace seconds after its expiry
+        return entry is None or entry[1] >= (self.ttl if entry[0] else self.negative_ttl) + grace
+
+    def get(self, key):
+        """Get a cached value
+
+        Args:
+            key (str): the key of the value
+
+        Returns:
+            tuple: the value and its age in seconds, or None if the key is not cached or expired
+
+        """
+        entry = self._get(key)
+        return None if self._is_expired(entry) else entry
+
+    def set(self, key, value):
+        """Store a value in the cache
+
+        Args:
+            key (str): the key of the value
+            value: the value
+
+        Returns:
+            None
+
+        """
+        if self.ttl > 0:
+            self.backend.set(key, value, time.time())
+
+    def purge(self, key):
+        """Remove a value from the cache
+
+        Args:
+            key (str): the key of the value
+
+        Returns:
+            bool: True if the key was cached
+
+        """
+        return self.backend.delete(key)
+
+    def clear(self):
+        """Remove all values from the cache
+
+        Returns:
+            None
+
+        """
+        self.backend.clear()
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _start_refresh(self, key):
+        # A key is refreshed once at a time, other refreshes are dropped
+        with self._lock:
+            if key in self._refreshing or len(self._refreshing) >= self.max_refreshes:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def _end_refresh(self, key, value):
+        if value is not None:
+            self.set(key, value)
+            self._count("refreshes")
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def _refresh(self, key, fetch):
+        value = None
+        try:
+            value = fetch()
+        except Exception:
+            # Keep serving the current value, the next request will try again
+            pass
+        finally:
+            self._end_refresh(key, value)
+
+    async def _call_async(self, fn, *args):
+        # The calls of a blocking backend run in the default executor, so that they do not stall the event loop
+        # Only imported by the asyncio variant of the app
+        import asyncio
+
+        if not self.backend.blocking:
+            return fn(*args)
+        return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
+    async def _refresh_async(self, key, fetch):
+        value = None
+        try:
+            value = await fetch()
+        except Exception:
+            # Keep serving the current value, the next request will try again
+            pass
+        finally:
+            await self._call_async(self._end_refresh, key, value)
+
+    def _refresh_in_background(self, key, fetch):
+        if self._start_refresh(key):
+            _refresh_executor.submit(self._refresh, key, fetch)
+
+    def lookup(self, key, fetch):
+        """Get a value from the cache or fetch it when it is not cached
+
+        Args:
+            key (str): the key of the value
+            fetch (callable): a function without arguments that returns the value
+
+        Returns:
+            tuple: the value and its age in seconds, age is None if the value has just been fetched
+
+        Raises:
+            any exception that is raised by fetch
+
+        """
+        entry = self._get(key)
+        if self._is_expired(entry):
+            self._count("misses")
+            try:
+                value = fetch()
+            except Exception:
+                if self._is_stale_if_error(entry):
+                    return entry
+                raise
+            self.set(key, value)
+            return value, None
+
+        if self._should_refresh(entry):
+            self._refresh_in_background(key, fetch)
+        return entry
+
+    async def lookup_async(self, key, fetch):
+        """Get a value from the cache or fetch it when it is not cached, see lookup
+
+        The calls of a blocking backend (sqlite, redis) run in the default executor of the event loop.
+
+        Args:
+            key (str): the key of the value
+            fetch (callable): a coroutine function without arguments that returns the value
+
+        Returns:
+            tuple: the value and its age in seconds, age is None if the value has just been fetched
+
+        Raises:
+            any exception that is raised by fetch
+
+        """
+        entry = await self._call_async(self._get, key)
+        if self._is_expired(entry):
+            self._count("misses")
+            try:
+                value = await fetch()
+            except Exception:
+                if self._is_stale_if_error(entry):
+                    return entry
+                raise
+            await self._call_async(self.set, key, value)
+            return value, None
+
+        if self._should_refresh(entry) and self._start_refresh(key):
+            import asyncio
+
+            asyncio.ensure_future(self._refresh_async(key, fetch))
+        return entry
+
+    def _is_stale_if_error(self, entry):
+        if not self._is_expired(entry, self.stale_if_error):
+            # Serve the expired value rather than an error
+            self._count("stale_if_error")
+            return True
+        return False
+
+    def _should_refresh(self, entry):
+        if entry[1] >= self.refresh:
+            self._count("stale_hits")
+            return True
+        self._count("hits")
+        return False
+
+    def stats(self):
+        """Get the statistics of the cache
+
+        Returns:
+            dict: the number of hits, misses, stale hits, refreshes and expired entries served on errors in this
+                process and any statistics of the backend
+
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(self.backend.stats())
+        return stats
+
+
+def get_backend(cache_config):
+    """Get the cache backend for the given cache configuration
+
+    Args:
+        cache_config (dict): the cache configuration
+
+    Returns:
+        CacheBackend: the cache backend
+
+    Raises:
+        ValueError: if the backend is unknown
+
+    """
+    backend = cache_config.get("backend", "memory")
+    size = cache_config.get("size", 10000)
+    if backend == "memory":
+        return MemoryBackend(size=size, memory=cache_config.get("memory", 16 * 1024 * 1024))
+    if backend == "sqlite":
+        return SQLiteBackend(path=cache_config["path"], size=size,
+                             mmap_size=cache_config.get("mmap_size", 16 * 1024 * 1024))
+    if backend == "redis":
+        ttl = cache_config.get("ttl", 0) + cache_config.get("stale_if_error", 0)
+        return RedisBackend(url=cache_config["url"], ttl=ttl)
+    raise ValueError(f"Unknown cache backend: {backend}")
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(config):
+    """Get the process-wide cache for the given configuration
+
+    Args:
+        config (dict): the configuration to use for requesting messages
+
+    Returns:
+        Cache: the cache
+
+    """
+    cache_config = config.get("cache", {})
+    key = config["host"]
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = Cache(
+                backend=get_backend(cache_config),
+                ttl=cache_config.get("ttl", 0),
+                refresh=cache_config.get("refresh", 0),
+                stale_if_error=cache_config.get("stale_if_error", 0),
+                negative_ttl=cache_config.get("negative_ttl")
+            )
+        return _caches[key]
@@ -0,0 +1,228 @@
+"""
+
+This module contains a generator of synthetic Stuf 0204 La01 messages, for load and parser tests
+
+The messages have any number of addresses (ADR) with any number of persons (ADRPRSVBL/PRS), of which a fraction
+is deceased and a fraction has a malformed or missing birthdate. Living persons have a nil datumOverlijden,
+like the messages of BRP.
+
+A message is generated in chunks, so that very large messages can be written to a file or socket without
+holding them in memory. The same seed and size parameters always give the same message, on any day: the
+birthdates are picked up to a fixed reference date unless another one is given.
+
+"""
+
+import datetime
+import random
+
+from dateutil.relativedelta import relativedelta
+
+from .config_0204 import ns
+
+_xsi = "http://www.w3.org/2001/XMLSchema-instance"
+
+_header = (
+    "<?xml version='1.0' encoding='UTF-8'?>"
+    '<soapenv:Envelope xmlns:soapenv="{soapenv}"><soapenv:Body>'
+    '<BG:synchroonAntwoordBericht xmlns:BG="{bg}" xmlns:StUF="{stuf}" xmlns:xsi="{xsi}">'
+    '<StUF:stuurgegevens xmlns="{stuf}"><StUF:berichtsoort>La01</StUF:berichtsoort>'
+    '<StUF:entiteittype>ADR</StUF:entiteittype><StUF:sectormodel>BG</StUF:sectormodel>'
+    '<StUF:versieStUF>0204</StUF:versieStUF><StUF:versieSectormodel>0204</StUF:versieSectormodel>'
+    '<StUF:referentienummer>SYN{seed:010}</StUF:referentienummer>'
+    '<StUF:antwoord><StUF:crossRefNummer>TGOLv01010</StUF:crossRefNummer></StUF:antwoord>'
+    '</StUF:stuurgegevens><BG:body xmlns="{bg}">'
+)
+
+_footer = '</BG:body></BG:synchroonAntwoordBericht></soapenv:Body></soapenv:Envelope>'
+
+_nil_tijdvak = (
+    '<BG:tijdvakGeldigheid>'
+    '<StUF:begindatumTijdvakGeldigheid xsi:nil="true" StUF:noValue="nietGeautoriseerd"/>'
+    '<StUF:einddatumTijdvakGeldigheid xsi:nil="true" StUF:noValue="nietGeautoriseerd"/>'
+    '</BG:tijdvakGeldigheid>'
+)
+
+_adr_start = (
+    '<BG:ADR soortEntiteit="F" StUF:sleutelVerzendend="{key}" StUF:sleutelGegevensbeheer="{key}">'
+    '<BG:postcode>{postcode}</BG:postcode>'
+    '<BG:woonplaatsnaam xsi:nil="true" StUF:noValue="waardeOnbekend"/>'
+    '<BG:straatnaam>Rustenburgerstraat</BG:straatnaam><BG:huisnummer>{huisnummer}</BG:huisnummer>'
+    '<BG:huisletter xsi:nil="true" StUF:noValue="geenWaarde"/>'
+    '<BG:huisnummertoevoeging xsi:nil="true" StUF:noValue="geenWaarde"/>' + _nil_tijdvak +
+    '<BG:extraElementen>'
+    '<StUF:extraElement naam="identificatieAOA">{bag_id}</StUF:extraElement>'
+    '<StUF:extraElement naam="identificatieNummerAanduiding">{bag_id}</StUF:extraElement>'
+    '</BG:extraElementen>'
+)
+
+_adr_end = '</BG:ADR>'
+
+_prs = (
+    '<BG:ADRPRSVBL soortEntiteit="R" StUF:sleutelVerzendend="{key}" StUF:sleutelGegevensbeheer="{key}">'
+    '<BG:tijdvakRelatie><StUF:begindatumRelatie>20010501</StUF:begindatumRelatie>'
+    '<StUF:einddatumRelatie xsi:nil="true" StUF:noValue="geenWaarde"/></BG:tijdvakRelatie>'
+    '<BG:PRS soortEntiteit="F" StUF:sleutelVerzendend="{key}" StUF:sleutelGegevensbeheer="{key}">'
+    '{geboortedatum}{datum_overlijden}' + _nil_tijdvak +
+    '</BG:PRS></BG:ADRPRSVBL>'
+)
+
+_living = '<BG:datumOverlijden xsi:nil="true" StUF:noValue="geenWaarde"/>'
+
+# Birthdates that cannot be parsed; a missing birthdate has no text
+_malformed = ["19621341", "20190229", "1962-04-12", "onbekend", ""]
+_nil_geboortedatum = '<BG:geboortedatum xsi:nil="true" StUF:noValue="waardeOnbekend"/>'
+
+# The maximum age at the reference date. The ages are computed at the current date, the margin to the maximum age of
+# the last age category (125) keeps the ages of the generated persons within the age categories for 25 years after
+# the reference date.
+_max_age = 100
+
+# The default latest birthdate, the date of the example messages of BRP
+_default_reference_date = datetime.date(2018, 1, 30)
+
+
+class La01Generator:
+    """A synthetic La01 message
+
+    Args:
+        seed (int): the seed for the message
+        addresses (int): the number of addresses
+        residents (int|tuple(int, int)): the number of persons per address, or the range to pick it from
+        deceased (float): the fraction of deceased persons
+        malformed (float): the fraction of persons with a malformed or missing birthdate
+        bag_id (str): the BAG id of the addresses
+        reference_date (datetime.date): the latest birthdate, defaults to a fixed date (2018-01-30); the earliest
+            birthdate is 100 years earlier
+
+    """
+
+    def __init__(self, seed=0, addresses=1, residents=2, deceased=0.1, malformed=0, bag_id="0363200000399540",
+                 reference_date=None):
+        self.seed = seed
+        self.n_addresses = addresses
+        self.residents = residents if isinstance(residents, tuple) else (residents, residents)
+        self.deceased = deceased
+        self.malformed = malformed
+        self.bag_id = bag_id
+        reference_date = reference_date or _default_reference_date
+        self.first_birthdate = (reference_date - relativedelta(years=_max_age)).toordinal()
+        self.last_birthdate = reference_date.toordinal()
+
+    def _persons(self, rnd):
+        # Yields the birthdate (str, None if nil) and date of death (str, None if living) per person and
+        # None after each address
+        for _ in range(self.n_addresses):
+            for _ in range(rnd.randint(*self.residents)):
+                birth = rnd.randint(self.first_birthdate, self.last_birthdate)
+                birthdate = datetime.date.fromordinal(birth).strftime("%Y%m%d")
+                if rnd.random() < self.malformed:
+                    birthdate = rnd.choice(_malformed + [None])
+                death = None
+                if rnd.random() < self.deceased:
+                    death = datetime.date.fromordinal(rnd.randint(birth, self.last_birthdate)).strftime("%Y%m%d")
+                yield birthdate, death
+            yield None
+
+    def _parts(self):
+        rnd = random.Random(self.seed)
+        yield _header.format(soapenv=ns["soapenv"], bg=ns["ns"], stuf=ns["stuf"], xsi=_xsi, seed=self.seed)
+        key = 9072717000000
+        start = True
+        for person in self._persons(rnd):
+            key += 1
+            if start:
+                yield _adr_start.format(key=key, postcode=f"{1000 + key % 9000}ET", huisnummer=key % 500 + 1,
+                                        bag_id=self.bag_id)
+                start = False
+            if person is None:
+                yield _adr_end
+                start = True
+                continue
+            birthdate, death = person
+            yield _prs.format(
+                key=key,
+                geboortedatum=_nil_geboortedatum if birthdate is None else
+                f"<BG:geboortedatum>{birthdate}</BG:geboortedatum>",
+                datum_overlijden=_living if death is None else f"<BG:datumOverlijden>{death}</BG:datumOverlijden>"
+            )
+        yield _footer
+
+    def chunks(self, chunk_size=64 * 1024):
+        """Generate the message in chunks
+
+        Args:
+            chunk_size (int): the minimum size of the chunks in bytes, the last chunk may be smaller
+
+        Yields:
+            bytes: the next chunk of the message
+
+        """
+        parts = []
+        size = 0
+        for part in self._parts():
+            part = part.encode("utf-8")
+            parts.append(part)
+            size += len(part)
+            if size >= chunk_size:
+                yield b"".join(parts)
+                parts = []
+                size = 0
+        if parts:
+            yield b"".join(parts)
+
+    def write(self, file, chunk_size=64 * 1024):
+        """Write the message to a file, or a socket by its makefile("wb")
+
+        Args:
+            file (file): the binary file to write to
+            chunk_size (int): the size of the chunks that are written
+
+        Returns:
+            int: the number of bytes written
+
+        """
+        size = 0
+        for chunk in self.chunks(chunk_size):
+            file.write(chunk)
+            size += len(chunk)
+        return size
+
+    def size(self):
+        """Get the size of the message without holding it in memory
+
+        Returns:
+            int: the size in bytes
+
+        """
+        return sum(len(chunk) for chunk in self.chunks())
+
+    def message(self):
+        """Get the message
+
+        Returns:
+            bytes: the message
+
+        """
+        return b"".join(self.chunks())
+
+    def addresses(self):
+        """Get the birthdates per address that the message should be parsed into, see parse_birthdates
+
+        Returns:
+            list(list(int)): the birthdates of the living persons per address, None for an address with a
+                living person with a malformed or missing birthdate
+
+        """
+        addresses = []
+        birthdates = []
+        for person in self._persons(random.Random(self.seed)):
+            if person is None:
+                addresses.append(birthdates)
+                birthdates = []
+            elif person[1] is None and birthdates is not None:
+                try:
+                    date = datetime.datetime.strptime(person[0], "%Y%m%d").date()
+                    birthdates.append(date.year * 10000 + date.month * 100 + date.day)
+                except (TypeError, ValueError):
+                    birthdates = None
+        return addresses
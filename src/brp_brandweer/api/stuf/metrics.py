@@ -0,0 +1,282 @@
+"""
+
+This module contains the metrics of the requests to BRP, in the Prometheus text format
+
+- Counter: a count per combination of label values
+- Gauge: a value that is set, per combination of label values
+- Histogram: a distribution over fixed buckets per combination of label values
+- Registry: the metrics of the process, rendered by the /metrics endpoint
+
+Recording a value takes a lock and a few dictionary operations, so the metrics can be left on in production.
+The metrics are kept per process, with multiple uWSGI workers each scrape returns the metrics of one worker.
+
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+latency_buckets = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+size_buckets = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+count_buckets = (0, 1, 2, 3, 4, 6, 10, 20, 50)
+
+
+def _format_labels(names, values, extra=""):
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A thread-safe counter per combination of label values
+
+    Args:
+        name (str): the name of the metric
+        help (str): the description of the metric
+        labels (tuple(str)): the names of the labels
+
+    """
+
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *values, amount=1):
+        """Increment the counter
+
+        Args:
+            values (str): the label values, in the order of the label names
+            amount (float): the amount to increment with
+
+        Returns:
+            None
+
+        """
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def get(self, *values):
+        with self._lock:
+            return self._values.get(values, 0)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}"
+                for labels, value in values]
+
+
+class Gauge(Counter):
+    """A thread-safe value per combination of label values
+
+    Args:
+        name (str): the name of the metric
+        help (str): the description of the metric
+        labels (tuple(str)): the names of the labels
+
+    """
+
+    type = "gauge"
+
+    def set(self, value, *values):
+        """Set the value
+
+        Args:
+            value (float): the value
+            values (str): the label values, in the order of the label names
+
+        Returns:
+            None
+
+        """
+        with self._lock:
+            self._values[values] = value
+
+
+class Histogram:
+    """A thread-safe histogram per combination of label values
+
+    Args:
+        name (str): the name of the metric
+        help (str): the description of the metric
+        buckets (tuple(float)): the upper bounds of the buckets, in increasing order
+        labels (tuple(str)): the names of the labels
+
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=latency_buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value, *values):
+        """Record a value
+
+        Args:
+            value (float): the value
+            values (str): the label values, in the order of the label names
+
+        Returns:
+            None
+
+        """
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._values.get(values)
+            if histogram is None:
+                # The counts per bucket (and +Inf), the sum and the count
+                histogram = self._values[values] = [[0] * (len(self.buckets) + 1), 0, 0]
+            histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def time(self, *values):
+        """Record the duration of a block of code in seconds
+
+        Args:
+            values (str): the label values, in the order of the label names
+
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *values)
+
+    def get(self, *values):
+        """Get the number of recorded values and their sum
+
+        Args:
+            values (str): the label values, in the order of the label names
+
+        Returns:
+            tuple: the count and the sum
+
+        """
+        with self._lock:
+            histogram = self._values.get(values)
+            return (histogram[2], histogram[1]) if histogram else (0, 0)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        with self._lock:
+            values = sorted((labels, (list(counts), total, count)) for labels, (counts, total, count)
+                            in self._values.items())
+        lines = []
+        for labels, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket
+                le = 'le="{}"'.format(bound if bound == "+Inf" else _format_value(float(bound)))
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {_format_value(float(total))}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {count}")
+        return lines
+
+
+class Registry:
+    """The metrics of a process"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        """Add a metric to the registry
+
+        Args:
+            metric (Counter|Gauge|Histogram): the metric
+
+        Returns:
+            Counter|Gauge|Histogram: the metric
+
+        """
+        self._metrics.append(metric)
+        return metric
+
+    def reset(self):
+        for metric in self._metrics:
+            metric.reset()
+
+    def render(self, families=()):
+        """Render the metrics in the Prometheus text format
+
+        Args:
+            families (list(tuple)): any additional metrics as (name, type, help, [(labels, value)]), where
+                labels is a dict of label names and values
+
+        Returns:
+            str: the metrics
+
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend([f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} {metric.type}"])
+            lines.extend(metric.render())
+        for name, metric_type, metric_help, samples in families:
+            lines.extend([f"# HELP {name} {metric_help}", f"# TYPE {name} {metric_type}"])
+            lines.extend(f"{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}"
+                         for labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+stage_seconds = registry.register(Histogram(
+    "brp_stage_seconds",
+    "Duration of the stages of a BRP lookup: message, connect, handshake, server, receive, parse, indicatoren",
+    labels=("stage",)))
+request_seconds = registry.register(Histogram(
+    "brp_request_seconds", "Duration of a BRP request, including any hedged request"))
+response_bytes = registry.register(Histogram(
+    "brp_response_bytes", "Size of the La01 responses", buckets=size_buckets))
+persons_per_address = registry.register(Histogram(
+    "brp_persons_per_address", "Number of living persons per address", buckets=count_buckets))
+errors = registry.register(Counter(
+    "brp_errors_total", "Failed lookups per error class (ParseError, RequestException, not_found) and exception",
+    labels=("error", "exception")))
+range_requests = registry.register(Counter(
+    "brp_range_requests_total",
+    "Requests for a range of BAG ids per outcome (ok, truncated, unattributed, rejected, failed)",
+    labels=("outcome",)))
+scheduler_wait_seconds = registry.register(Histogram(
+    "brp_scheduler_wait_seconds", "Time that a BRP request waited for the scheduler per priority class",
+    labels=("priority",)))
+startup_seconds = registry.register(Gauge(
+    "brp_startup_seconds",
+    "Startup of the process: the time from the start of the process until the app was loaded (load), "
+    "and the duration of the warm-up (warmup) and of opening the connection to BRP (connect)",
+    labels=("phase",)))
+time_to_first_response_seconds = registry.register(Gauge(
+    "brp_time_to_first_response_seconds", "Time from the start of the process until its first HTTP response"))
+http_request_seconds = registry.register(Histogram(
+    "http_request_seconds", "Duration of the HTTP requests", labels=("route", "method", "status")))
+http_response_bytes = registry.register(Histogram(
+    "http_response_bytes", "Size of the HTTP responses", buckets=size_buckets, labels=("route",)))
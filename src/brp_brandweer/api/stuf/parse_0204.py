@@ -32,8 +32,13 @@ De eerste indicator is er dus altijd (waarschuwingsniveau 2 of 3) als de BRP iet
 
 """
 
+import calendar
 import datetime
-from dateutil.relativedelta import relativedelta
+import functools
+import threading
+import xml.etree.ElementTree as ET
+from array import array
+from collections import OrderedDict
 
 from .config_0204 import ns
 
@@ -59,6 +64,19 @@ _age_categories = [
 _kwetsbare_categories = [_age_categories[i]["name"] for i in [0, 2]]    # 0-12 and 70+
 _kritisch_aantal_personen = 10                                          # additional indicator requested
 
+# lookup tables for the age categories
+_age_category_names = [category["name"] for category in _age_categories]
+_age_category_table = {                                                 # age => index of its age category
+    age: i
+    for i, category in enumerate(_age_categories)
+    for age in range(category["min_age"], category["max_age"] + 1)
+}
+_kwetsbare_indices = [_age_category_names.index(category) for category in _kwetsbare_categories]
+_last_category_index = len(_age_categories) - 1
+
+# The ages at which a person moves to another age category (or beyond the last one)
+_age_boundaries = [category["min_age"] for category in _age_categories[1:]] + [_age_categories[-1]["max_age"] + 1]
+
 
 def _get_age(birthdate):
     """Get the age giving a birthdate
@@ -70,10 +88,65 @@ def _get_age(birthdate):
         int: the corresponding age at the current date
 
     """
+    from dateutil.relativedelta import relativedelta
+
     now = datetime.datetime.now().date()
     return relativedelta(now, birthdate).years
 
 
+def _get_ages(birthdates, reference_date=None):
+    """Get the ages for the given birthdates in a single pass
+
+    The age is computed from the difference between the YYYYMMDD integers of the reference date and the
+    birthdate. Like _get_age, persons that are born on February 29 age on February 28 in non-leap years.
+
+    Args:
+        birthdates (iterable(int)): the birthdates as YYYYMMDD
+        reference_date (datetime.date): the date at which to compute the ages, defaults to today
+
+    Returns:
+        array.array: the corresponding ages at the reference date
+
+    """
+    if reference_date is None:
+        reference_date = datetime.date.today()
+    reference = _get_compact_date(reference_date)
+
+    if calendar.isleap(reference_date.year):
+        return array("l", [(reference - birthdate) // 10000 for birthdate in birthdates])
+    return array("l", [(reference - birthdate + (birthdate % 10000 == 229)) // 10000 for birthdate in birthdates])
+
+
+def _get_compact_date(date):
+    return date.year * 10000 + date.month * 100 + date.day
+
+
+def _get_birthday(birthdate, age):
+    # The date (YYYYMMDD) at which a person reaches the given age, see _get_ages
+    year = birthdate // 10000 + age
+    if birthdate % 10000 == 229 and not calendar.isleap(year):
+        return year * 10000 + 228
+    return year * 10000 + birthdate % 10000
+
+
+def get_next_change(birthdates, reference_date=None):
+    """Get the first date after the reference date at which the indicatoren for the birthdates change
+
+    The indicatoren only change without a change in BRP when a person moves to another age category.
+
+    Args:
+        birthdates (iterable(int)): the birthdates as YYYYMMDD
+        reference_date (datetime.date): the date after which to look for a change, defaults to today
+
+    Returns:
+        int: the date as YYYYMMDD, None if the indicatoren never change
+
+    """
+    reference = _get_compact_date(reference_date or datetime.date.today())
+    birthdays = [_get_birthday(birthdate, age) for birthdate in birthdates for age in _age_boundaries]
+    return min((birthday for birthday in birthdays if birthday > reference), default=None)
+
+
 def _get_age_category_names():
     """Get the age categories
 
@@ -81,7 +154,7 @@ def _get_age_category_names():
         list(str): the names of the age categories
 
     """
-    return [category["name"] for category in _age_categories]
+    return list(_age_category_names)
 
 
 def _get_age_category(age):
@@ -94,35 +167,30 @@ def _get_age_category(age):
         str: the name of the age category for the given age
 
     """
-    matches = [c for i, c in enumerate(_age_categories) if c["min_age"] <= age <= c["max_age"]]
-    return matches[0]["name"] if matches else None
+    i = _age_category_table.get(age)
+    return None if i is None else _age_category_names[i]
 
 
-def _get_indicatoren(ages):
-    """Get the indicatoren (kwetsbaarheid en aantal) for the given ages
+def _render_indicatoren(counts):
+    """Get the indicatoren (kwetsbaarheid en aantal) for the given number of persons per age category
 
     Args:
-        ages (list): A list of ages of persons
+        counts (list(int)): the number of persons per age category, in the order of _age_categories
 
     Returns:
-        list(dict): a list of indicator objects that correspond to the given list of ages
+        list(dict): a list of indicator objects that correspond to the given numbers of persons
 
     """
-    aantal_personen = len(ages)
-
-    # Initialize each age category and then increment for each age in the respective category
-    age_categories = {category: 0 for category in _get_age_category_names()}
-    for category in [_get_age_category(age) for age in ages]:
-        age_categories[category] += 1
+    aantal_personen = sum(counts)
 
     # compose a string that describes the number of persons per age category
     aanvullende_informatie = "Ingeschrevenen " + \
-                             ", ".join([f"{category} jaar: {age_categories[category]} pers."
-                                        for category in _get_age_category_names()])
+                             ", ".join([f"{category} jaar: {count} pers."
+                                        for category, count in zip(_age_category_names, counts)])
 
-    # Convert the ages into indicatoren
+    # Convert the counts into indicatoren
     indicatoren = [{
-        "waarschuwingsniveau": 2 if sum([age_categories[category] for category in _kwetsbare_categories]) else 3,
+        "waarschuwingsniveau": 2 if sum([counts[i] for i in _kwetsbare_indices]) else 3,
         "indicator": "Kwetsbare personen",
         "label": "Leeftijd",
         "aanvullende_informatie": aanvullende_informatie
@@ -139,6 +207,455 @@ def _get_indicatoren(ages):
     return indicatoren
 
 
+@functools.lru_cache(maxsize=4096)
+def _render_counts(counts):
+    # The indicatoren only depend on the counts, which take few distinct values; the lists are shared
+    return _render_indicatoren(counts)
+
+
+def _get_category_indices(ages):
+    """Get the index of the age category for each age
+
+    An age outside all age categories (a birthdate in the future or more than 125 years ago) is counted in the
+    nearest category, so that a single wrong birthdate does not make the indicatoren of an address fail
+
+    Args:
+        ages (iterable(int)): the ages
+
+    Returns:
+        array.array: the index of the age category per age
+
+    """
+    table = _age_category_table
+    return array("b", [table[age] if age in table else (0 if age < 0 else _last_category_index) for age in ages])
+
+
+def _get_counts(ages):
+    """Get the number of persons per age category for the given ages
+
+    Args:
+        ages (list): A list of ages of persons
+
+    Returns:
+        tuple(int): the number of persons per age category, in the order of _age_categories
+
+    """
+    categories = _get_category_indices(ages)
+    return tuple(categories.count(i) for i in range(len(_age_categories)))
+
+
+def _get_indicatoren(ages):
+    """Get the indicatoren (kwetsbaarheid en aantal) for the given ages
+
+    Args:
+        ages (list): A list of ages of persons
+
+    Returns:
+        list(dict): a list of indicator objects that correspond to the given list of ages
+
+    """
+    return _render_indicatoren(_get_counts(ages))
+
+
+# The number of persons per age category per list of birthdates, see get_counts
+_rendered = OrderedDict()
+_rendered_lock = threading.Lock()
+_rendered_size = 10000
+
+
+def get_counts(birthdates, reference_date=None):
+    """Get the number of persons per age category for the birthdates of the persons at an address
+
+    The counts for the same birthdates are computed once and reused until the next date at which a person
+    moves to another age category (see get_next_change), so that serving them is a lookup and a date comparison.
+
+    Args:
+        birthdates (iterable(int)): the birthdates as YYYYMMDD
+        reference_date (datetime.date): the date at which to compute the ages, defaults to today
+
+    Returns:
+        tuple(int): the number of persons per age category, in the order of _age_categories
+
+    """
+    birthdates = birthdates if isinstance(birthdates, array) else array("i", birthdates)
+    key = birthdates.tobytes()
+    reference_date = reference_date or datetime.date.today()
+    reference = _get_compact_date(reference_date)
+    with _rendered_lock:
+        entry = _rendered.get(key)
+        if entry is not None and entry[0] <= reference and (entry[1] is None or reference < entry[1]):
+            _rendered.move_to_end(key)
+            return entry[2]
+
+    counts = _get_counts(_get_ages(birthdates, reference_date))
+    with _rendered_lock:
+        # Computed at the reference date, valid until the next change
+        _rendered[key] = (reference, get_next_change(birthdates, reference_date), counts)
+        if len(_rendered) > _rendered_size:
+            _rendered.popitem(last=False)
+    return counts
+
+
+def get_indicatoren(birthdates, reference_date=None):
+    """Get the indicatoren for the birthdates of the persons at an address
+
+    The indicatoren are rendered once per distinct number of persons per age category (see get_counts).
+    The returned list is shared, it should not be modified.
+
+    Args:
+        birthdates (iterable(int)): the birthdates as YYYYMMDD
+        reference_date (datetime.date): the date at which to compute the ages, defaults to today
+
+    Returns:
+        list(dict): a list of indicator objects, see _get_indicatoren
+
+    """
+    return _render_counts(get_counts(birthdates, reference_date))
+
+
+def get_indicatoren_batch(birthdates, offsets, reference_date=None):
+    """Get the indicatoren for many addresses at once
+
+    The birthdates of all addresses are given as one column, the birthdates of address i are
+    birthdates[offsets[i]:offsets[i + 1]]. The result is identical to calling _get_indicatoren with the
+    ages of the persons at each address.
+
+    Args:
+        birthdates (array.array): the birthdates (YYYYMMDD) of the persons at all addresses
+        offsets (array.array): the offset of the first birthdate of each address, followed by len(birthdates)
+        reference_date (datetime.date): the date at which to compute the ages, defaults to today
+
+    Returns:
+        list(list(dict)): the indicatoren per address
+
+    """
+    categories = _get_category_indices(_get_ages(birthdates, reference_date))
+    category_indices = range(len(_age_categories))
+
+    indicatoren = []
+    for start, end in zip(offsets, offsets[1:]):
+        address_categories = categories[start:end]
+        indicatoren.append(_render_indicatoren([address_categories.count(i) for i in category_indices]))
+    return indicatoren
+
+
+def _parse_birthdate(text):
+    """Parse a birthdate into a compact birthdate
+
+    Args:
+        text (str): the birthdate as YYYYMMDD
+
+    Returns:
+        int: the birthdate as YYYYMMDD
+
+    Raises:
+        ValueError: if the text is not a valid date
+
+    """
+    return _get_compact_date(datetime.datetime.strptime(text, "%Y%m%d").date())
+
+
+def parse_birthdates(address):
+    """Parse the birthdates of all living persons (PRS) that live at the address
+
+    The birthdates are returned as compact YYYYMMDD integers
+
+    Args:
+        address (xml.etree.ElementTree): the address part of the stuf message
+
+    Returns:
+        list(int): the birthdates or None if the message cannot be parsed
+
+    """
+    try:
+        return [
+            _parse_birthdate(prs.find("./ns:geboortedatum", ns).text)
+            for prs in address.findall(".//ns:PRS", ns)
+            if not prs.find("./ns:datumOverlijden", ns).text
+        ]
+    except (TypeError, ValueError):
+        return None
+
+
+class PackedAddresses:
+    """The birthdates of the living persons per address, packed in a single array
+
+    Per address the array holds the number of birthdates followed by the birthdates (YYYYMMDD), or -1 for an
+    address whose birthdates could not be parsed. This takes 4 bytes per person instead of a list with an int
+    object per person, so that many more addresses fit in the cache.
+
+    Iterating gives the birthdates per address as arrays, None for an address that could not be parsed, like
+    the lists that are returned by parse_birthdates.
+
+    Args:
+        addresses (iterable(list(int))): the birthdates per address, None if they could not be parsed
+
+    """
+
+    __slots__ = ("_data",)
+
+    def __init__(self, addresses=()):
+        data = []
+        for birthdates in addresses:
+            if birthdates is None:
+                data.append(-1)
+            else:
+                data.append(len(birthdates))
+                data.extend(birthdates)
+        # Initialized at once, without the spare room of an array that is extended
+        self._data = array("i", data)
+
+    def __iter__(self):
+        data = self._data
+        position = 0
+        while position < len(data):
+            count = data[position]
+            if count < 0:
+                yield None
+                position += 1
+            else:
+                yield data[position + 1:position + 1 + count]
+                position += 1 + count
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        if isinstance(other, PackedAddresses):
+            return self._data == other._data
+        return self.tolist() == other
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + self._data.__sizeof__()
+
+    def __repr__(self):
+        return f"PackedAddresses({self.tolist()!r})"
+
+    def tolist(self):
+        """Get the birthdates per address as lists, eg to store them as JSON
+
+        Returns:
+            list(list(int)): the birthdates per address, None if they could not be parsed
+
+        """
+        return [None if birthdates is None else birthdates.tolist() for birthdates in self]
+
+
+class La01Parser:
+    """Incremental parser for La01 messages
+
+    The message can be fed in chunks as it arrives. Of each person (PRS) only the geboortedatum and
+    datumOverlijden are kept, all other elements are discarded as soon as they have been read.
+    The memory use is therefore independent of the number of persons in the message.
+
+    Only the outermost address (ADR) elements are taken into account, any persons within an address
+    are considered to live at that address.
+
+    """
+
+    _adr = f"{{{ns['ns']}}}ADR"
+    _prs = f"{{{ns['ns']}}}PRS"
+    _geboortedatum = f"{{{ns['ns']}}}geboortedatum"
+    _datum_overlijden = f"{{{ns['ns']}}}datumOverlijden"
+    _extra_element = f"{{{ns['stuf']}}}extraElement"
+    _fault = f"{{{ns['soapenv']}}}Fault"
+
+    def __init__(self):
+        self._parser = ET.XMLPullParser(events=("start", "end"))
+        self._elements = []         # the currently open elements
+        self._adr_depth = 0         # the number of currently open ADR elements
+        self._birthdates = None     # the birthdates at the current address, None if they cannot be parsed
+        self._bag_id = None         # the BAG id (identificatieNummerAanduiding) of the current address
+        self.addresses = []         # the birthdates per address, see parse_birthdates
+        self.bag_ids = []           # the BAG id per address, None if it is not in the message
+        self.fault = False          # whether the message is a SOAP fault
+
+    def _start(self, element):
+        self._elements.append(element)
+        if element.tag == self._adr:
+            if not self._adr_depth:
+                self._birthdates = []
+                self._bag_id = None
+            self._adr_depth += 1
+        elif element.tag == self._fault:
+            self.fault = True
+
+    def _end_prs(self, prs):
+        datum_overlijden = prs.find(self._datum_overlijden)
+        if self._birthdates is None or (datum_overlijden is not None and datum_overlijden.text):
+            return
+        try:
+            self._birthdates.append(_parse_birthdate(prs.find(self._geboortedatum).text))
+        except (AttributeError, TypeError, ValueError):
+            self._birthdates = None
+
+    def _end_adr(self):
+        self._adr_depth -= 1
+        if not self._adr_depth:
+            self.addresses.append(self._birthdates)
+            self.bag_ids.append(self._bag_id)
+
+    def _end_extra_element(self, extra_element):
+        # ADR/extraElementen/extraElement, not that of a person
+        if extra_element.get("naam") == "identificatieNummerAanduiding" and len(self._elements) > 1 and \
+                self._elements[-2].tag == self._adr:
+            self._bag_id = extra_element.text
+
+    def _end(self, element):
+        self._elements.pop()
+        if not self._adr_depth:
+            return
+
+        if element.tag == self._prs:
+            self._end_prs(element)
+        elif element.tag == self._adr:
+            self._end_adr()
+        elif element.tag == self._extra_element:
+            self._end_extra_element(element)
+
+        # Discard persons, addresses and the direct children of addresses once they have been read
+        parent = self._elements[-1] if self._elements else None
+        if parent is not None and (element.tag in (self._prs, self._adr) or parent.tag == self._adr):
+            parent.remove(element)
+
+    def _process(self):
+        for event, element in self._parser.read_events():
+            if event == "start":
+                self._start(element)
+            else:
+                self._end(element)
+
+    def feed(self, data):
+        """Feed the next chunk of the message
+
+        Args:
+            data (bytes): the next chunk
+
+        Returns:
+            None
+
+        Raises:
+            ET.ParseError: if the message is not well-formed
+
+        """
+        self._parser.feed(data)
+        self._process()
+
+    def close(self):
+        """Finish parsing the message
+
+        Returns:
+            PackedAddresses: the birthdates (YYYYMMDD) of the living persons per address,
+                None for an address if its birthdates cannot be parsed
+
+        Raises:
+            ET.ParseError: if the message is not complete or not well-formed
+
+        """
+        self._parser.close()
+        self._process()
+        return PackedAddresses(self.addresses)
+
+    def get_addresses_by_bag_id(self):
+        """Get the birthdates per address per BAG id, for a message with the addresses of multiple BAG ids
+
+        Should be called after close.
+
+        Returns:
+            dict: the birthdates per address (PackedAddresses) per BAG id, without the addresses that have no
+                BAG id
+
+        """
+        addresses = {}
+        for bag_id, birthdates in zip(self.bag_ids, self.addresses):
+            if bag_id is not None:
+                addresses.setdefault(bag_id, []).append(birthdates)
+        return {bag_id: PackedAddresses(birthdates) for bag_id, birthdates in addresses.items()}
+
+
+class AddressInfo:
+    """The information for the brandweer about a single address
+
+    Only the number of persons per age category is kept, the response object is rendered by as_dict when it
+    is sent.
+
+    Args:
+        bag_id (str): the BAG id of the address
+        counts (tuple(int)): the number of persons per age category, see get_counts
+        error (str): any error message, in which case counts is None
+
+    """
+
+    __slots__ = ("bag_id", "counts", "error")
+
+    def __init__(self, bag_id, counts=None, error=None):
+        self.bag_id = bag_id
+        self.counts = counts
+        self.error = error
+
+    def as_dict(self):
+        """Get the response object for the brandweer
+
+        Returns:
+            dict: the response object, contains an error property in case of any errors
+
+        """
+        # Register the bag_id for this address
+        info = {
+            "locatie": {
+                "bag_id": self.bag_id,
+            },
+        }
+
+        if self.error:
+            info["error"] = self.error
+        else:
+            info["indicatoren"] = _render_counts(self.counts)
+        return info
+
+
+def get_address_info(bag_id, birthdates=None, error_message=None):
+    """Get the information for the brandweer from the birthdates of the persons at an address
+
+    The indicatoren are those at the moment of calling this method, see get_counts
+
+    Args:
+        bag_id (str): the BAG id of the address
+        birthdates (list(int)): the birthdates (YYYYMMDD) of all living persons at the address,
+            None if they could not be parsed
+        error_message (str): any error message that relates to the retrieval of the stuf message
+
+    Returns:
+        AddressInfo: the information, with an error in case of any errors
+
+    """
+    if error_message:
+        return AddressInfo(bag_id, error=error_message)
+
+    if birthdates is None:
+        return AddressInfo(bag_id, error="Bericht kan niet worden vertaald")
+
+    return AddressInfo(bag_id, get_counts(birthdates))
+
+
+def get_info(bag_id, birthdates=None, error_message=None):
+    """Get the response object for the brandweer from the birthdates of the persons at an address
+
+    See get_address_info
+
+    Args:
+        bag_id (str): the BAG id of the address
+        birthdates (list(int)): the birthdates (YYYYMMDD) of all living persons at the address,
+            None if they could not be parsed
+        error_message (str): any error message that relates to the retrieval of the stuf message
+
+    Returns:
+        dict: the response object, contains an error property in case of any errors
+
+    """
+    return get_address_info(bag_id, birthdates, error_message).as_dict()
+
+
 def parse_message(bag_id, address, error_message=None):
     """Parse the stuf address message into a response object for the brandweer
 
@@ -151,33 +668,7 @@ def parse_message(bag_id, address, error_message=None):
         dict: the parsed message, contains an error property in case of any errors
 
     """
-    # Register the bag_id for this address
-    info = {
-        "locatie": {
-            "bag_id": bag_id,
-        },
-    }
-
     if error_message:
-        info["error"] = error_message
-        return info
-
-    # No errors so far, parse the message
-
-    # try to get the ages of all persons (PRS) that live at the address
-    try:
-        ages = [
-            _get_age(birthdate)
-            for birthdate
-            in [
-                datetime.datetime.strptime(prs.find("./ns:geboortedatum", ns).text, "%Y%m%d").date()
-                for prs in address.findall(".//ns:PRS", ns)
-                if not prs.find("./ns:datumOverlijden", ns).text
-            ]
-        ]
-    except ValueError:
-        info["error"] = "Bericht kan niet worden vertaald"
-        return info
+        return get_info(bag_id, error_message=error_message)
 
-    info["indicatoren"] = _get_indicatoren(ages=ages)
-    return info
+    return get_info(bag_id, parse_birthdates(address))
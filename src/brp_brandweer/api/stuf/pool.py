@@ -0,0 +1,284 @@
+"""
+
+This module contains a process-wide pool of (keep-alive) connections to the BRP host
+
+Setting up a mutual TLS connection to the BRP host is the most expensive part of a request.
+The pool keeps the connections open between requests, evicts them when they have been idle for too long
+and resends a request when the server turns out to have closed the kept-alive connection it was sent over.
+
+The pool is safe to use from multiple threads. After a fork (uWSGI workers) a fresh set of connections is
+created, sockets are never shared between processes.
+
+"""
+
+import os
+import threading
+import time
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from .profiler import timed_stage
+
+
+class PoolStats:
+    """Thread-safe counters that describe the use of the connection pool"""
+
+    names = ["requests", "hits", "new_connections", "handshakes", "evictions", "reconnects"]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {name: 0 for name in self.names}
+
+    def increment(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+stats = PoolStats()
+
+# Whether the last connection that the current thread got from a pool was already connected
+_local = threading.local()
+
+
+class _CountingHTTPConnection(HTTPConnection):
+
+    def connect(self):
+        stats.increment("new_connections")
+        with timed_stage("connect"):
+            return super().connect()
+
+
+class _CountingHTTPSConnection(HTTPSConnection):
+
+    def connect(self):
+        stats.increment("new_connections")
+        stats.increment("handshakes")
+        # Includes setting up the TCP connection
+        with timed_stage("handshake"):
+            return super().connect()
+
+
+class _CountingPoolMixin:
+
+    def _get_conn(self, *args, **kwargs):
+        conn = super()._get_conn(*args, **kwargs)
+        _local.reused = getattr(conn, "sock", None) is not None
+        if _local.reused:
+            # An already connected connection is reused
+            stats.increment("hits")
+        return conn
+
+
+class _CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    ConnectionCls = _CountingHTTPConnection
+
+
+class _CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    ConnectionCls = _CountingHTTPSConnection
+
+
+class _CountingAdapter(HTTPAdapter):
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+    def get_connection_pool(self, url, verify, cert):
+        # The connection pool that a request to url with the given verify and cert would be sent over
+        if hasattr(self, "get_connection_with_tls_context"):
+            # requests >= 2.32
+            return self.get_connection_with_tls_context(requests.Request("POST", url).prepare(), verify, cert=cert)
+        connection_pool = self.get_connection(url)
+        self.cert_verify(connection_pool, url, verify, cert)
+        return connection_pool
+
+
+def _is_stale_connection(err):
+    """Check whether a request failed because the server had closed the kept-alive connection
+
+    The request has then not been handled, unlike after a timeout, and can safely be sent again
+
+    Args:
+        err (requests.ConnectionError): the error
+
+    Returns:
+        bool: True if a reused connection was closed or reset by the server
+
+    """
+    cause = err.args[0] if err.args else None
+    return getattr(_local, "reused", False) and isinstance(cause, urllib3.exceptions.ProtocolError)
+
+
+class SessionPool:
+    """A pool of keep-alive connections to a single BRP host
+
+    Args:
+        cert (str): the client certificate
+        verify (bool|str): whether or how to verify the server certificate
+        size (int): the maximum number of connections that are kept open
+        idle_timeout (float): the number of seconds after which idle connections are closed
+
+    """
+
+    def __init__(self, cert, verify, size=10, idle_timeout=60):
+        self.cert = cert
+        self.verify = verify
+        self.size = size
+        self.idle_timeout = idle_timeout
+
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+        self._last_used = 0
+
+    def _new_session(self):
+        session = requests.Session()
+        session.cert = self.cert
+        session.verify = self.verify
+        session.headers["Connection"] = "keep-alive"
+
+        adapter = _CountingAdapter(pool_connections=1, pool_maxsize=self.size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def close(self):
+        """Close all connections in the pool
+
+        Returns:
+            None
+
+        """
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def session(self):
+        """Get the pooled session
+
+        A new session is created on first use, after a fork and after the connections have been idle
+        for more than idle_timeout seconds
+
+        Returns:
+            requests.Session: the session to use for requests to the BRP host
+
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._session is not None and (self._pid != os.getpid() or now - self._last_used > self.idle_timeout):
+                if self._pid == os.getpid():
+                    self._session.close()
+                stats.increment("evictions")
+                self._session = None
+
+            if self._session is None:
+                self._session = self._new_session()
+                self._pid = os.getpid()
+
+            self._last_used = now
+            return self._session
+
+    def connect(self, url, timeout=None):
+        """Open a connection to the host of url and keep it in the pool, without sending a request
+
+        The first request to the host then does not have to wait for the TCP connection and the TLS handshake
+
+        Args:
+            url (str): the url that requests will be posted to
+            timeout (float): the maximum number of seconds to wait for the connection
+
+        Returns:
+            bool: True if the connection has been opened
+
+        """
+        session = self.session()
+        # The same settings as for a request, including any environment variables (REQUESTS_CA_BUNDLE)
+        settings = session.merge_environment_settings(url, {}, None, None, None)
+        connection_pool = session.get_adapter(url).get_connection_pool(url, settings["verify"], settings["cert"])
+        connection = connection_pool._get_conn()
+        try:
+            connection.timeout = timeout
+            connection.connect()
+        except (OSError, urllib3.exceptions.HTTPError):
+            connection.close()
+            return False
+        finally:
+            connection_pool._put_conn(connection)
+        return True
+
+    def post(self, **kwargs):
+        """Post a request over a pooled connection
+
+        When the server has closed the pooled connection the request is sent again over another connection.
+        The broken connection has already been discarded, the other connections are kept.
+
+        Args:
+            kwargs: any arguments for requests.Session.post
+
+        Returns:
+            requests.Response: the response
+
+        Raises:
+            requests.RequestException: if the request cannot be sent
+
+        """
+        stats.increment("requests")
+        # Every pooled connection may have been closed, after which a new connection is made
+        for _ in range(self.size):
+            try:
+                return self.session().post(**kwargs)
+            except requests.ConnectionError as err:
+                if not _is_stale_connection(err):
+                    raise
+                stats.increment("reconnects")
+        return self.session().post(**kwargs)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(config):
+    """Get the process-wide session pool for the given configuration
+
+    Args:
+        config (dict): the configuration to use for requesting messages
+
+    Returns:
+        SessionPool: the session pool
+
+    """
+    pool_config = config.get("pool", {})
+    key = (config["host"], config["cert"], config["verify"])
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = SessionPool(
+                cert=config["cert"],
+                verify=config["verify"],
+                size=pool_config.get("size", 10),
+                idle_timeout=pool_config.get("idle_timeout", 60)
+            )
+        return _pools[key]
+
+
+def get_pool_stats():
+    """Get the statistics of the connection pools in this process
+
+    Returns:
+        dict: the number of requests, reused connections (hits), new connections, TLS handshakes,
+            evictions and reconnects
+
+    """
+    return stats.as_dict()
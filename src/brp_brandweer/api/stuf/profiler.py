@@ -0,0 +1,392 @@
+"""
+
+This module contains the profiling of slow requests (opt-in, BRP_PROFILE_THRESHOLD)
+
+- Trace: the stages of a request (scheduler, message, connect, server, receive, parse, indicatoren) with their
+  duration and details like the sizes and the number of addresses and persons, and any errors
+- Profiler: traces the requests, samples the stacks of the threads that work for a request every interval
+  seconds and keeps the traces of the requests that took longer than the threshold in a ring buffer
+
+A trace is kept per thread. Work for a request in another thread (concurrent lookups, the latency budget of the
+snapshot fallback, hedged requests) is recorded in the trace of the request when the function is bound to it,
+see bind. The asyncio variant of the app is not traced.
+
+Personal data is never recorded: BAG ids are replaced by a keyed hash (the same BAG id gives the same hash
+within a process), any other long numbers (birthdates, BAG ids) in error messages are removed and the stacks only
+contain file and function names.
+
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from .metrics import stage_seconds
+
+# The maximum number of frames per sampled stack and of distinct stacks per trace
+_max_depth = 40
+_max_stacks = 20
+
+# The key for the hashes of BAG ids, different for every process
+_redact_key = os.urandom(16)
+_number = re.compile(r"\d{8,}")
+
+_local = threading.local()
+
+
+def redact_bag_id(bag_id):
+    """Replace a BAG id by a keyed hash, keeping the municipality code
+
+    Args:
+        bag_id (str): the BAG id
+
+    Returns:
+        str: the redacted BAG id
+
+    """
+    digest = hmac.new(_redact_key, bag_id.encode("utf-8"), hashlib.sha256).hexdigest()
+    return f"{bag_id[:4]}-{digest[:12]}"
+
+
+def redact(text):
+    """Remove any long numbers, like BAG ids and birthdates, from a text
+
+    Args:
+        text (str): the text
+
+    Returns:
+        str: the redacted text
+
+    """
+    return _number.sub("<redacted>", text)
+
+
+def _format_stack(frame):
+    # The stack in the folded format of flame graphs: the outermost frame first, separated by semicolons
+    frames = []
+    while frame is not None and len(frames) < _max_depth:
+        code = frame.f_code
+        frames.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ";".join(reversed(frames))
+
+
+class Trace:
+    """The stages and sampled stacks of a single request
+
+    Args:
+        name (str): the name of the request, like the method and route
+
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._stages = []
+        self._stacks = {}
+        self._samples = 0
+        self._threads = set()
+        self._finished = False
+
+    def add(self, stage, seconds, details):
+        """Add a stage that has just ended, ignored when the request has already finished
+
+        Args:
+            stage (str): the name of the stage
+            seconds (float): the duration of the stage
+            details (dict): any details, without personal data
+
+        Returns:
+            None
+
+        """
+        end = time.perf_counter() - self._start
+        entry = dict(details, stage=stage, start=round(end - seconds, 6), seconds=round(seconds, 6),
+                     thread=threading.current_thread().name)
+        with self._lock:
+            if not self._finished:
+                self._stages.append(entry)
+
+    def enter(self):
+        # The current thread starts working for the request
+        with self._lock:
+            self._threads.add(threading.get_ident())
+
+    def leave(self):
+        with self._lock:
+            self._threads.discard(threading.get_ident())
+
+    def sample(self, frames):
+        """Add the stacks of the threads that work for the request
+
+        Args:
+            frames (dict): the current frame per thread id, see sys._current_frames
+
+        Returns:
+            None
+
+        """
+        with self._lock:
+            stacks = [_format_stack(frames[thread]) for thread in self._threads if thread in frames]
+            for stack in stacks:
+                if stack in self._stacks or len(self._stacks) < _max_stacks:
+                    self._stacks[stack] = self._stacks.get(stack, 0) + 1
+                self._samples += 1
+
+    def finish(self):
+        """Stop recording
+
+        Returns:
+            float: the duration of the request in seconds
+
+        """
+        with self._lock:
+            self._finished = True
+            self._threads.clear()
+        return time.perf_counter() - self._start
+
+    def as_dict(self):
+        with self._lock:
+            stacks = sorted(self._stacks.items(), key=lambda item: -item[1])
+            return {
+                "name": self.name,
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(self.started)),
+                "stages": list(self._stages),
+                "samples": self._samples,
+                "stacks": [{"stack": stack, "samples": samples} for stack, samples in stacks],
+            }
+
+
+def current():
+    """Get the trace of the request that the current thread works for
+
+    Returns:
+        Trace: the trace, None if the request is not traced
+
+    """
+    return getattr(_local, "trace", None)
+
+
+def bind(fn):
+    """Bind a function to the trace of the current thread, to be called in another thread
+
+    Args:
+        fn (callable): the function
+
+    Returns:
+        callable: the function, that records in the trace of the current thread wherever it is called
+
+    """
+    trace = current()
+    if trace is None:
+        return fn
+
+    def bound(*args, **kwargs):
+        previous = current()
+        _local.trace = trace
+        trace.enter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            trace.leave()
+            _local.trace = previous
+
+    return bound
+
+
+def add_stage(stage, seconds, **details):
+    """Add a stage to the trace of the current thread, if any
+
+    Args:
+        stage (str): the name of the stage
+        seconds (float): the duration of the stage
+        details: any details, without personal data
+
+    Returns:
+        None
+
+    """
+    trace = current()
+    if trace is not None:
+        trace.add(stage, seconds, details)
+
+
+def record_stage(stage, seconds, **details):
+    """Record a stage of a BRP lookup in the metrics (brp_stage_seconds) and in the trace of the current thread
+
+    See add_stage
+
+    """
+    stage_seconds.observe(seconds, stage)
+    add_stage(stage, seconds, **details)
+
+
+@contextmanager
+def timed_stage(stage, **details):
+    """Record the duration of a block of code as a stage of a BRP lookup, see record_stage
+
+    Args:
+        stage (str): the name of the stage
+        details: any details, without personal data
+
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start, **details)
+
+
+def add_error(err):
+    """Add an error to the trace of the current thread, if any
+
+    Args:
+        err (Exception): the error
+
+    Returns:
+        None
+
+    """
+    add_stage("error", 0, error=type(err).__name__, message=redact(str(err)))
+
+
+class Profiler:
+    """Traces requests and keeps the traces of the slow requests
+
+    Args:
+        threshold (float): the number of seconds after which a request is slow
+        size (int): the number of slow requests to keep
+        interval (float): the number of seconds between two samples of the stacks
+        path (str): a file to append the slow requests to (as JSON lines), if any
+
+    """
+
+    def __init__(self, threshold, size=50, interval=0.01, path=None):
+        self.threshold = threshold
+        self.interval = interval
+        self.path = path
+
+        self._condition = threading.Condition()
+        self._active = set()
+        self._slow = deque(maxlen=size)
+        self._sampler_pid = None
+
+    def _start_sampler(self):
+        # With the condition acquired. Threads do not survive a fork, every process starts its own sampler
+        if self._sampler_pid != os.getpid():
+            self._sampler_pid = os.getpid()
+            threading.Thread(target=self._sample, name="brp_profiler", daemon=True).start()
+
+    def _sample(self):
+        while True:
+            with self._condition:
+                while not self._active:
+                    self._condition.wait()
+            time.sleep(self.interval)
+            with self._condition:
+                traces = list(self._active)
+            frames = sys._current_frames()
+            for trace in traces:
+                trace.sample(frames)
+
+    def start(self, name):
+        """Start tracing a request that is handled by the current thread
+
+        Args:
+            name (str): the name of the request, without personal data
+
+        Returns:
+            Trace: the trace
+
+        """
+        trace = Trace(name)
+        trace.enter()
+        _local.trace = trace
+        with self._condition:
+            self._start_sampler()
+            self._active.add(trace)
+            self._condition.notify_all()
+        return trace
+
+    def finish(self, trace, **details):
+        """Stop tracing a request, and keep the trace when the request was slow
+
+        Args:
+            trace (Trace): the trace
+            details: any details of the outcome, like the status
+
+        Returns:
+            dict: the slow request, None if the request was not slow
+
+        """
+        seconds = trace.finish()
+        if current() is trace:
+            _local.trace = None
+        with self._condition:
+            self._active.discard(trace)
+        if seconds < self.threshold:
+            return None
+
+        slow_request = dict(trace.as_dict(), seconds=round(seconds, 6), interval=self.interval, **details)
+        self._slow.append(slow_request)
+        if self.path:
+            self.dump(self.path, [slow_request])
+        return slow_request
+
+    def slow_requests(self):
+        """Get the last slow requests
+
+        Returns:
+            list(dict): the slow requests, the oldest first
+
+        """
+        return list(self._slow)
+
+    def dump(self, path, slow_requests=None):
+        """Append slow requests to a file, one JSON object per line
+
+        Args:
+            path (str): the file
+            slow_requests (list(dict)): the slow requests, defaults to all kept slow requests
+
+        Returns:
+            None
+
+        """
+        lines = "".join(json.dumps(slow_request, sort_keys=True) + "\n"
+                        for slow_request in (self.slow_requests() if slow_requests is None else slow_requests))
+        with open(path, "a") as file:
+            file.write(lines)
+
+
+_profilers = {}
+_lock = threading.Lock()
+
+
+def get_profiler(config):
+    """Get the process-wide profiler for the given configuration
+
+    Args:
+        config (dict): the configuration to use for requesting messages
+
+    Returns:
+        Profiler: the profiler, None if profiling is disabled
+
+    """
+    profile_config = config.get("profile", {})
+    if not profile_config.get("threshold"):
+        return None
+    key = tuple(sorted(profile_config.items()))
+    with _lock:
+        if key not in _profilers:
+            _profilers[key] = Profiler(**profile_config)
+        return _profilers[key]
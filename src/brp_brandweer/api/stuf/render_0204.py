@@ -0,0 +1,208 @@
+"""
+
+This module contains the serialization of the address informations into the JSON responses for the brandweer
+
+The responses are rendered straight to bytes, byte for byte the same as flask.jsonify of the pinned Flask 0.12:
+sorted keys, non-ASCII characters escaped and a trailing newline, pretty-printed (indent 2, with a space after
+every separator) unless the request is an XMLHttpRequest, then compact. The indicatoren only depend on the
+number of persons per age category, their JSON is rendered once per distinct counts and nesting level and
+reused. The rest of a response is pasted together from pre-encoded constant fragments and the encoded BAG id
+or error message.
+
+orjson is used for encoding the compact layout and the strings when it is installed. Its output is only used when
+it is ASCII, because unlike jsonify it does not escape non-ASCII characters.
+
+"""
+
+import functools
+import json
+import re
+
+from .parse_0204 import _render_counts
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_non_ascii = re.compile(rb"[^\x00-\x7f]")
+
+
+def _separators(pretty):
+    return (", ", ": ") if pretty else (",", ":")
+
+
+def _dumps(value, pretty=False, level=0):
+    """Encode a value as JSON with sorted keys, like flask.jsonify without the trailing newline
+
+    Args:
+        value: any JSON serializable value
+        pretty (bool): pretty-print the JSON, like jsonify of Flask 0.12 does by default
+        level (int): the nesting level of the value in the response, for the indentation of a pretty-printed value
+
+    Returns:
+        bytes: the JSON
+
+    """
+    if orjson is not None and not pretty:
+        data = orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+        if _non_ascii.search(data) is None:
+            return data
+    text = json.dumps(value, sort_keys=True, indent=2 if pretty else None, separators=_separators(pretty))
+    if pretty and level:
+        # Strings are encoded with escaped newlines, so every newline starts an indented line
+        text = text.replace("\n", "\n" + "  " * level)
+    return text.encode("ascii")
+
+
+@functools.lru_cache(maxsize=4096)
+def _render_indicatoren_json(counts, pretty, level):
+    # The counts take few distinct values, see _render_counts
+    return _dumps(_render_counts(counts), pretty, level)
+
+
+class _Layout:
+    """The pre-encoded constant fragments of the responses in the compact or in the pretty-printed layout
+
+    Each fragment includes the separators and the indentation that jsonify puts around the members
+
+    """
+
+    def __init__(self, pretty):
+        self.pretty = pretty
+        item, key = (separator.encode("ascii") for separator in _separators(pretty))
+
+        def newline(level):
+            return b"\n" + b"  " * level if pretty else b""
+
+        def member(name, level):
+            return newline(level) + b'"' + name + b'"' + key
+
+        # The members of an address information in the response object at the given level, see _render_info
+        self.error = {level: member(b"error", level + 1) for level in [0, 2]}
+        self.indicatoren = {level: member(b"indicatoren", level + 1) for level in [0, 2]}
+        self.locatie = {
+            level: item + member(b"locatie", level + 1) + b"{" + member(b"bag_id", level + 2) for level in [0, 2]
+        }
+        self.locatie_end = {level: newline(level + 1) + b"}" for level in [0, 2]}
+
+        self.info_end = newline(0) + b"}\n"
+
+        # A response object of a batch response is at level 2: {"results": [{...}]}
+        self.result = b"{"
+        self.result_age = b"{" + member(b"age", 3) + b"%d" + item
+        self.source = item + member(b"source", 3)
+        self.status = item + member(b"status", 3)
+        self.result_end = newline(2) + b"}"
+        self.results = b"{" + member(b"results", 1) + b"[" + newline(2)
+        self.results_item = item + newline(2)
+        self.results_end = newline(1) + b"]" + newline(0) + b"}\n"
+        self.no_results = b"{" + member(b"results", 1) + b"[]" + newline(0) + b"}\n"
+
+
+_layouts = {pretty: _Layout(pretty) for pretty in [False, True]}
+
+
+def is_pretty(headers):
+    """Check whether flask.jsonify of Flask 0.12 pretty-prints the response to a request
+
+    It does unless the request is an XMLHttpRequest (JSONIFY_PRETTYPRINT_REGULAR, on by default).
+
+    Args:
+        headers: the request headers, a mapping with a get method
+
+    Returns:
+        bool: True if the response is pretty-printed
+
+    """
+    return headers.get("X-Requested-With") != "XMLHttpRequest"
+
+
+def _render_info(info, layout, level):
+    """Render the members of the response object of an address information, up to the end of the locatie
+
+    Args:
+        info (AddressInfo): the address information
+        layout (_Layout): the layout of the response
+        level (int): the nesting level of the response object
+
+    Returns:
+        bytes: the JSON of the members, without the braces of the response object
+
+    """
+    if info.error:
+        head = layout.error[level] + _dumps(info.error)
+    else:
+        head = layout.indicatoren[level] + _render_indicatoren_json(info.counts, layout.pretty, level + 1)
+    return head + layout.locatie[level] + _dumps(info.bag_id) + layout.locatie_end[level]
+
+
+def _render_result(info, source, age, layout):
+    """Render the response object of an address information in a batch response
+
+    Args:
+        info (AddressInfo): the address information
+        source (str): the source of the information (brp, cache or snapshot)
+        age (float): the age of the information in seconds, None if it has just been retrieved from BRP
+        layout (_Layout): the layout of the response
+
+    Returns:
+        bytes: the JSON of the response object, with its age, source and status
+
+    """
+    head = layout.result if age is None else layout.result_age % int(age)
+    return head + _render_info(info, layout, 2) + layout.source + _dumps(source) + layout.status + \
+        (b"404" if info.error else b"200") + layout.result_end
+
+
+def dumps(data, pretty=True):
+    """Render any JSON response body
+
+    Args:
+        data: any JSON serializable value
+        pretty (bool): pretty-print the response, see is_pretty
+
+    Returns:
+        bytes: the response body, identical to that of flask.jsonify(data)
+
+    """
+    return _dumps(data, pretty) + b"\n"
+
+
+def dumps_info(info, pretty=True):
+    """Render the response body for a single address information
+
+    Args:
+        info (AddressInfo): the address information
+        pretty (bool): pretty-print the response, see is_pretty
+
+    Returns:
+        bytes: the response body, identical to that of flask.jsonify(info.as_dict())
+
+    """
+    layout = _layouts[pretty]
+    return b"{" + _render_info(info, layout, 0) + layout.info_end
+
+
+def dumps_results(lookups, pretty=True):
+    """Render the response body of a batch request
+
+    Each address information gets a status, 404 if it has an error and 200 otherwise, and the source and age
+    of its lookup (the age is left out when the information has just been retrieved from BRP).
+
+    Args:
+        lookups (list(Lookup)): the lookups, see stuf_0204.Lookup
+        pretty (bool): pretty-print the response, see is_pretty
+
+    Returns:
+        bytes: the response body, identical to that of flask.jsonify({"results": [...]}) with the response
+            objects of the address informations
+
+    """
+    layout = _layouts[pretty]
+    results = [
+        _render_result(info, lookup.source, lookup.age, layout) for lookup in lookups for info in lookup.results
+    ]
+    if not results:
+        return layout.no_results
+    return layout.results + layout.results_item.join(results) + layout.results_end
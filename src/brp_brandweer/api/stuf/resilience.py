@@ -0,0 +1,263 @@
+"""
+
+This module contains the logic to limit the latency and impact of a slow or failing BRP backend
+
+- LatencyTracker: keeps the latencies of the most recent requests to derive percentiles
+- hedge: sends a duplicate request when the first one takes longer than usual
+- CircuitBreaker: fails fast when too many recent requests have failed or were too slow
+
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from requests import RequestException
+
+
+class CircuitOpenError(RequestException):
+    """Raised when a request is not sent because the circuit breaker is open"""
+
+
+class LatencyTracker:
+    """Thread-safe record of the latencies of the most recent requests
+
+    Args:
+        size (int): the number of latencies to keep
+
+    """
+
+    def __init__(self, size=200):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=size)
+
+    def add(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def reset(self):
+        with self._lock:
+            self._latencies.clear()
+
+    def percentile(self, percentile, min_samples=20):
+        """Get a percentile of the recent latencies
+
+        Args:
+            percentile (float): the percentile, between 0 and 100
+            min_samples (int): the minimum number of latencies that is required
+
+        Returns:
+            float: the latency in seconds, None if there are less than min_samples latencies
+
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies or len(latencies) < min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+
+_hedge_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="brp_hedge")
+_hedges = {"hedged": 0}
+_hedges_lock = threading.Lock()
+
+
+def hedge(fn, delay, acquire=None):
+    """Call fn, and call it once more if the first call has not completed within delay seconds
+
+    The result of the first call that succeeds is returned, the other call is left to complete in the
+    background.
+
+    Args:
+        fn (callable): a function without arguments
+        delay (float): the number of seconds after which the call is hedged, None to never hedge
+        acquire (callable): a function without arguments that is called before the second call, the call is only
+            hedged when it returns True (like Scheduler.try_acquire)
+
+    Returns:
+        the result of fn
+
+    Raises:
+        any exception that is raised by fn, if both calls fail
+
+    """
+    if delay is None:
+        return fn()
+
+    futures = {_hedge_executor.submit(fn)}
+    done, _ = wait(futures, timeout=delay)
+    if not done and (acquire is None or acquire()):
+        record_hedge()
+        futures.add(_hedge_executor.submit(fn))
+
+    while True:
+        done, futures = wait(futures, return_when=FIRST_COMPLETED)
+        succeeded = [future for future in done if future.exception() is None]
+        if succeeded or not futures:
+            return (succeeded or list(done))[0].result()
+
+
+def record_hedge():
+    """Count a hedged call, also used by the asyncio counterpart of hedge
+
+    Returns:
+        None
+
+    """
+    with _hedges_lock:
+        _hedges["hedged"] += 1
+
+
+def get_hedge_stats():
+    """Get the statistics of hedged calls
+
+    Returns:
+        dict: the number of calls that have been hedged
+
+    """
+    with _hedges_lock:
+        return dict(_hedges)
+
+
+class CircuitBreaker:
+    """A thread-safe circuit breaker
+
+    The breaker opens (trips) when, of the last window requests, the fraction that failed or that took longer
+    than latency seconds reaches error_rate. While open, requests are rejected. After reset_timeout seconds a
+    single trial request is allowed (half open); the breaker closes when it succeeds and opens again otherwise.
+    When the outcome of the trial request has not been recorded after another reset_timeout seconds, a next
+    trial request is allowed.
+
+    Args:
+        window (int): the number of recent requests to take into account
+        error_rate (float): the fraction of failed or slow requests at which the breaker opens
+        latency (float): the number of seconds after which a successful request is considered slow
+        reset_timeout (float): the number of seconds after which a trial request is allowed
+
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, window=20, error_rate=0.5, latency=5, reset_timeout=30):
+        self.window = window
+        self.error_rate = error_rate
+        self.latency = latency
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=window)   # True for each failed or slow request
+        self._state = self.CLOSED
+        self._opened = 0
+        self._stats = {"trips": 0, "rejected": 0}
+
+    def reset(self):
+        """Close the breaker and forget all recent requests
+
+        Returns:
+            None
+
+        """
+        with self._lock:
+            self._outcomes.clear()
+            self._state = self.CLOSED
+
+    def allow(self):
+        """Check whether a request may be sent
+
+        Returns:
+            bool: True if the request may be sent
+
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if now - self._opened >= self.reset_timeout:
+                # Allow a single trial request, from then on the reset timeout applies to the trial
+                self._state = self.HALF_OPEN
+                self._opened = now
+                return True
+            self._stats["rejected"] += 1
+            return False
+
+    def _trip(self):
+        self._state = self.OPEN
+        self._opened = time.monotonic()
+        self._stats["trips"] += 1
+
+    def record(self, success, latency):
+        """Record the outcome of a request
+
+        Args:
+            success (bool): whether the request succeeded
+            latency (float): the duration of the request in seconds
+
+        Returns:
+            None
+
+        """
+        bad = not success or latency > self.latency
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                if bad:
+                    self._trip()
+                else:
+                    self._state = self.CLOSED
+                    self._outcomes.clear()
+                return
+
+            self._outcomes.append(bad)
+            if len(self._outcomes) == self.window and sum(self._outcomes) >= self.error_rate * self.window:
+                self._trip()
+                self._outcomes.clear()
+
+    def stats(self):
+        """Get the state and statistics of the breaker
+
+        Returns:
+            dict: the state, the number of trips and the number of rejected requests
+
+        """
+        with self._lock:
+            return dict(self._stats, state=self._state)
+
+
+_breakers = {}
+_latencies = {}
+_lock = threading.Lock()
+
+
+def get_breaker(config):
+    """Get the process-wide circuit breaker for the given configuration
+
+    Args:
+        config (dict): the configuration to use for requesting messages
+
+    Returns:
+        CircuitBreaker: the circuit breaker
+
+    """
+    breaker_config = config.get("breaker", {})
+    with _lock:
+        if config["host"] not in _breakers:
+            _breakers[config["host"]] = CircuitBreaker(**breaker_config)
+        return _breakers[config["host"]]
+
+
+def get_latencies(config):
+    """Get the process-wide latency tracker for the given configuration
+
+    Args:
+        config (dict): the configuration to use for requesting messages
+
+    Returns:
+        LatencyTracker: the latency tracker
+
+    """
+    with _lock:
+        if config["host"] not in _latencies:
+            _latencies[config["host"]] = LatencyTracker()
+        return _latencies[config["host"]]
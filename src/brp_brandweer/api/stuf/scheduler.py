@@ -0,0 +1,452 @@
+"""
+
+This module contains the scheduler of the requests to BRP
+
+Live lookups for the brandweer (interactive) and bulk jobs like the export and the refresh (background) share
+the same BRP backend. Every request to BRP takes a token from a token bucket, so that the rate of requests
+stays within the capacity of the backend. Interactive requests always go first: a background request waits
+while any interactive request is waiting, and leaves a reserve of tokens in the bucket for interactive
+requests.
+
+The rate adapts to the backend (AIMD): it increases additively while the requests succeed within the target
+latency, and it is decreased multiplicatively when a request fails or is slow, at most once per cooldown.
+
+A Scheduler is kept per process. With multiple processes (uWSGI workers, the export and refresh jobs) every
+process would have a rate of its own, and a background job would not know about the lookups of the app. The
+SharedScheduler keeps the token bucket and the rate in a SQLite file instead, so that all processes on a node
+share them, and a background request waits while an interactive request of any process is waiting.
+
+"""
+
+import os
+import threading
+import time
+
+from requests import RequestException
+
+from .metrics import scheduler_wait_seconds
+from .profiler import add_stage
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+PRIORITIES = [INTERACTIVE, BACKGROUND]
+
+
+class RateLimitedError(RequestException):
+    """Raised when a request is not sent because no token became available in time"""
+
+
+class Scheduler:
+    """A thread-safe adaptive token bucket with priority classes
+
+    Args:
+        rate (float): the initial number of requests per second
+        min_rate (float): the minimum number of requests per second
+        max_rate (float): the maximum number of requests per second
+        burst (float): the maximum number of tokens in the bucket, defaults to a second of requests at max_rate
+        reserve (float): the number of tokens that background requests leave for interactive requests
+        latency (float): the target latency in seconds, slower requests decrease the rate
+        increase (float): the increase of the rate per second of requests that are fast and succeed
+        decrease (float): the factor by which the rate is decreased
+        cooldown (float): the minimum number of seconds between two decreases
+
+    """
+
+    # The clock of the bucket
+    _clock = staticmethod(time.monotonic)
+    # Whether taking a token does I/O, see acquire_async
+    blocking = False
+
+    def __init__(self, rate=50, min_rate=1, max_rate=None, burst=None, reserve=1, latency=2, increase=1,
+                 decrease=0.5, cooldown=1):
+        self.initial_rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate
+        self.burst = burst or self.max_rate
+        self.reserve = reserve
+        self.latency = latency
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+
+        self._condition = threading.Condition()
+        self._waiting = {priority: 0 for priority in PRIORITIES}
+        self.reset()
+
+    def reset(self):
+        """Restore the initial rate and fill the bucket
+
+        Returns:
+            None
+
+        """
+        with self._condition:
+            self.rate = self.initial_rate
+            self._tokens = self.burst
+            self._refilled = self._clock()
+            self._adjusted = self._refilled
+            self._decreased = self._refilled - self.cooldown
+            self._stats = {"decreases": 0, "rejected": 0}
+
+    def _take(self, priority):
+        """Take a token if the request with the given priority may be sent now, with the condition acquired
+
+        Returns:
+            float: 0 if a token was taken, otherwise the number of seconds to wait before trying again
+
+        """
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+        needed = 1
+        if priority != INTERACTIVE:
+            if self._waiting[INTERACTIVE]:
+                return 1 / self.rate
+            needed += min(self.reserve, self.burst - 1)
+        if self._tokens >= needed:
+            self._tokens -= 1
+            return 0
+        return (needed - self._tokens) / self.rate
+
+    def acquire(self, priority=INTERACTIVE, timeout=None):
+        """Wait until a request with the given priority may be sent
+
+        Args:
+            priority (str): the priority class, interactive or background
+            timeout (float): the maximum number of seconds to wait, None to wait as long as needed
+
+        Returns:
+            float: the number of seconds that was waited
+
+        Raises:
+            RateLimitedError: if no token became available within timeout seconds
+
+        """
+        start = time.monotonic()
+        with self._condition:
+            self._waiting[priority] += 1
+            try:
+                delay = self._take(priority)
+                while delay:
+                    remaining = None if timeout is None else start + timeout - time.monotonic()
+                    if remaining is not None and remaining < delay:
+                        self._stats["rejected"] += 1
+                        raise RateLimitedError("No capacity for a request to BRP")
+                    self._condition.wait(delay)
+                    delay = self._take(priority)
+            finally:
+                self._waiting[priority] -= 1
+                self._condition.notify_all()
+        waited = time.monotonic() - start
+        scheduler_wait_seconds.observe(waited, priority)
+        add_stage("scheduler", waited, priority=priority)
+        return waited
+
+    def _try_take(self, priority, start, timeout):
+        # Take a token, or get the number of seconds to wait if the timeout leaves time for it
+        with self._condition:
+            delay = self._take(priority)
+            remaining = None if timeout is None else start + timeout - time.monotonic()
+            if delay and remaining is not None and remaining < delay:
+                self._stats["rejected"] += 1
+                raise RateLimitedError("No capacity for a request to BRP")
+            return delay
+
+    async def _call_async(self, fn, *args):
+        # The calls of a blocking scheduler run in the default executor, so that they do not stall the event loop
+        # Only imported by the asyncio variant of the app
+        import asyncio
+
+        if not self.blocking:
+            return fn(*args)
+        return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
+    def try_acquire(self, priority=INTERACTIVE):
+        """Take a token if a request with the given priority may be sent right away, see acquire
+
+        Args:
+            priority (str): the priority class, interactive or background
+
+        Returns:
+            bool: True if a token was taken
+
+        """
+        with self._condition:
+            return not self._take(priority)
+
+    async def try_acquire_async(self, priority=INTERACTIVE):
+        """Take a token if a request with the given priority may be sent right away, see try_acquire"""
+        return await self._call_async(self.try_acquire, priority)
+
+    async def acquire_async(self, priority=INTERACTIVE, timeout=None):
+        """Wait until a request with the given priority may be sent, without blocking the event loop
+
+        See acquire
+
+        """
+        import asyncio
+
+        start = time.monotonic()
+        with self._condition:
+            self._waiting[priority] += 1
+        try:
+            while True:
+                delay = await self._call_async(self._try_take, priority, start, timeout)
+                if not delay:
+                    break
+                await asyncio.sleep(delay)
+        finally:
+            with self._condition:
+                self._waiting[priority] -= 1
+                self._condition.notify_all()
+        waited = time.monotonic() - start
+        scheduler_wait_seconds.observe(waited, priority)
+        return waited
+
+    async def record_async(self, success, latency):
+        """Adapt the rate to the outcome of a request without blocking the event loop, see record"""
+        await self._call_async(self.record, success, latency)
+
+    def record(self, success, latency):
+        """Adapt the rate to the outcome of a request
+
+        Args:
+            success (bool): whether the request succeeded
+            latency (float): the duration of the request in seconds
+
+        Returns:
+            None
+
+        """
+        with self._condition:
+            now = self._clock()
+            if success and latency <= self.latency:
+                # Additive increase, proportional to the time since the last adjustment
+                self.rate = min(self.max_rate, self.rate + self.increase * min(1, now - self._adjusted))
+            elif now - self._decreased >= self.cooldown:
+                # Multiplicative decrease
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self._decreased = now
+                self._stats["decreases"] += 1
+            self._adjusted = now
+
+    def stats(self):
+        """Get the state and statistics of the scheduler
+
+        Returns:
+            dict: the current rate, the available tokens, the number of waiting requests per priority class,
+                the number of rate decreases and the number of rejected requests
+
+        """
+        with self._condition:
+            return dict(self._stats, rate=self.rate, tokens=self._tokens, waiting=dict(self._waiting))
+
+
+class SharedScheduler(Scheduler):
+    """A Scheduler of which the token bucket and the rate are shared by all processes that use the same file
+
+    A process leases tokens from the shared bucket in batches of up to lease seconds of requests at the current
+    rate, so that the file is written once per batch instead of once per request. Leased tokens expire after
+    lease seconds, so that an idle process does not save them up. The adjustments of the rate by a process are
+    added to the shared rate with its next lease. One thread of a process at a time reads and writes the file,
+    without holding the condition, so that the other threads can take the tokens that are left meanwhile.
+
+    When the file cannot be used (for example when it stays locked) the process falls back on its own copy of
+    the bucket, see Scheduler.
+
+    Args:
+        path (str): the SQLite file
+        key (str): the name of the bucket in the file, like the BRP host
+        lease (float): the number of seconds of requests at the current rate to lease at once
+        kwargs: see Scheduler
+
+    """
+
+    _clock = staticmethod(time.time)
+    _started = False
+    blocking = True
+
+    def __init__(self, path, key, lease=0.1, **kwargs):
+        self.path = path
+        self.key = key
+        self.lease = lease
+        self._local = threading.local()
+        # Whether a thread of this process is reading and writing the file
+        self._leasing = False
+        super().__init__(**kwargs)
+        self._started = True
+
+    def _connection(self):
+        # Connections can neither be shared between threads nor between processes
+        if getattr(self._local, "pid", None) != os.getpid():
+            import sqlite3
+
+            self._local.connection = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            self._local.connection.execute("PRAGMA journal_mode=WAL")
+            # In WAL mode a crash of the machine may only lose the last leases, it never corrupts the file
+            self._local.connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection.execute(
+                "CREATE TABLE IF NOT EXISTS scheduler (key TEXT PRIMARY KEY, rate REAL, tokens REAL, refilled REAL, "
+                "adjusted REAL, decreased REAL, interactive REAL)")
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def _lease_shared(self, row, priority, count, rate_change, decreased):
+        """Lease tokens from the shared bucket and add the adjustment of the rate of this process
+
+        Args:
+            row (tuple): the rate, tokens, refill time, decrease time and interactive time of the shared bucket,
+                None for a new bucket
+            priority (str): the priority class of the request that needs a token
+            count (int): the maximum number of tokens to lease, 0 to only exchange the rate
+            rate_change (float): the adjustment of the rate by this process since its last lease
+            decreased (float): the time of the last decrease of the rate by this process
+
+        Returns:
+            tuple: the new state of the shared bucket (see row), the number of leased tokens and the number of
+                seconds to wait before trying again when no tokens were leased
+
+        """
+        now = self._clock()
+        rate, tokens, refilled, shared_decreased, interactive = row or (self.initial_rate, self.burst, now, 0, 0)
+        rate = min(self.max_rate, max(self.min_rate, rate + rate_change))
+        tokens = min(self.burst, tokens + (now - refilled) * rate)
+        decreased = max(decreased, shared_decreased)
+        if not count:
+            return (rate, tokens, now, decreased, interactive), 0, 0
+
+        needed = 1 if priority == INTERACTIVE else 1 + min(self.reserve, self.burst - 1)
+        leased, delay = 0, 0
+        if priority != INTERACTIVE and now < interactive:
+            delay = min(1 / rate, interactive - now)
+        elif tokens >= needed:
+            leased = min(count, int(tokens - needed + 1))
+            tokens -= leased
+        else:
+            delay = (needed - tokens) / rate
+            if priority == INTERACTIVE:
+                # Keep the background requests of all processes waiting until this request has taken its token
+                interactive = max(interactive, now + delay + 1 / rate)
+        return (rate, tokens, now, decreased, interactive), leased, delay
+
+    def _transact(self, priority, count, rate_change, decreased, reset=False):
+        # _lease_shared in a transaction on the file, None if the file cannot be used
+        import sqlite3
+
+        try:
+            connection = self._connection()
+            connection.execute("BEGIN IMMEDIATE")
+        except sqlite3.Error:
+            return None
+        try:
+            row = None if reset else connection.execute(
+                "SELECT rate, tokens, refilled, decreased, interactive FROM scheduler WHERE key = ?",
+                (self.key,)).fetchone()
+            result = self._lease_shared(row, priority, count, rate_change, decreased)
+            (rate, tokens, refilled, decreased, interactive), _, _ = result
+            connection.execute(
+                "INSERT OR REPLACE INTO scheduler VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.key, rate, tokens, refilled, refilled, decreased, interactive))
+            connection.execute("COMMIT")
+            return result
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def _sync(self, priority, count, reset=False):
+        """Lease up to count tokens and exchange the rate with the shared bucket, with the condition acquired
+
+        The condition is released while the file is read and written.
+
+        Returns:
+            float: 0 if a token was taken, otherwise the number of seconds to wait before trying again
+
+        """
+        self._leasing = True
+        rate = self.rate
+        self._condition.release()
+        try:
+            result = self._transact(priority, count, rate - self._synced_rate, self._decreased, reset)
+        finally:
+            self._condition.acquire()
+            self._leasing = False
+            self._condition.notify_all()
+        if result is None:
+            return super()._take(priority) if count else 0
+
+        (shared_rate, self._tokens, self._refilled, decreased, self._interactive), leased, delay = result
+        # Keep the adjustments of the rate that were made meanwhile for the next lease
+        self.rate = min(self.max_rate, max(self.min_rate, shared_rate + self.rate - rate))
+        self._synced_rate = shared_rate
+        self._decreased = max(self._decreased, decreased)
+        if leased:
+            self._leased = leased - 1
+            self._lease_expires = self._clock() + self.lease
+            return 0
+        return delay
+
+    def reset(self):
+        """Restore the initial rate and fill the bucket, for all processes
+
+        Returns:
+            None
+
+        """
+        super().reset()
+        with self._condition:
+            self._leased = 0
+            self._lease_expires = 0
+            self._synced_rate = self.rate
+            # The time until which background requests wait for the interactive requests of any process
+            self._interactive = 0
+            if self._started:
+                # A process that starts joins the shared bucket as it is
+                self._sync(INTERACTIVE, 0, reset=True)
+
+    def _take(self, priority):
+        now = self._clock()
+        if priority != INTERACTIVE:
+            if self._waiting[INTERACTIVE]:
+                return 1 / self.rate
+            if now < self._interactive:
+                return min(1 / self.rate, self._interactive - now)
+        if self._leased >= 1 and now < self._lease_expires:
+            self._leased -= 1
+            return 0
+        if self._leasing:
+            # Another thread is leasing, it notifies the waiting threads when it is done
+            return min(1 / self.rate, 0.01)
+        return self._sync(priority, max(1, int(self.rate * self.lease)))
+
+    def stats(self):
+        with self._condition:
+            if not self._leasing:
+                self._sync(INTERACTIVE, 0)
+        return super().stats()
+
+
+_schedulers = {}
+_lock = threading.Lock()
+
+
+def get_scheduler(config):
+    """Get the process-wide scheduler for the given configuration
+
+    Args:
+        config (dict): the configuration to use for requesting messages
+
+    Returns:
+        Scheduler: the scheduler
+
+    """
+    scheduler_config = dict(config.get("scheduler", {}))
+    backend = scheduler_config.pop("backend", "memory")
+    path = scheduler_config.pop("path", None)
+    with _lock:
+        if config["host"] not in _schedulers:
+            if backend == "sqlite":
+                _schedulers[config["host"]] = SharedScheduler(path, config["host"], **scheduler_config)
+            else:
+                _schedulers[config["host"]] = Scheduler(**scheduler_config)
+        return _schedulers[config["host"]]
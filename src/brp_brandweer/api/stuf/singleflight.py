@@ -0,0 +1,65 @@
+"""
+
+This module contains the logic to coalesce identical concurrent calls (single-flight)
+
+When a call for a key is already in flight, any other caller for the same key waits for that call
+and receives its result (or exception) instead of making a call of its own.
+
+"""
+
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """Thread-safe de-duplication of concurrent calls per key"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stats = {"calls": 0, "coalesced": 0}
+
+    def do(self, key, fn):
+        """Call fn, unless a call for the same key is already in flight
+
+        Args:
+            key (hashable): the key that identifies the call
+            fn (callable): a function without arguments
+
+        Returns:
+            the result of fn, or of the call that was already in flight
+
+        Raises:
+            any exception that is raised by fn
+
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self._stats["calls"] += 1
+            else:
+                self._stats["coalesced"] += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            future.set_result(fn())
+        except BaseException as err:
+            future.set_exception(err)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return future.result()
+
+    def stats(self):
+        """Get the statistics of the calls
+
+        Returns:
+            dict: the number of calls that were made and the number of calls that were coalesced
+
+        """
+        with self._lock:
+            return dict(self._stats)
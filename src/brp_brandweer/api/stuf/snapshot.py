@@ -0,0 +1,182 @@
+"""
+
+This module contains a local snapshot of the information that has been retrieved from BRP per BAG id
+
+The snapshot is a SQLite file with the last known birthdates per address for each BAG id (see cache.py),
+indexed by BAG id. It is filled by a bulk job (export.py --snapshot) and read by the API when BRP cannot be
+reached or does not respond within the latency budget.
+
+The API opens the snapshot read-only, the bulk job can update it while the API is reading from it.
+
+For each BAG id the snapshot also holds the next date at which its indicatoren change because a person moves to
+another age category, so that these can be recomputed without requesting BRP (see refresh.py).
+
+"""
+
+import datetime
+import json
+import os
+import threading
+import time
+
+from .cache import _to_json
+from .parse_0204 import _get_compact_date, get_next_change
+
+
+class Snapshot:
+    """Read-only access to a snapshot file
+
+    Args:
+        path (str): the path of the snapshot file
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        # Connections can neither be shared between threads nor between processes
+        if getattr(self._local, "pid", None) != os.getpid():
+            import sqlite3
+
+            self._local.connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def get(self, bag_id):
+        """Get the last known information for a BAG id
+
+        Args:
+            bag_id (str): the BAG id
+
+        Returns:
+            tuple: the birthdates per address and the time (time.time()) at which they were retrieved,
+                None if the BAG id is not in the snapshot or the snapshot cannot be read
+
+        """
+        import sqlite3
+
+        try:
+            row = self._connection().execute(
+                "SELECT addresses, stored FROM snapshot WHERE bag_id = ?", (bag_id,)).fetchone()
+        except sqlite3.Error:
+            self._local.pid = None
+            return None
+        return None if row is None else (json.loads(row[0]), row[1])
+
+
+class SnapshotWriter:
+    """Write access to a snapshot file, for use by a single thread
+
+    The changes are committed every commit_interval updates and on close.
+
+    Args:
+        path (str): the path of the snapshot file, it is created if it does not exist
+        commit_interval (int): the number of updates per transaction
+
+    """
+
+    def __init__(self, path, commit_interval=1000):
+        import sqlite3
+
+        self.commit_interval = commit_interval
+        self._pending = 0
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS snapshot "
+            "(bag_id TEXT PRIMARY KEY, addresses TEXT, stored REAL, next_change INTEGER)")
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(snapshot)")]
+        if "next_change" not in columns:
+            # Snapshot from before the next change was stored
+            self._connection.execute("ALTER TABLE snapshot ADD COLUMN next_change INTEGER")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS snapshot_next_change ON snapshot (next_change)")
+
+    def put(self, bag_id, addresses, stored=None, reference_date=None):
+        """Store the information for a BAG id
+
+        Args:
+            bag_id (str): the BAG id
+            addresses (PackedAddresses|list(list(int))): the birthdates per address
+            stored (float): the time at which the information was retrieved, defaults to now
+            reference_date (datetime.date): the date after which to schedule the next change, defaults to today
+
+        Returns:
+            None
+
+        """
+        next_change = get_next_change(
+            (birthdate for birthdates in addresses if birthdates for birthdate in birthdates), reference_date)
+        self._connection.execute(
+            "INSERT OR REPLACE INTO snapshot (bag_id, addresses, stored, next_change) VALUES (?, ?, ?, ?)",
+            (bag_id, json.dumps(addresses, separators=(",", ":"), default=_to_json),
+             time.time() if stored is None else stored, next_change))
+        self._pending += 1
+        if self._pending >= self.commit_interval:
+            self.commit()
+
+    def due(self, reference_date=None):
+        """Get the BAG ids for which the indicatoren have changed because a person moved to another age category
+
+        Args:
+            reference_date (datetime.date): the date up to which to look for changes, defaults to today
+
+        Returns:
+            list(tuple): the BAG id, the birthdates per address and the time at which they were retrieved,
+                store them again with put to schedule the next change
+
+        """
+        reference = _get_compact_date(reference_date or datetime.date.today())
+        rows = self._connection.execute(
+            "SELECT bag_id, addresses, stored FROM snapshot WHERE next_change <= ? ORDER BY bag_id", (reference,))
+        return [(bag_id, json.loads(addresses), stored) for bag_id, addresses, stored in rows]
+
+    def commit(self):
+        """Commit the pending updates
+
+        Returns:
+            None
+
+        """
+        self._connection.commit()
+        self._pending = 0
+
+    def close(self):
+        """Commit the pending updates and close the snapshot file
+
+        Returns:
+            None
+
+        """
+        self.commit()
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def get_snapshot(config):
+    """Get the snapshot for the given configuration
+
+    Args:
+        config (dict): the configuration to use for requesting messages
+
+    Returns:
+        Snapshot: the snapshot, or None if no snapshot is configured
+
+    """
+    path = config.get("snapshot", {}).get("path")
+    if not path:
+        return None
+    with _snapshots_lock:
+        if path not in _snapshots:
+            _snapshots[path] = Snapshot(path)
+        return _snapshots[path]
@@ -0,0 +1,128 @@
+"""
+
+This module contains the measurement of the cold start of a process
+
+The first request of a process pays for anything that has not been done yet: loading modules, compiling the
+Lv01 message, setting up the connection to BRP. The time from the start of the process until its first HTTP
+response (brp_time_to_first_response_seconds) shows whether the warm-up of the app (BRP_WARMUP) moved this
+work out of the first request.
+
+The warm-up is done when the app is loaded. uWSGI loads the app in the master process before the workers are
+forked (unless lazy-apps is set), so the workers share the warm-up and the start of a worker process, the moment
+of the fork, is after it. Connections are never shared between processes, each worker opens its own connection
+to BRP after the fork.
+
+"""
+
+import os
+import threading
+import time
+
+from .metrics import startup_seconds, time_to_first_response_seconds
+from .stuf_0204 import connect_Lv01, warm_up_Lv01
+
+_imported = time.monotonic()
+_lock = threading.Lock()
+_responded = {"pid": None}
+
+
+def _get_process_age():
+    # The number of seconds since the start of this process according to Linux, None if it cannot be known
+    boottime = getattr(time, "CLOCK_BOOTTIME", None)
+    if boottime is None:
+        return None
+    try:
+        with open(f"/proc/{os.getpid()}/stat") as file:
+            # The process name (in parentheses) may contain spaces, the start time is the 22nd field
+            start = int(file.read().rsplit(")", 1)[1].split()[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+    return time.clock_gettime(boottime) - start
+
+
+def get_uptime():
+    """Get the number of seconds since the start of this process
+
+    The start time of a process is only known on Linux, elsewhere the time since the import of this module is
+    used, which leaves out the start of the interpreter.
+
+    Returns:
+        float: the number of seconds
+
+    """
+    age = _get_process_age()
+    return time.monotonic() - _imported if age is None else age
+
+
+def record_loaded():
+    """Record that the app has been loaded (brp_startup_seconds{phase="load"})
+
+    Returns:
+        float: the number of seconds since the start of this process
+
+    """
+    uptime = get_uptime()
+    startup_seconds.set(uptime, "load")
+    return uptime
+
+
+def record_response():
+    """Record the time to the first response of this process, called after every response
+
+    Returns:
+        float: the number of seconds since the start of this process for the first response of the process,
+            None for any later response
+
+    """
+    if _responded["pid"] == os.getpid():
+        return None
+    with _lock:
+        if _responded["pid"] == os.getpid():
+            return None
+        _responded["pid"] = os.getpid()
+    uptime = get_uptime()
+    time_to_first_response_seconds.set(uptime)
+    return uptime
+
+
+def _is_uwsgi_master():
+    try:
+        import uwsgi
+    except ImportError:
+        return False
+    # The app is loaded before the workers are forked
+    return uwsgi.worker_id() == 0
+
+
+def _connect(config):
+    start = time.perf_counter()
+    connected = connect_Lv01(config)
+    startup_seconds.set(time.perf_counter() - start, "connect")
+    return connected
+
+
+def warm_up(config, connect=True):
+    """Warm up the process for the first request, see warm_up_Lv01 and connect_Lv01
+
+    In the uWSGI master the connection to BRP is opened by each worker after the fork instead.
+
+    Args:
+        config (dict): the configuration to use for requesting the messages
+        connect (bool): whether to open a connection to BRP
+
+    Returns:
+        bool: True if a connection to BRP has been opened by this process
+
+    """
+    start = time.perf_counter()
+    warm_up_Lv01(config)
+    startup_seconds.set(time.perf_counter() - start, "warmup")
+    if not connect:
+        return False
+
+    if _is_uwsgi_master():
+        from uwsgidecorators import postfork
+
+        postfork(lambda: _connect(config))
+        return False
+    return _connect(config)
@@ -4,29 +4,81 @@ This module contains the logic to send and receive Stuf messages
 
 """
 
-import requests
 import datetime
+import itertools
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from xml.sax.saxutils import escape
 
-from requests import RequestException
+from requests import HTTPError, RequestException, Timeout
 import xml.etree.ElementTree as ET
 
+from .cache import get_cache
 from .config_0204 import ns, soap_action
-from .parse_0204 import parse_message
+from .generate_0204 import La01Generator
+from .metrics import errors, persons_per_address, range_requests, registry, request_seconds, response_bytes
+from .parse_0204 import La01Parser, PackedAddresses, get_address_info
+from .pool import get_pool, get_pool_stats
+from .profiler import add_error, add_stage, bind, record_stage, redact_bag_id, timed_stage
+from .render_0204 import dumps_info
+from .resilience import CircuitOpenError, get_breaker, get_hedge_stats, get_latencies, hedge
+from .scheduler import INTERACTIVE, PRIORITIES, get_scheduler
+from .singleflight import SingleFlight
+from .snapshot import get_snapshot
 
+# The address informations (AddressInfo) for a BAG id, with the source (brp, cache or snapshot) and age in seconds
+# of the information and the birthdates per address that the informations are based on (None in case of errors)
+Lookup = namedtuple("Lookup", ["results", "source", "age", "addresses"])
 
-def _get_Lv01_message(bag_id, zender, ontvanger):
+# The error message when BRP cannot be reached
+_unreachable = "Bericht kan niet worden opgehaald"
+
+# Runs the requests to BRP that should complete within a latency budget
+_fallback_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="brp_fallback")
+
+# The size of the chunks in which the response is received and parsed
+_chunk_size = 16 * 1024
+
+# Concurrent requests for the same BAG id share a single Lv01 request
+flights = SingleFlight()
+
+# The BAG ids that can be requested in a range
+_range_bag_id = re.compile("[0-9]{16}")
+
+# The time (time.monotonic()) at which a range request was rejected, per host
+_range_rejected = {}
+
+
+class RangeRejectedError(Exception):
+    """BRP does not support requests for a range of BAG ids"""
+
+
+def _get_Lv01_message(bag_id, zender, ontvanger, referentienummer="TGOLv01010", tijdstip_bericht=None,
+                      last_bag_id=None, maximum_aantal=15):
     """Get the stuf message Lv01
 
+    The first two ADR entities in the body are the lower and upper bound of the selection, the third is the scope
+    of the answer. The bounds are the same BAG id, unless a range of BAG ids is requested.
+
     Args:
         bag_id (str): the BAG id for which the message should be constructed
         zender (dict): The sender details
         ontvanger (dict): The receiver details
+        referentienummer (str): the reference number of the message
+        tijdstip_bericht (str): the time of the message (YYYYMMDDhhmmss), defaults to now
+        last_bag_id (str): the last BAG id of a range of BAG ids, defaults to bag_id
+        maximum_aantal (int): the maximum number of addresses in the answer
 
     Returns:
         str: the stuf message
 
     """
-    tijdstip_bericht = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+    if tijdstip_bericht is None:
+        tijdstip_bericht = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
     namespaces = " ".join([f"xmlns:{key}='{value}'" for key, value in ns.items()])
     return f"""
     <soapenv:Envelope {namespaces}>
@@ -47,11 +99,11 @@ def _get_Lv01_message(bag_id, zender, ontvanger):
                    <stuf:organisatie>{ontvanger["organisatie"]}</stuf:organisatie>
                    <stuf:applicatie>{ontvanger["applicatie"]}</stuf:applicatie>
                 </stuf:ontvanger>
-                <stuf:referentienummer>TGOLv01010</stuf:referentienummer>
+                <stuf:referentienummer>{referentienummer}</stuf:referentienummer>
                 <stuf:tijdstipBericht>{tijdstip_bericht}</stuf:tijdstipBericht>
                 <stuf:vraag>
                    <stuf:sortering>01</stuf:sortering>
-                   <stuf:maximumAantal>15</stuf:maximumAantal>
+                   <stuf:maximumAantal>{maximum_aantal}</stuf:maximumAantal>
                 </stuf:vraag>
              </stuf:stuurgegevens>
              <ns:body>
@@ -59,7 +111,7 @@ def _get_Lv01_message(bag_id, zender, ontvanger):
                    <identificatieNummerAanduiding>{bag_id}</identificatieNummerAanduiding>
                 </ns:ADR>
                 <ns:ADR soortEntiteit="F">
-                   <identificatieNummerAanduiding>{bag_id}</identificatieNummerAanduiding>
+                   <identificatieNummerAanduiding>{last_bag_id or bag_id}</identificatieNummerAanduiding>
                 </ns:ADR>
                 <ns:ADR soortEntiteit="F">
                    <postcode stuf:noValue="geenWaarde" xsi:nil="true"/>
@@ -83,62 +135,779 @@ def _get_Lv01_message(bag_id, zender, ontvanger):
     """
 
 
-def get_Lv01(bag_ids, config): # noqa C901 get_Lv01 is too complex (8)
-    """Get the Lv01 message
+class Lv01Template:
+    """A precompiled Lv01 message
+
+    The static parts of the message are rendered and encoded once. Building a message only fills in the
+    BAG ids, the maximum number of addresses, the time of the message and a reference number that is unique per
+    message.
+
+    Args:
+        zender (dict): The sender details
+        ontvanger (dict): The receiver details
+
+    """
+
+    _slot = re.compile("\x00(\\w+)\x00")
+
+    def __init__(self, zender, ontvanger):
+        message = _get_Lv01_message(
+            bag_id="\x00bag_id\x00",
+            zender={key: escape(value or "") for key, value in zender.items()},
+            ontvanger={key: escape(value or "") for key, value in ontvanger.items()},
+            referentienummer="\x00referentienummer\x00",
+            tijdstip_bericht="\x00tijdstip_bericht\x00",
+            last_bag_id="\x00last_bag_id\x00",
+            maximum_aantal="\x00maximum_aantal\x00"
+        )
+        # Alternating static parts and slot names, starting and ending with a static part
+        parts = self._slot.split(message)
+        self._parts = [part.encode("utf-8") for part in parts[::2]]
+        self._slots = parts[1::2]
+
+        self._references = self._new_references()
+        self._second = None
+        self._tijdstip_bericht = None
+
+    def _get_tijdstip_bericht(self):
+        second = int(time.time())
+        if second != self._second:
+            self._tijdstip_bericht = time.strftime("%Y%m%d%H%M%S", time.localtime(second)).encode()
+            self._second = second
+        return self._tijdstip_bericht
+
+    @staticmethod
+    def _new_references():
+        # Process ids are reused, by restarts and by other containers (where the app is often process 1),
+        # a random prefix keeps the numbers unique
+        pid = os.getpid()
+        return pid, f"BRB{pid}.{os.urandom(4).hex()}.", itertools.count(1)
+
+    def _get_referentienummer(self):
+        pid, prefix, references = self._references
+        if pid != os.getpid():
+            # Restart the numbering after a fork, replacing all at once for the other threads
+            self._references = pid, prefix, references = self._new_references()
+        return f"{prefix}{next(references)}".encode()
+
+    def build(self, bag_id, last_bag_id=None, maximum_aantal=15):
+        """Build a Lv01 message
+
+        Args:
+            bag_id (str): the BAG id for which the message should be constructed
+            last_bag_id (str): the last BAG id of a range of BAG ids, defaults to bag_id
+            maximum_aantal (int): the maximum number of addresses in the answer
+
+        Returns:
+            bytes: the encoded stuf message
+
+        """
+        values = {
+            "bag_id": escape(bag_id).encode("utf-8"),
+            "last_bag_id": escape(last_bag_id or bag_id).encode("utf-8"),
+            "maximum_aantal": str(int(maximum_aantal)).encode(),
+            "referentienummer": self._get_referentienummer(),
+            "tijdstip_bericht": self._get_tijdstip_bericht(),
+        }
+        message = [self._parts[0]]
+        for slot, part in zip(self._slots, self._parts[1:]):
+            message.append(values[slot])
+            message.append(part)
+        return b"".join(message)
+
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def get_Lv01_template(config):
+    """Get the precompiled Lv01 message for the given configuration
+
+    Args:
+        config (dict): the configuration to use for requesting messages
+
+    Returns:
+        Lv01Template: the precompiled message
+
+    """
+    key = (tuple(config["zender"].items()), tuple(config["ontvanger"].items()))
+    with _templates_lock:
+        if key not in _templates:
+            _templates[key] = Lv01Template(zender=config["zender"], ontvanger=config["ontvanger"])
+        return _templates[key]
+
+
+def _post(data, config, pool, deadline):
+    """Send a Lv01 message
+
+    Args:
+        data (bytes): the message
+        config (dict): the configuration to use for requesting the message
+        pool (SessionPool): the session pool to send the request over
+        deadline (float): the time (time.monotonic()) at which the response should have been received
+
+    Returns:
+        requests.Response: the streamed response, should be closed
+
+    Raises:
+        RequestException: if the response headers cannot be retrieved before the deadline
+
+    """
+    headers = {
+        "Content-Type": "text/xml;charset=UTF-8",
+        "SOAPAction": soap_action,
+        "Content-Length": str(len(data)),
+    }
+
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise Timeout("Deadline exceeded")
+
+    timeout = config.get("timeout", {})
+    start = time.perf_counter()
+    response = pool.post(
+        url=config["host"] + config["path"],
+        data=data,
+        headers=headers,
+        stream=True,
+        timeout=(timeout.get("connect"), min(timeout.get("read", remaining), remaining))
+    )
+    # Until the response headers have been received, including setting up any new connection
+    record_stage("server", time.perf_counter() - start, status=response.status_code, request_bytes=len(data))
+    return response
+
+
+def _post_Lv01(bag_id, config, pool, deadline):
+    """Send a single Lv01 request and parse the birthdates per address while the response is received
+
+    Args:
+        bag_id (str): the BAG id
+        config (dict): the configuration to use for requesting the message
+        pool (SessionPool): the session pool to send the request over
+        deadline (float): the time (time.monotonic()) at which the response should have been received
+
+    Returns:
+        list(list(int)): the birthdates of the living persons per address, see parse_birthdates
+
+    Raises:
+        RequestException: if the message cannot be retrieved before the deadline, or BRP answers with an HTTP
+            error or a SOAP fault
+        ET.ParseError: if the message cannot be parsed
+
+    """
+    with timed_stage("message"):
+        data = get_Lv01_template(config).build(bag_id)
+
+    response = _post(data, config, pool, deadline)
+    try:
+        _check_status(response.status_code)
+        parser = La01Parser()
+        addresses = _receive_addresses(response.iter_content(chunk_size=_chunk_size), deadline, parser)
+    finally:
+        response.close()
+    _check_fault(parser)
+    return addresses
+
+
+def _check_status(status_code):
+    """Check the HTTP status of an answer of BRP
+
+    Args:
+        status_code (int): the HTTP status
+
+    Returns:
+        None
+
+    Raises:
+        HTTPError: if the status is not a success, the answer is then not a La01 message
+
+    """
+    if not 200 <= status_code < 300:
+        raise HTTPError(f"BRP answered with status {status_code}")
+
+
+def _check_fault(parser):
+    """Check whether BRP answered with a SOAP fault instead of a La01 message
+
+    A fault has no addresses, it should not be mistaken for an answer in which no address was found
+
+    Args:
+        parser (La01Parser): the parser of the answer
+
+    Returns:
+        None
+
+    Raises:
+        RequestException: if the answer is a SOAP fault
+
+    """
+    if parser.fault:
+        raise RequestException("BRP answered with a SOAP fault")
+
+
+def _post_Lv01_range(bag_ids, config, pool, deadline):
+    """Send a single Lv01 request for a range of BAG ids and split the answer per BAG id
+
+    Args:
+        bag_ids (list(str)): the sorted BAG ids, the first and last are the bounds of the range
+        config (dict): the configuration to use for requesting the message
+        pool (SessionPool): the session pool to send the request over
+        deadline (float): the time (time.monotonic()) at which the response should have been received
+
+    Returns:
+        dict: the birthdates per address (PackedAddresses) per BAG id, empty if the answer has the maximum
+            number of addresses and may therefore be incomplete, None if an address in the answer has no BAG id
+            or one outside the range
+
+    Raises:
+        RangeRejectedError: if BRP does not answer the request with a La01 message
+        RequestException: if the message cannot be retrieved before the deadline
+        ET.ParseError: if the message cannot be parsed
+
+    """
+    maximum = config["range"]["maximum"]
+    with timed_stage("message"):
+        data = get_Lv01_template(config).build(bag_ids[0], bag_ids[-1], maximum)
+
+    response = _post(data, config, pool, deadline)
+    try:
+        if response.status_code >= 400:
+            raise RangeRejectedError(f"Range request rejected with status {response.status_code}")
+        parser = La01Parser()
+        _receive_addresses(response.iter_content(chunk_size=_chunk_size), deadline, parser)
+    finally:
+        response.close()
+
+    if parser.fault:
+        raise RangeRejectedError("Range request rejected with a fault")
+    if len(parser.addresses) >= maximum:
+        return {}
+    if not all(bag_id is not None and _range_bag_id.fullmatch(bag_id) and bag_ids[0] <= bag_id <= bag_ids[-1]
+               for bag_id in parser.bag_ids):
+        # The addresses cannot all be attributed, the BAG ids without addresses may not be missing
+        return None
+    addresses = parser.get_addresses_by_bag_id()
+    # BAG ids without addresses are not found, like the answer to a request for a single BAG id
+    return {bag_id: addresses.get(bag_id, PackedAddresses()) for bag_id in bag_ids}
+
+
+def _receive_addresses(chunks, deadline, parser=None):
+    """Parse the birthdates per address while the La01 message is being received
+
+    Args:
+        chunks (iterable(bytes)): the chunks of the message
+        deadline (float): the time (time.monotonic()) at which the message should have been received
+        parser (La01Parser): the parser to use, to inspect it afterwards
+
+    Returns:
+        list(list(int)): the birthdates of the living persons per address, see parse_birthdates
+
+    Raises:
+        Timeout: if the message has not been received before the deadline
+        ET.ParseError: if the message cannot be parsed
+
+    """
+    parser = parser or La01Parser()
+    size = 0
+    parsing = 0
+    start = time.perf_counter()
+    for chunk in chunks:
+        if time.monotonic() > deadline:
+            raise Timeout("Deadline exceeded")
+        parsed = time.perf_counter()
+        parser.feed(chunk)
+        parsing += time.perf_counter() - parsed
+        size += len(chunk)
+    parsed = time.perf_counter()
+    addresses = parser.close()
+    end = time.perf_counter()
+    parsing += end - parsed
+
+    record_stage("receive", end - start - parsing, bytes=size)
+    record_stage("parse", parsing, addresses=len(addresses))
+    response_bytes.observe(size)
+    return addresses
+
+
+def _get_flight_key(bag_id, config):
+    # Only requests with the same priority are coalesced, an interactive lookup never waits for a background one
+    return bag_id, config.get("priority", INTERACTIVE)
+
+
+def _acquire(scheduler, config):
+    """Wait for the scheduler, with the priority config["priority"] (interactive by default)
+
+    An interactive request takes at most config["timeout"]["deadline"] seconds, including the wait. A
+    background request waits as long as needed, and then gets the full deadline.
+
+    Args:
+        scheduler (Scheduler): the scheduler
+        config (dict): the configuration to use for requesting the message
+
+    Returns:
+        float: the time (time.monotonic()) at which the response should have been received
+
+    Raises:
+        RateLimitedError: if an interactive request cannot be sent before its deadline
+
+    """
+    seconds = config.get("timeout", {}).get("deadline", 30)
+    priority = config.get("priority", INTERACTIVE)
+    if priority == INTERACTIVE:
+        deadline = time.monotonic() + seconds
+        scheduler.acquire(priority, seconds)
+        return deadline
+    scheduler.acquire(priority)
+    return time.monotonic() + seconds
+
+
+def _send(post, config):
+    """Send a request to BRP through the circuit breaker and the scheduler
+
+    The request first waits for the scheduler (see _acquire), and is then rejected when the circuit breaker is
+    open. That way a trial request of a half open breaker is sent right away, and its outcome is always recorded.
+
+    Args:
+        post (callable): sends the request, gets the deadline (time.monotonic()) for the response
+        config (dict): the configuration to use for requesting the message
+
+    Returns:
+        tuple: the result of post and the latency of the request in seconds, without the wait
+
+    Raises:
+        RequestException: if the request cannot be sent or fails
+        any other exception that is raised by post
+
+    """
+    scheduler = get_scheduler(config)
+    deadline = _acquire(scheduler, config)
+
+    breaker = get_breaker(config)
+    if not breaker.allow():
+        raise CircuitOpenError("Circuit breaker is open")
+
+    start = time.monotonic()
+    try:
+        result = post(deadline)
+    except RequestException:
+        breaker.record(False, time.monotonic() - start)
+        scheduler.record(False, time.monotonic() - start)
+        raise
+    except BaseException:
+        # Any other failure, like a message that cannot be parsed, still ends a trial request of the breaker
+        breaker.record(False, time.monotonic() - start)
+        raise
+
+    latency = time.monotonic() - start
+    breaker.record(True, latency)
+    scheduler.record(True, latency)
+    return result, latency
+
+
+def _request_addresses(bag_id, config, pool):
+    """Request the Lv01 message for a single BAG id and parse the birthdates per address
+
+    The request is sent through the circuit breaker and the scheduler (see _send), and it is hedged when it
+    takes longer than the configured percentile of the recent latencies and the scheduler has a token for the
+    hedged request right away.
+
+    Args:
+        bag_id (str): the BAG id
+        config (dict): the configuration to use for requesting the message
+        pool (SessionPool): the session pool to send the request over
+
+    Returns:
+        list(list(int)): the birthdates of the living persons per address, see parse_birthdates
+
+    Raises:
+        RequestException: if the message cannot be retrieved
+        ET.ParseError: if the message cannot be parsed
+
+    """
+    latencies = get_latencies(config)
+    hedge_config = config.get("hedge", {})
+    delay = latencies.percentile(hedge_config.get("percentile", 95), hedge_config.get("min_samples", 20)) \
+        if hedge_config.get("percentile") else None
+
+    scheduler = get_scheduler(config)
+    priority = config.get("priority", INTERACTIVE)
+    addresses, latency = _send(
+        lambda deadline: hedge(bind(lambda: _post_Lv01(bag_id, config, pool, deadline)), delay,
+                               lambda: scheduler.try_acquire(priority)), config)
+    latencies.add(latency)
+    request_seconds.observe(latency)
+    return addresses
+
+
+def _get_ranges(bag_ids, size):
+    """Group BAG ids into ranges that can be requested in a single Lv01 message
 
     Args:
         bag_ids (list(str)): any list of BAG ids
-        config (dict): the configuratin to use for requesting the message
+        size (int): the maximum difference between the first and last BAG id in a range, plus one
 
     Returns:
-        list(dict): a list of address informations for the BAG ids
+        list(list(str)): the sorted BAG ids per range, only ranges with multiple BAG ids
+
+    """
+    ranges = [[]]
+    for bag_id in sorted({bag_id for bag_id in bag_ids if _range_bag_id.fullmatch(bag_id)}):
+        if ranges[-1] and int(bag_id) - int(ranges[-1][0]) >= size:
+            ranges.append([])
+        ranges[-1].append(bag_id)
+    return [bag_ids for bag_ids in ranges if len(bag_ids) > 1]
+
+
+def _request_range(bag_ids, config, pool):
+    """Request the Lv01 message for a range of BAG ids and split the birthdates per address per BAG id
+
+    Any failure, or an answer that cannot be split per BAG id, is not raised but results in an empty result,
+    the BAG ids are then requested one by one.
+
+    Args:
+        bag_ids (list(str)): the sorted BAG ids, see _get_ranges
+        config (dict): the configuration to use for requesting the message
+        pool (SessionPool): the session pool to send the request over
+
+    Returns:
+        dict: the birthdates per address (PackedAddresses) per BAG id
+
+    """
+    try:
+        addresses, _ = _send(lambda deadline: _post_Lv01_range(bag_ids, config, pool, deadline), config)
+    except RangeRejectedError:
+        _range_rejected[config["host"]] = time.monotonic()
+        range_requests.inc("rejected")
+        return {}
+    except (ET.ParseError, RequestException):
+        range_requests.inc("failed")
+        return {}
+
+    if addresses is None:
+        range_requests.inc("unattributed")
+        return {}
+    range_requests.inc("ok" if addresses else "truncated")
+    return addresses
+
+
+def _request_ranges(bag_ids, config, pool):
+    """Request the uncached BAG ids that are close to each other in ranges, if enabled in config["range"]
+
+    Args:
+        bag_ids (list(str)): any list of BAG ids
+        config (dict): the configuration to use for requesting the messages
+        pool (SessionPool): the session pool to send the requests over
+
+    Returns:
+        dict: the birthdates per address (PackedAddresses) per BAG id, for the BAG ids that could be requested
+            in a range
+
+    """
+    range_config = config.get("range", {})
+    rejected = _range_rejected.get(config["host"])
+    if range_config.get("size", 0) < 2 or \
+            (rejected is not None and time.monotonic() - rejected < range_config.get("retry", 3600)):
+        return {}
+
+    cache = get_cache(config)
+    ranges = _get_ranges([bag_id for bag_id in bag_ids if cache.get(bag_id) is None], range_config["size"])
+    addresses = {}
+    for result in _map(lambda range_bag_ids: _request_range(range_bag_ids, config, pool), ranges, config):
+        addresses.update(result)
+    return addresses
+
+
+def _get_lookup(bag_id, addresses, source, age=None):
+    """Get the lookup for the birthdates per address of a BAG id
+
+    Args:
+        bag_id (str): the BAG id
+        addresses (PackedAddresses|list(list(int))): the birthdates of the living persons per address
+        source (str): the source of the birthdates
+        age (float): the age of the birthdates in seconds, if not retrieved just now
+
+    Returns:
+        Lookup: the address informations for the BAG id
+
+    """
+    if not addresses:
+        errors.inc("not_found", "")
+        add_stage("not_found", 0, bag_id=redact_bag_id(bag_id), source=source)
+        return Lookup([get_address_info(bag_id, error_message="Geen adres gevonden")], source, age, addresses)
+
+    persons = [len(birthdates) for birthdates in addresses if birthdates is not None]
+    with timed_stage("indicatoren", bag_id=redact_bag_id(bag_id), source=source, addresses=len(addresses),
+                     persons=sum(persons)):
+        results = [get_address_info(bag_id, birthdates) for birthdates in addresses]
+    for count in persons:
+        persons_per_address.observe(count)
+    return Lookup(results, source, age, addresses)
+
+
+def _get_error_lookup(bag_id, err):
+    """Get the lookup for a BAG id for which the information could not be retrieved from BRP
+
+    Args:
+        bag_id (str): the BAG id
+        err (ET.ParseError|RequestException): the error
+
+    Returns:
+        Lookup: the error information for the BAG id
+
+    """
+    add_error(err)
+    if isinstance(err, ET.ParseError):
+        errors.inc("ParseError", type(err).__name__)
+        return Lookup([get_address_info(bag_id, error_message="Bericht kan niet worden vertaald")], "brp", None, None)
+    errors.inc("RequestException", type(err).__name__)
+    return Lookup([get_address_info(bag_id, error_message=_unreachable)], "brp", None, None)
+
+
+def _lookup_address_info(bag_id, config, pool, addresses=None):
+    """Lookup the address informations for a single BAG id, from the cache or from BRP
+
+    Args:
+        bag_id (str): the BAG id
+        config (dict): the configuration to use for requesting the message
+        pool (SessionPool): the session pool to send the request over
+        addresses (PackedAddresses): the birthdates per address if they have just been requested in a range
+
+    Returns:
+        Lookup: the address informations for the BAG id
 
     """
-    session = requests.Session()
+    if addresses is not None:
+        get_cache(config).set(bag_id, addresses)
+        return _get_lookup(bag_id, addresses, "brp")
+
+    def fetch():
+        return flights.do(_get_flight_key(bag_id, config), lambda: _request_addresses(bag_id, config, pool))
 
-    session.cert = config["cert"]
-    session.verify = config["verify"]
+    try:
+        addresses, age = get_cache(config).lookup(bag_id, fetch)
+    except (ET.ParseError, RequestException) as err:
+        return _get_error_lookup(bag_id, err)
 
-    url = config["host"] + config["path"]
+    return _get_lookup(bag_id, addresses, "brp" if age is None else "cache", age)
+
+
+def _lookup_snapshot(bag_id, snapshot):
+    """Lookup the address informations for a single BAG id in the snapshot
+
+    Args:
+        bag_id (str): the BAG id
+        snapshot (Snapshot): the snapshot
+
+    Returns:
+        Lookup: the address informations for the BAG id, None if the BAG id is not in the snapshot
+
+    """
+    entry = snapshot.get(bag_id)
+    if entry is None:
+        return None
+    addresses, stored = entry
+    return _get_lookup(bag_id, addresses, "snapshot", max(0, time.time() - stored))
+
+
+def lookup_Lv01(bag_ids, config):
+    """Lookup the address informations for the given BAG ids
+
+    Multiple BAG ids are looked up concurrently, at most config["concurrency"] requests at a time.
+    BAG ids that are close to each other, like the units in a building, are requested in a single message for
+    a range of BAG ids when config["range"]["size"] is set. Any BAG ids that cannot be requested that way,
+    for example because BRP rejects it, are requested one by one.
+    The lookups are returned in the order of the given BAG ids.
+
+    Args:
+        bag_ids (list(str)): any list of BAG ids
+        config (dict): the configuration to use for requesting the messages
+
+    Returns:
+        list(Lookup): a lookup per BAG id
+
+    """
+    pool = get_pool(config)
 
     if isinstance(bag_ids, str):
         # Accept string arguments, automatically convert to list
         bag_ids = [bag_ids]
 
-    results = []
-    for bag_id in bag_ids:
-        data = _get_Lv01_message(
-            bag_id=bag_id,
-            zender=config["zender"],
-            ontvanger=config["ontvanger"]
-        )
+    ranged = _request_ranges(bag_ids, config, pool)
+    return _map(lambda bag_id: _lookup_address_info(bag_id, config, pool, ranged.get(bag_id)), bag_ids, config)
 
-        headers = {
-            "Content-Type": "text/xml;charset=UTF-8",
-            "SOAPAction": soap_action,
-            "Content-Length": str(len(data)),
-        }
 
-        error_message = None
+def _map(fn, bag_ids, config):
+    # Call fn for every BAG id, at most config["concurrency"] at a time, and return the results in order
+    concurrency = min(config.get("concurrency", 1), len(bag_ids))
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return list(executor.map(bind(fn), bag_ids))
+    return [fn(bag_id) for bag_id in bag_ids]
+
+
+def refresh_Lv01(bag_ids, config):
+    """Request the address informations for the given BAG ids from BRP and update the cache
+
+    Unlike lookup_Lv01 any cached information is not used but replaced, for BAG ids that are known to have
+    changed in BRP. Multiple BAG ids are requested concurrently, at most config["concurrency"] at a time.
+
+    Args:
+        bag_ids (list(str)): any list of BAG ids
+        config (dict): the configuration to use for requesting the messages
+
+    Returns:
+        list(Lookup): a lookup per BAG id, in the order of the given BAG ids
+
+    """
+    pool = get_pool(config)
+    cache = get_cache(config)
+
+    def refresh(bag_id):
         try:
-            request = session.post(
-                url=url,
-                data=data,
-                headers=headers
-            )
-
-            xml = ET.fromstring(request.content)
-            addresses = xml.findall(".//ns:ADR", ns)
-            if not addresses:
-                error_message = f"Geen adres gevonden"
-        except ET.ParseError as err:
-            error_message = f"Bericht kan niet worden vertaald"
-        except RequestException as err:
-            error_message = f"Bericht kan niet worden opgehaald"
-
-        if error_message:
-            results.append(parse_message(bag_id, None, error_message=error_message))
-        else:
-            results.extend([parse_message(bag_id, adres) for adres in addresses])
-
-    return results
+            addresses = flights.do(_get_flight_key(bag_id, config), lambda: _request_addresses(bag_id, config, pool))
+        except (ET.ParseError, RequestException) as err:
+            return _get_error_lookup(bag_id, err)
+        cache.set(bag_id, addresses)
+        return _get_lookup(bag_id, addresses, "brp")
+
+    return _map(refresh, bag_ids, config)
+
+
+def lookup_Lv01_with_fallback(bag_id, config):
+    """Lookup the address informations for a single BAG id, with a fallback on the snapshot
+
+    The snapshot is used when BRP cannot be reached, or when it does not respond within
+    config["snapshot"]["latency_budget"] seconds. In the latter case the request to BRP is completed in the
+    background, so that its result is cached.
+
+    Args:
+        bag_id (str): the BAG id
+        config (dict): the configuration to use for requesting the message
+
+    Returns:
+        Lookup: the address informations for the BAG id
+
+    """
+    snapshot = get_snapshot(config)
+    if snapshot is None:
+        return lookup_Lv01(bag_id, config)[0]
+
+    future = _fallback_executor.submit(bind(_lookup_address_info), bag_id, config, get_pool(config))
+    try:
+        lookup = future.result(timeout=config["snapshot"].get("latency_budget") or None)
+        if lookup.results[0].error != _unreachable:
+            return lookup
+    except TimeoutError:
+        pass
+
+    return _lookup_snapshot(bag_id, snapshot) or future.result()
+
+
+def get_Lv01(bag_ids, config):
+    """Get the Lv01 message
+
+    Multiple BAG ids are requested concurrently, at most config["concurrency"] requests at a time.
+    The results are returned in the order of the given BAG ids.
+
+    Args:
+        bag_ids (list(str)): any list of BAG ids
+        config (dict): the configuratin to use for requesting the message
+
+    Returns:
+        list(dict): a list of address informations for the BAG ids
+
+    """
+    return [info.as_dict() for lookup in lookup_Lv01(bag_ids, config) for info in lookup.results]
+
+
+def purge_Lv01(bag_id, config):
+    """Remove any cached information for the given BAG id
+
+    Args:
+        bag_id (str): the BAG id
+        config (dict): the configuration to use for requesting the messages
+
+    Returns:
+        bool: True if there was any cached information
+
+    """
+    return get_cache(config).purge(bag_id)
+
+
+def warm_up_Lv01(config):
+    """Prepare everything for the first lookup that does not need BRP
+
+    Precompiles the Lv01 message, creates the process-wide cache, pool, breaker and scheduler, and handles a
+    synthetic La01 message, so that the parser is loaded and the most common indicatoren are rendered.
+    No request is sent and no metrics are recorded.
+
+    Args:
+        config (dict): the configuration to use for requesting the messages
+
+    Returns:
+        None
+
+    """
+    generator = La01Generator(addresses=3, residents=(0, 4))
+    get_Lv01_template(config).build(generator.bag_id)
+    get_cache(config)
+    get_pool(config)
+    get_breaker(config)
+    get_scheduler(config)
+
+    parser = La01Parser()
+    parser.feed(generator.message())
+    for birthdates in parser.close():
+        dumps_info(get_address_info(generator.bag_id, birthdates))
+
+
+def connect_Lv01(config):
+    """Open a connection to BRP ahead of the first lookup, see SessionPool.connect
+
+    Args:
+        config (dict): the configuration to use for requesting the messages
+
+    Returns:
+        bool: True if the connection has been opened
+
+    """
+    return get_pool(config).connect(config["host"] + config["path"], timeout=config.get("timeout", {}).get("connect"))
+
+
+def get_Lv01_metrics(config):
+    """Get the metrics of the requests to BRP, including the statistics of the pool, cache, breaker and scheduler
+
+    Args:
+        config (dict): the configuration to use for requesting the messages
+
+    Returns:
+        str: the metrics in the Prometheus text format
+
+    """
+    cache_stats = get_cache(config).stats()
+    cache_events = ["hits", "misses", "stale_hits", "refreshes", "stale_if_error", "evictions"]
+    breaker_stats = get_breaker(config).stats()
+    breaker_states = ["closed", "open", "half_open"]
+    flight_stats = flights.stats()
+    scheduler_stats = get_scheduler(config).stats()
+    return registry.render([
+        ("brp_pool_events_total", "counter", "Connection pool events",
+         [({"event": name}, value) for name, value in sorted(get_pool_stats().items())]),
+        ("brp_cache_events_total", "counter", "Cache events",
+         [({"event": name}, cache_stats[name]) for name in cache_events if name in cache_stats]),
+        ("brp_cache_size", "gauge", "Size of the cache in entries and estimated bytes",
+         [({"measure": name}, cache_stats[name]) for name in ["entries", "memory"] if name in cache_stats]),
+        ("brp_breaker_events_total", "counter", "Circuit breaker trips and rejected requests",
+         [({"event": name}, breaker_stats[name]) for name in ["trips", "rejected"]]),
+        ("brp_breaker_state", "gauge", "Circuit breaker state",
+         [({"state": name}, int(breaker_stats["state"] == name)) for name in breaker_states]),
+        ("brp_hedged_total", "counter", "Hedged requests", [({}, get_hedge_stats()["hedged"])]),
+        ("brp_singleflight_total", "counter", "Lookups that made a request (calls) or shared one (coalesced)",
+         [({"result": name}, flight_stats[name]) for name in ["calls", "coalesced"]]),
+        ("brp_scheduler_queue_depth", "gauge", "Requests waiting for the scheduler per priority class",
+         [({"priority": name}, scheduler_stats["waiting"][name]) for name in PRIORITIES]),
+        ("brp_scheduler_rate", "gauge", "Current adaptive limit of BRP requests per second",
+         [({}, scheduler_stats["rate"])]),
+        ("brp_scheduler_events_total", "counter", "Scheduler rate decreases and rejected requests",
+         [({"event": name}, scheduler_stats[name]) for name in ["decreases", "rejected"]]),
+    ])
@@ -1,13 +1,38 @@
 import datetime
+import itertools
+import json
+import random
+import re
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+from array import array
+from http.client import RemoteDisconnected
 
 import pytest
 
+from dateutil.relativedelta import relativedelta
+
+from requests import ConnectionError, ConnectTimeout, ReadTimeout, RequestException
 from requests.sessions import Session
+from urllib3.exceptions import ProtocolError
 
 from app import app as main_app
 from config import config, check_env_vars, required_env_vars
-from stuf.parse_0204 import _get_age, _get_age_category, _get_indicatoren
-from stuf.stuf_0204 import get_Lv01
+from stuf import render_0204
+from stuf.parse_0204 import AddressInfo, La01Parser, PackedAddresses, _get_age, _get_age_category, _get_ages, \
+    _get_indicatoren, get_address_info, get_indicatoren, get_indicatoren_batch, get_info, get_next_change
+from stuf.cache import get_cache
+from stuf.metrics import scheduler_wait_seconds, stage_seconds
+from stuf import pool as pool_module
+from stuf.pool import SessionPool, get_pool, get_pool_stats
+from stuf.profiler import get_profiler
+from stuf.resilience import get_breaker, get_latencies
+from stuf.scheduler import BACKGROUND, get_scheduler
+from stuf.snapshot import SnapshotWriter
+from stuf import stuf_0204
+from stuf.stuf_0204 import Lookup, Lv01Template, _get_Lv01_message, _get_ranges, get_Lv01
 
 
 @pytest.fixture
@@ -15,6 +40,14 @@ def app():
     return main_app
 
 
+@pytest.fixture(autouse=True)
+def clear_cache():
+    get_cache(config).clear()
+    get_breaker(config).reset()
+    get_latencies(config).reset()
+    get_scheduler(config).reset()
+
+
 def test_age():
     birthdate = datetime.date.today()
     assert _get_age(birthdate) == 0
@@ -100,11 +133,169 @@ def test_indicatoren():
 # The following tests need mocked http responses
 response_ok = b'<?xml version=\'1.0\' encoding=\'UTF-8\'?><soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"><soapenv:Body><BG:synchroonAntwoordBericht xmlns:BG="http://www.egem.nl/StUF/sector/bg/0204" xmlns:StUF="http://www.egem.nl/StUF/StUF0204" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"><StUF:stuurgegevens xmlns="http://www.egem.nl/StUF/StUF0204"><StUF:berichtsoort>La01</StUF:berichtsoort><StUF:entiteittype>ADR</StUF:entiteittype><StUF:sectormodel>BG</StUF:sectormodel><StUF:versieStUF>0204</StUF:versieStUF><StUF:versieSectormodel>0204</StUF:versieSectormodel><StUF:zender><StUF:organisatie>Amsterdam</StUF:organisatie><StUF:applicatie>CGM</StUF:applicatie></StUF:zender><StUF:ontvanger><StUF:applicatie>Meldkamer1</StUF:applicatie><StUF:gebruiker>meld-sys-user</StUF:gebruiker></StUF:ontvanger><StUF:referentienummer>MK0000008709</StUF:referentienummer><StUF:tijdstipBericht>2018013013011501</StUF:tijdstipBericht><StUF:antwoord><StUF:crossRefNummer>TGOLv01010</StUF:crossRefNummer></StUF:antwoord></StUF:stuurgegevens><BG:body xmlns="http://www.egem.nl/StUF/sector/bg/0204"><BG:ADR soortEntiteit="F" StUF:sleutelVerzendend="9072717152486" StUF:sleutelGegevensbeheer="9072717152486"><BG:postcode>1074ET</BG:postcode><BG:woonplaatsnaam xsi:nil="true" StUF:noValue="waardeOnbekend"/><BG:straatnaam>Rustenburgerstraat</BG:straatnaam><BG:huisnummer>14</BG:huisnummer><BG:huisletter>C</BG:huisletter><BG:huisnummertoevoeging xsi:nil="true" StUF:noValue="geenWaarde"/><BG:tijdvakGeldigheid><StUF:begindatumTijdvakGeldigheid xsi:nil="true" StUF:noValue="nietGeautoriseerd"/><StUF:einddatumTijdvakGeldigheid xsi:nil="true" StUF:noValue="nietGeautoriseerd"/></BG:tijdvakGeldigheid><BG:extraElementen><StUF:extraElement naam="identificatieAOA">0363200000399540</StUF:extraElement><StUF:extraElement naam="identificatieNummerAanduiding">0363200000399540</StUF:extraElement></BG:extraElementen><BG:ADRPRSVBL soortEntiteit="R" StUF:sleutelVerzendend="9072717290844" StUF:sleutelGegevensbeheer="9072717290844"><BG:tijdvakRelatie><StUF:begindatumRelatie>20010501</StUF:begindatumRelatie><StUF:einddatumRelatie xsi:nil="true" StUF:noValue="geenWaarde"/></BG:tijdvakRelatie><BG:PRS soortEntiteit="F" StUF:sleutelVerzendend="9072717290834" StUF:sleutelGegevensbeheer="9072717290834"><BG:geboortedatum>19620412</BG:geboortedatum><BG:datumOverlijden xsi:nil="true" StUF:noValue="geenWaarde"/><BG:tijdvakGeldigheid><StUF:begindatumTijdvakGeldigheid xsi:nil="true" StUF:noValue="nietGeautoriseerd"/><StUF:einddatumTijdvakGeldigheid xsi:nil="true" StUF:noValue="nietGeautoriseerd"/></BG:tijdvakGeldigheid></BG:PRS></BG:ADRPRSVBL></BG:ADR></BG:body></BG:synchroonAntwoordBericht></soapenv:Body></soapenv:Envelope>'  # noqa E501 line too long (2735 > 119 characters)
 response_error = b'<?xml version=\'1.0\' encoding=\'UTF-8\'?><soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"><soapenv:Body><BG:synchroonAntwoordBericht xmlns:BG="http://www.egem.nl/StUF/sector/bg/0204" xmlns:StUF="http://www.egem.nl/StUF/StUF0204" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"><StUF:stuurgegevens xmlns="http://www.egem.nl/StUF/StUF0204"><StUF:berichtsoort>La01</StUF:berichtsoort><StUF:entiteittype>ADR</StUF:entiteittype><StUF:sectormodel>BG</StUF:sectormodel><StUF:versieStUF>0204</StUF:versieStUF><StUF:versieSectormodel>0204</StUF:versieSectormodel><StUF:zender><StUF:organisatie>Amsterdam</StUF:organisatie><StUF:applicatie>CGM</StUF:applicatie></StUF:zender><StUF:ontvanger><StUF:applicatie>Meldkamer1</StUF:applicatie><StUF:gebruiker>meld-sys-user</StUF:gebruiker></StUF:ontvanger><StUF:referentienummer>MK0000008711</StUF:referentienummer><StUF:tijdstipBericht>2018013013165699</StUF:tijdstipBericht><StUF:antwoord><StUF:crossRefNummer>TGOLv01010</StUF:crossRefNummer></StUF:antwoord></StUF:stuurgegevens><BG:body xmlns="http://www.egem.nl/StUF/sector/bg/0204"/></BG:synchroonAntwoordBericht></soapenv:Body></soapenv:Envelope>'  # noqa E501 line too long (1189 > 119 characters)
+response_fault = b"<soapenv:Envelope xmlns:soapenv='http://schemas.xmlsoap.org/soap/envelope/'><soapenv:Body>" \
+    b"<soapenv:Fault><faultcode>soapenv:Server</faultcode></soapenv:Fault></soapenv:Body></soapenv:Envelope>"
+
+
+def test_ages():
+    birthdates = [datetime.date(1996, 1, 1) + datetime.timedelta(days=days) for days in range(0, 1500, 5)]
+    birthdates.append(datetime.date(1996, 2, 29))
+    compact = [birthdate.year * 10000 + birthdate.month * 100 + birthdate.day for birthdate in birthdates]
+    for days in range(0, 3000, 11):
+        reference_date = datetime.date(2002, 1, 1) + datetime.timedelta(days=days)
+        assert list(_get_ages(compact, reference_date)) == [
+            relativedelta(reference_date, birthdate).years for birthdate in birthdates
+        ]
+    assert list(_get_ages([19960229], datetime.date(2002, 2, 28))) == [6]
+    assert list(_get_ages([19960229], datetime.date(2002, 2, 27))) == [5]
+
+
+def test_next_change():
+    reference_date = datetime.date(2020, 6, 1)
+    assert get_next_change([], reference_date) is None
+    assert get_next_change([20100301], reference_date) == 20230301
+    assert get_next_change([20100301, 19500602], reference_date) == 20200602
+    assert get_next_change([20070601], reference_date) == 20770601
+    assert get_next_change([20080229], reference_date) == 20210228
+    assert get_next_change([19510101], reference_date) == 20210101
+
+    # The indicatoren change on the returned date, and not before
+    for birthdate in [20100301, 19500602, 20080229]:
+        change = get_next_change([birthdate], reference_date)
+        day = datetime.date(change // 10000, change // 100 % 100, change % 100)
+        assert _get_indicatoren(_get_ages([birthdate], day)) != \
+            _get_indicatoren(_get_ages([birthdate], day - datetime.timedelta(days=1)))
+        assert _get_indicatoren(_get_ages([birthdate], reference_date)) == \
+            _get_indicatoren(_get_ages([birthdate], day - datetime.timedelta(days=1)))
+
+
+def test_rendered_indicatoren():
+    reference_date = datetime.date(2020, 6, 1)
+    birthdates = [20070602, 19900101]
+    indicatoren = get_indicatoren(birthdates, reference_date)
+    assert indicatoren == _get_indicatoren(_get_ages(birthdates, reference_date))
+    assert get_indicatoren(list(birthdates), reference_date) is indicatoren
+
+    # Rendered again once a person has moved to another age category
+    next_day = reference_date + datetime.timedelta(days=1)
+    assert get_indicatoren(birthdates, next_day) is not indicatoren
+    assert get_indicatoren(birthdates, next_day) == _get_indicatoren(_get_ages(birthdates, next_day))
+    assert get_indicatoren(birthdates, reference_date) == indicatoren
+
+
+def test_indicatoren_batch():
+    reference_date = datetime.date(2018, 1, 30)
+    generator = random.Random(0)
+    addresses = [[], [20100101], [19400101, 20000101]] + [
+        [generator.randint(1900, 2017) * 10000 + 101 for _ in range(generator.randint(0, 25))] for _ in range(100)
+    ]
+    birthdates = array("l", [birthdate for address in addresses for birthdate in address])
+    offsets = array("l", itertools.accumulate([0] + [len(address) for address in addresses]))
+
+    assert get_indicatoren_batch(birthdates, offsets, reference_date) == [
+        _get_indicatoren(_get_ages(address, reference_date)) for address in addresses
+    ]
+
+    # A birthdate in the future or more than 125 years ago is counted in the nearest age category
+    assert get_indicatoren_batch(array("l", [20200101, 18800101]), array("l", [0, 1, 2]), reference_date) == [
+        _get_indicatoren([0]), _get_indicatoren([70])
+    ]
+    assert _get_indicatoren([-1, 130]) == _get_indicatoren([0, 125])
+
+
+def _get_La01(*addresses):
+    prs = '<BG:ADRPRSVBL><BG:PRS><BG:geboortedatum>{}</BG:geboortedatum>{}</BG:PRS></BG:ADRPRSVBL>'
+    overleden = {
+        True: '<BG:datumOverlijden>20170101</BG:datumOverlijden>',
+        False: '<BG:datumOverlijden xsi:nil="true" StUF:noValue="geenWaarde"/>',
+    }
+    body = "".join(
+        '<BG:ADR>' + "".join(prs.format(birthdate, overleden[dead]) for birthdate, dead in address) + '</BG:ADR>'
+        for address in addresses
+    )
+    return response_error.replace(b'<BG:body xmlns="http://www.egem.nl/StUF/sector/bg/0204"/>',
+                                  b'<BG:body>' + body.encode() + b'</BG:body>')
+
+
+def test_La01_parser():
+    message = _get_La01(
+        [("19620412", False), ("20100101", True), ("20100102", False)],
+        [],
+        [("19620412", False), ("19621341", False)],
+        [("19620412", True), ("19620413", False)] * 100,
+    )
+
+    parser = La01Parser()
+    end_of_body = message.index(b'</BG:body>')
+    for i in range(0, end_of_body, 7):
+        parser.feed(message[i:min(i + 7, end_of_body)])
+
+    # Persons and addresses are discarded once they have been read
+    assert parser._elements[-1].tag == "{http://www.egem.nl/StUF/sector/bg/0204}body"
+    assert len(parser._elements[-1]) == 0
+
+    parser.feed(message[end_of_body:])
+    assert parser.close() == [[19620412, 20100102], [], None, [19620413] * 100]
+
+    parser = La01Parser()
+    parser.feed(message[:-10])
+    with pytest.raises(ET.ParseError):
+        parser.close()
+
+
+def test_packed_addresses():
+    addresses = [[19620412, 20100102], [], None, [19620413] * 100]
+    packed = PackedAddresses(addresses)
+    assert packed == addresses
+    assert packed == PackedAddresses(addresses)
+    assert len(packed) == 4
+    assert [None if birthdates is None else list(birthdates) for birthdates in packed] == addresses
+    assert not PackedAddresses()
+
+    # 4 bytes per birthdate instead of a list of int objects
+    assert sys.getsizeof(packed) < sum(sys.getsizeof(birthdates or []) for birthdates in addresses)
+
+    info = get_address_info("0363200000399540", next(iter(packed)))
+    assert info.as_dict() == get_info("0363200000399540", [19620412, 20100102])
+    assert get_address_info("0363200000399540", None).as_dict() == get_info("0363200000399540", None)
+    with pytest.raises(AttributeError):
+        info.other = 1
+
+
+def test_Lv01_template():
+    template = Lv01Template(zender=config["zender"], ontvanger=config["ontvanger"])
+    message = template.build("0363200000399540")
+    referentienummer = re.search(b"<stuf:referentienummer>(.*)</stuf:referentienummer>", message).group(1)
+    tijdstip_bericht = re.search(b"<stuf:tijdstipBericht>(.*)</stuf:tijdstipBericht>", message).group(1)
+    assert message == _get_Lv01_message(
+        bag_id="0363200000399540",
+        zender={key: value or "" for key, value in config["zender"].items()},
+        ontvanger={key: value or "" for key, value in config["ontvanger"].items()},
+        referentienummer=referentienummer.decode(),
+        tijdstip_bericht=tijdstip_bericht.decode()
+    ).encode()
+
+    # Every message has its own reference number, also when a process with the same id builds it
+    assert referentienummer not in template.build("0363200000399540")
+    other = Lv01Template(zender=config["zender"], ontvanger=config["ontvanger"])
+    assert referentienummer not in other.build("0363200000399540")
+    assert len(referentienummer) <= 40
+
+    # The BAG id is escaped
+    assert b"<identificatieNummerAanduiding>&lt;x&gt;</identificatieNummerAanduiding>" in template.build("<x>")
 
 
 class MockResponse:
+    status_code = 200
     content = None
 
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
 
 def mockreturn(*args, **kwargs):
     return MockResponse()
@@ -137,6 +328,217 @@ def test_messages(monkeypatch):
     }]
 
 
+def test_messages_concurrent(monkeypatch):
+    def request(self, method, url, data=None, **kwargs):
+        if b"fail" in data:
+            raise RequestException()
+        if b"slow" in data:
+            time.sleep(0.2)
+        response = MockResponse()
+        response.content = response_ok if b"0363" in data else response_error
+        return response
+
+    monkeypatch.setattr(Session, "request", request)
+
+    msg = get_Lv01(["slow0363", "fail", "0363200000399540", "x"], dict(config, concurrency=4))
+    assert [info["locatie"]["bag_id"] for info in msg] == ["slow0363", "fail", "0363200000399540", "x"]
+    assert [info.get("error") for info in msg] == [
+        None, "Bericht kan niet worden opgehaald", None, "Geen adres gevonden"
+    ]
+
+
+def _get_range_La01(*bag_ids):
+    # The answer of response_ok with its address repeated for each BAG id
+    start, end = response_ok.index(b"<BG:ADR "), response_ok.index(b"</BG:ADR>") + len(b"</BG:ADR>")
+    addresses = b"".join(response_ok[start:end].replace(b"0363200000399540", bag_id.encode()) for bag_id in bag_ids)
+    return response_ok[:start] + addresses + response_ok[end:]
+
+
+class MockRangeResponse(MockResponse):
+    status_code = 200
+
+
+def test_ranges():
+    assert _get_ranges(["0363200000399545", "0363200000399540", "0363200000399541", "0363200000399540"], 15) == [
+        ["0363200000399540", "0363200000399541", "0363200000399545"]
+    ]
+    assert _get_ranges(["0363200000399540", "0363200000399555", "0363200000399556", "x", "123"], 15) == [
+        ["0363200000399555", "0363200000399556"]
+    ]
+    assert _get_ranges(["0363200000399540", "0363200000399541"], 1) == []
+
+    parser = La01Parser()
+    parser.feed(_get_range_La01("0363200000399541", "0363200000399540", "0363200000399541"))
+    parser.close()
+    assert parser.bag_ids == ["0363200000399541", "0363200000399540", "0363200000399541"]
+    assert parser.get_addresses_by_bag_id() == {
+        "0363200000399540": [[19620412]],
+        "0363200000399541": [[19620412], [19620412]],
+    }
+    assert not parser.fault
+
+
+def test_messages_range(monkeypatch):
+    requests = []
+    answer = {"status_code": 200, "content": None}
+
+    def request(self, method, url, data=None, **kwargs):
+        bounds = re.findall(b"<identificatieNummerAanduiding>([^<]*)</identificatieNummerAanduiding>", data)
+        requests.append(tuple(bound.decode() for bound in bounds))
+        response = MockRangeResponse()
+        if bounds[0] != bounds[1]:
+            response.status_code = answer["status_code"]
+            response.content = answer["content"]
+        else:
+            response.content = response_ok if b"0363" in data else response_error
+        return response
+
+    monkeypatch.setattr(Session, "request", request)
+    monkeypatch.setattr(stuf_0204, "_range_rejected", {})
+    # Without hedging, which would add requests once enough latencies are known
+    range_config = dict(config, range={"size": 15, "maximum": 4, "retry": 3600}, hedge={})
+    bag_ids = ["0363200000399540", "x", "0363200000399545", "0363200000399541"]
+
+    # A single request for the range, the BAG ids in the range that have no address are not found
+    answer["content"] = _get_range_La01("0363200000399540", "0363200000399541", "0363200000399542")
+    msg = get_Lv01(bag_ids, range_config)
+    assert sorted(requests) == [("0363200000399540", "0363200000399545"), ("x", "x")]
+    assert [info["locatie"]["bag_id"] for info in msg] == bag_ids
+    assert [info.get("error") for info in msg] == [None, "Geen adres gevonden", "Geen adres gevonden", None]
+
+    # The BAG ids are requested one by one when the answer may be incomplete
+    get_cache(config).clear()
+    requests.clear()
+    answer["content"] = _get_range_La01(*(f"036320000039954{i}" for i in range(4)))
+    msg = get_Lv01(bag_ids, range_config)
+    assert len(requests) == 5
+    assert [info.get("error") for info in msg] == [None, "Geen adres gevonden", None, None]
+
+    # And when an address in the answer has no BAG id or one outside the range
+    no_bag_id = _get_range_La01("0363200000399540").replace(
+        b'<StUF:extraElement naam="identificatieNummerAanduiding">0363200000399540</StUF:extraElement>', b"")
+    for content in [_get_range_La01("0363200000399540", "0363200000399546"), no_bag_id]:
+        get_cache(config).clear()
+        requests.clear()
+        answer["content"] = content
+        msg = get_Lv01(bag_ids, range_config)
+        assert len(requests) == 5
+        assert [info.get("error") for info in msg] == [None, "Geen adres gevonden", None, None]
+
+    # And when BRP rejects the range, after which no more ranges are requested
+    for status_code, content in [(500, response_ok), (200, response_fault)]:
+        monkeypatch.setattr(stuf_0204, "_range_rejected", {})
+        get_cache(config).clear()
+        requests.clear()
+        answer.update(status_code=status_code, content=content)
+        msg = get_Lv01(bag_ids, range_config)
+        assert len(requests) == 5
+        assert [info.get("error") for info in msg] == [None, "Geen adres gevonden", None, None]
+
+        get_cache(config).clear()
+        requests.clear()
+        get_Lv01(bag_ids, range_config)
+        assert len(requests) == 4
+
+
+def test_messages_coalesced(monkeypatch):
+    calls = []
+
+    def request(self, method, url, data=None, **kwargs):
+        calls.append(data)
+        time.sleep(0.2)
+        response = MockResponse()
+        response.content = response_ok
+        return response
+
+    monkeypatch.setattr(Session, "request", request)
+
+    msg = get_Lv01(["0363200000399540"] * 4, dict(config, concurrency=4))
+    assert len(msg) == 4
+    assert all(info == msg[0] for info in msg)
+    assert len(calls) == 1
+
+    # An interactive lookup does not wait for a background request for the same BAG id
+    get_cache(config).clear()
+    calls.clear()
+    background = threading.Thread(target=get_Lv01, args=("0363200000399540", dict(config, priority=BACKGROUND)))
+    background.start()
+    time.sleep(0.05)
+    get_Lv01("0363200000399540", config)
+    background.join()
+    assert len(calls) == 2
+
+
+def test_messages_deadline(monkeypatch):
+    def request(self, method, url, timeout=None, **kwargs):
+        assert timeout[0] == config["timeout"]["connect"]
+        assert timeout[1] <= 0.2
+        response = MockResponse()
+        response.content = response_ok
+        response.iter_content = lambda chunk_size: (time.sleep(0.1) or response_ok[i:i + 10]
+                                                    for i in range(0, len(response_ok), 10))
+        return response
+
+    monkeypatch.setattr(Session, "request", request)
+    timeout = dict(config["timeout"], deadline=0.2)
+    msg = get_Lv01("0363200000399540", dict(config, timeout=timeout))
+    assert msg[0]["error"] == "Bericht kan niet worden opgehaald"
+
+
+def test_messages_circuit_breaker(monkeypatch):
+    def unreachable(*args, **kwargs):
+        raise RequestException()
+
+    monkeypatch.setattr(Session, "request", unreachable)
+    for _ in range(config["breaker"]["window"]):
+        get_Lv01("0363200000399540", config)
+    assert get_breaker(config).stats()["state"] == "open"
+
+    # The breaker rejects requests without sending them
+    monkeypatch.setattr(Session, "request", mockreturn)
+    MockResponse.content = response_ok
+    assert get_Lv01("0363200000399540", config)[0]["error"] == "Bericht kan niet worden opgehaald"
+
+    # A trial request that cannot be parsed opens the breaker again, instead of leaving it half open
+    monkeypatch.setattr(get_breaker(config), "reset_timeout", 0)
+    MockResponse.content = b"<no xml"
+    assert get_Lv01("0363200000399540", config)[0]["error"] == "Bericht kan niet worden vertaald"
+    assert get_breaker(config).stats()["state"] == "open"
+
+    # A request that the scheduler rejects does not take the trial request of the breaker
+    scheduler = get_scheduler(config)
+    monkeypatch.setattr(scheduler, "_tokens", 0)
+    monkeypatch.setattr(scheduler, "rate", 0.001)
+    monkeypatch.setitem(config, "timeout", dict(config["timeout"], deadline=0.01))
+    assert get_Lv01("0363200000399540", config)[0]["error"] == "Bericht kan niet worden opgehaald"
+    assert get_breaker(config).stats()["state"] == "open"
+
+    scheduler.reset()
+    MockResponse.content = response_ok
+    assert "error" not in get_Lv01("0363200000399540", config)[0]
+    assert get_breaker(config).stats()["state"] == "closed"
+
+
+def test_messages_fault(monkeypatch):
+    answer = {}
+
+    def fault(*args, **kwargs):
+        response = MockResponse()
+        response.status_code = answer["status_code"]
+        response.content = response_fault
+        return response
+
+    # An HTTP error or a SOAP fault is a failed request, not an address that is not found
+    monkeypatch.setattr(Session, "request", fault)
+    for status_code in [500, 200]:
+        answer["status_code"] = status_code
+        assert get_Lv01("0363200000399540", config)[0]["error"] == "Bericht kan niet worden opgehaald"
+        assert get_cache(config).get("0363200000399540") is None
+    for _ in range(config["breaker"]["window"]):
+        get_Lv01("0363200000399540", config)
+    assert get_breaker(config).stats()["state"] == "open"
+
+
 def test_http_responses(client, monkeypatch):
     monkeypatch.setattr(Session, "request", mockreturn)
 
@@ -157,6 +559,225 @@ def test_http_responses(client, monkeypatch):
     assert client.get('/brp_brandweer/0363200000399540x').status_code == 404
 
 
+def test_http_cached_responses(client, monkeypatch):
+    monkeypatch.setattr(Session, "request", mockreturn)
+
+    MockResponse.content = response_ok
+    response = client.get('/brp_brandweer/0363200000399540')
+    assert response.headers["X-BRP-Source"] == "brp"
+    assert "Age" not in response.headers
+
+    MockResponse.content = response_error
+    response = client.get('/brp_brandweer/0363200000399540')
+    assert response.status_code == 200
+    assert response.headers["X-BRP-Source"] == "cache"
+    assert response.headers["Age"] == "0"
+
+    assert client.delete('/brp_brandweer/cache/0363200000399540').status_code == 204
+    response = client.get('/brp_brandweer/0363200000399540')
+    assert response.status_code == 404
+    assert response.headers["X-BRP-Source"] == "brp"
+
+
+def test_http_snapshot_responses(client, monkeypatch, tmpdir):
+    path = str(tmpdir.join("snapshot.sqlite"))
+    with SnapshotWriter(path) as snapshot:
+        snapshot.put("0363200000399540", [[19620412]], stored=time.time() - 3600)
+    monkeypatch.setitem(config["snapshot"], "path", path)
+    monkeypatch.setitem(config["snapshot"], "latency_budget", 0.1)
+
+    def unreachable(*args, **kwargs):
+        raise RequestException()
+
+    monkeypatch.setattr(Session, "request", unreachable)
+    response = client.get('/brp_brandweer/0363200000399540')
+    assert response.status_code == 200
+    assert response.headers["X-BRP-Source"] == "snapshot"
+    assert 3600 <= int(response.headers["Age"]) < 3610
+    assert "Last-Modified" in response.headers
+    assert response.json["indicatoren"][0]["aanvullende_informatie"] == \
+        "Ingeschrevenen 0-12 jaar: 0 pers., 13-69 jaar: 1 pers., 70+ jaar: 0 pers."
+
+    assert client.get('/brp_brandweer/0363200000399541').status_code == 404
+
+    def slow(*args, **kwargs):
+        time.sleep(0.3)
+        return mockreturn()
+
+    monkeypatch.setattr(Session, "request", slow)
+    MockResponse.content = response_error
+    assert client.get('/brp_brandweer/0363200000399540').headers["X-BRP-Source"] == "snapshot"
+    assert client.get('/brp_brandweer/0363200000399541').headers["X-BRP-Source"] == "brp"
+
+
+def _post_json(client, url, body):
+    return client.post(url, data=json.dumps(body), content_type="application/json")
+
+
+def test_http_batch_responses(client, monkeypatch):
+    monkeypatch.setattr(Session, "request", mockreturn)
+
+    MockResponse.content = response_ok
+    response = _post_json(client, '/brp_brandweer', ["0363200000399540", "0363200000399541"])
+    assert response.status_code == 200
+    assert [result["status"] for result in response.json["results"]] == [200, 200]
+    assert [result["locatie"]["bag_id"] for result in response.json["results"]] == [
+        "0363200000399540", "0363200000399541"
+    ]
+    assert [result["source"] for result in response.json["results"]] == ["brp", "brp"]
+    assert "age" not in response.json["results"][0]
+
+    # Each result has its own source and age
+    response = _post_json(client, '/brp_brandweer', ["0363200000399540", "0363200000399542"])
+    assert [result["source"] for result in response.json["results"]] == ["cache", "brp"]
+    assert response.json["results"][0]["age"] == 0
+    assert "age" not in response.json["results"][1]
+
+    # A resident born more than 125 years ago does not make the batch fail
+    MockResponse.content = response_ok.replace(b"19620412", b"18800101")
+    response = _post_json(client, '/brp_brandweer', ["0363200000399543"])
+    assert response.status_code == 200
+    assert response.json["results"][0]["indicatoren"][0]["aanvullende_informatie"].endswith("70+ jaar: 1 pers.")
+
+    MockResponse.content = response_error
+    response = _post_json(client, '/brp_brandweer', {"bag_ids": ["0363200000399540x"]})
+    assert response.json["results"][0]["status"] == 404
+
+    assert _post_json(client, '/brp_brandweer', {"bag_id": "0363200000399540"}).status_code == 400
+    assert _post_json(client, '/brp_brandweer', [1, 2]).status_code == 400
+    assert _post_json(client, '/brp_brandweer', {"bag_ids": ["1"], "priority": "urgent"}).status_code == 400
+    waits = scheduler_wait_seconds.get("background")[0]
+    response = _post_json(client, '/brp_brandweer', {"bag_ids": ["0363200000399549"], "priority": "background"})
+    assert response.status_code == 200
+    assert scheduler_wait_seconds.get("background")[0] == waits + 1
+    assert _post_json(client, '/brp_brandweer', ["1"] * (config["max_batch_size"] + 1)).status_code == 413
+
+
+def _jsonify(data, pretty):
+    # The body of flask.jsonify(data) of the pinned Flask 0.12, the installed Flask may be another version
+    separators = (", ", ": ") if pretty else (",", ":")
+    return (json.dumps(data, sort_keys=True, indent=2 if pretty else None, separators=separators) + "\n").encode()
+
+
+@pytest.mark.parametrize("fast_encoder", [True, False])
+@pytest.mark.parametrize("pretty", [True, False])
+def test_rendered_responses(monkeypatch, fast_encoder, pretty):
+    if not fast_encoder:
+        monkeypatch.setattr(render_0204, "orjson", None)
+
+    generator = random.Random(0)
+    infos = [
+        AddressInfo("0363200000399540", (0, 0, 0)),
+        AddressInfo("0363200000399540", (3, 8, 1)),
+        AddressInfo("0363200000399541", error="Geen adres gevonden"),
+        AddressInfo('"\\ é €\n', error='Bericht "kan" niet\t\u00e9\u20ac\U0001f525'),
+    ] + [
+        AddressInfo(str(generator.randint(0, 10 ** 16)), tuple(generator.randint(0, 20) for _ in range(3)))
+        for _ in range(100)
+    ]
+    lookups = [Lookup(infos[:2], "brp", None, None), Lookup(infos[2:3], "snapshot", 86400.5, None)] + [
+        Lookup([info], generator.choice(["brp", "cache"]), generator.choice([None, generator.random() * 300]), None)
+        for info in infos[3:]
+    ]
+    for info in infos:
+        assert render_0204.dumps_info(info, pretty) == _jsonify(info.as_dict(), pretty)
+    results = [
+        dict(info.as_dict(), source=lookup.source, status=404 if info.error else 200,
+             **({} if lookup.age is None else {"age": int(lookup.age)}))
+        for lookup in lookups for info in lookup.results
+    ]
+    assert render_0204.dumps_results(lookups, pretty) == _jsonify({"results": results}, pretty)
+    assert render_0204.dumps_results([], pretty) == _jsonify({"results": []}, pretty)
+    assert render_0204.dumps({"error": "Niet €"}, pretty) == _jsonify({"error": "Niet €"}, pretty)
+
+
+def test_rendered_layout(client, monkeypatch):
+    monkeypatch.setattr(Session, "request", mockreturn)
+    MockResponse.content = response_ok
+
+    response = client.get('/brp_brandweer/0363200000399540')
+    assert response.get_data() == _jsonify(json.loads(response.get_data()), True)
+    response = client.get('/brp_brandweer/0363200000399540', headers={"X-Requested-With": "XMLHttpRequest"})
+    assert response.get_data() == _jsonify(json.loads(response.get_data()), False)
+
+
+def test_http_metrics(client, monkeypatch):
+    monkeypatch.setattr(Session, "request", mockreturn)
+    requests = stage_seconds.get("parse")[0]
+
+    MockResponse.content = response_ok
+    client.get('/brp_brandweer/0363200000399540')
+    MockResponse.content = b"<no xml"
+    client.get('/brp_brandweer/0363200000399541')
+    assert stage_seconds.get("parse")[0] == requests + 1
+    assert stage_seconds.get("indicatoren")[0] > 0
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    metrics = response.get_data(as_text=True)
+    for line in [
+        '# TYPE brp_stage_seconds histogram',
+        'brp_stage_seconds_count{stage="message"}',
+        'brp_errors_total{error="ParseError",exception="ParseError"}',
+        'http_request_seconds_count{route="/brp_brandweer/<string:bag_id>",method="GET",status="200"}',
+        'brp_cache_events_total{event="misses"}',
+        'brp_breaker_state{state="closed"} 1',
+        'brp_scheduler_queue_depth{priority="background"} 0',
+        'brp_scheduler_wait_seconds_count{priority="interactive"}',
+    ]:
+        assert line in metrics
+
+
+def test_http_admin_token(client, monkeypatch):
+    # Disabled without a token
+    monkeypatch.setitem(config, "admin_token", None)
+    assert client.get('/admin/slow_requests', headers={"Authorization": "Bearer "}).status_code == 404
+
+    monkeypatch.setitem(config, "admin_token", "secret")
+    assert client.get('/admin/slow_requests').status_code == 401
+    response = client.get('/admin/slow_requests', headers={"Authorization": "Bearer other"})
+    assert response.status_code == 401
+    assert response.headers["WWW-Authenticate"] == "Bearer"
+    # Profiling is disabled
+    assert client.get('/admin/slow_requests', headers={"Authorization": "Bearer secret"}).status_code == 404
+
+    # No cross-origin requests for the admin endpoints
+    origin = {"Origin": "https://example.com"}
+    assert "Access-Control-Allow-Origin" not in client.get('/admin/slow_requests', headers=origin).headers
+    assert "Access-Control-Allow-Origin" in client.get('/metrics', headers=origin).headers
+
+
+def test_http_slow_requests(client, monkeypatch):
+    monkeypatch.setattr(Session, "request", mockreturn)
+    monkeypatch.setitem(config, "admin_token", "secret")
+    admin = {"Authorization": "Bearer secret"}
+    assert client.get('/admin/slow_requests', headers=admin).status_code == 404
+
+    monkeypatch.setitem(config, "profile", dict(config["profile"], threshold=1e-9, interval=0.001))
+    MockResponse.content = response_ok
+    client.get('/brp_brandweer/0363200000399540')
+    MockResponse.content = b"<no xml"
+    client.get('/brp_brandweer/0363200000399541')
+
+    response = client.get('/admin/slow_requests', headers=admin)
+    assert response.status_code == 200
+    slow_request, failed_request = response.json["slow_requests"]
+    assert slow_request["name"] == "GET /brp_brandweer/<string:bag_id>"
+    assert slow_request["status"] == 200
+    stages = {stage["stage"]: stage for stage in slow_request["stages"]}
+    assert {"scheduler", "message", "server", "receive", "parse", "indicatoren"} <= set(stages)
+    assert stages["receive"]["bytes"] == len(response_ok)
+    assert stages["indicatoren"]["addresses"] == 1
+    assert stages["indicatoren"]["persons"] == 1
+    assert failed_request["stages"][-1]["error"] == "ParseError"
+
+    # No BAG ids or birthdates
+    text = response.get_data(as_text=True)
+    assert "0363200000399540" not in text and "19620412" not in text
+    assert stages["indicatoren"]["bag_id"].startswith("0363-")
+    assert len(get_profiler(config).slow_requests()) == 3
+
+
 def test_swagger(client):
     assert client.get('/static/openapi.yaml').status_code == 200
 
@@ -173,3 +794,46 @@ def test_env_check(monkeypatch):
             check_env_vars()
         monkeypatch.setenv(var, "any other value")
         check_env_vars()
+
+
+def test_pool():
+    assert get_pool(config) is get_pool(config)
+    assert get_pool(config).session() is get_pool(config).session()
+
+    pool = SessionPool(cert=None, verify=False, idle_timeout=0)
+    session = pool.session()
+    assert pool.session() is not session
+
+
+def test_pool_reconnect(monkeypatch):
+    calls = []
+    failure = {}
+
+    def fail_once(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            pool_module._local.reused = failure["reused"]
+            raise failure["error"]
+        return MockResponse()
+
+    monkeypatch.setattr(Session, "request", fail_once)
+    pool = SessionPool(cert=None, verify=False)
+    session = pool.session()
+    reconnects = get_pool_stats()["reconnects"]
+
+    # Resent when the server has closed a kept-alive connection, without closing the other connections
+    stale = ConnectionError(ProtocolError("Connection aborted.", RemoteDisconnected("closed")))
+    failure.update(error=stale, reused=True)
+    assert isinstance(pool.post(url="http://localhost"), MockResponse)
+    assert len(calls) == 2
+    assert get_pool_stats()["reconnects"] == reconnects + 1
+    assert pool.session() is session
+
+    # But not when the request may have been sent or when a new connection failed
+    for error, reused in [(ConnectTimeout(), True), (ReadTimeout(), True), (stale, False)]:
+        calls.clear()
+        failure.update(error=error, reused=reused)
+        with pytest.raises(type(error)):
+            pool.post(url="http://localhost")
+        assert len(calls) == 1
+    assert get_pool_stats()["reconnects"] == reconnects + 1
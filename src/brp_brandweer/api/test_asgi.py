@@ -0,0 +1,164 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from asgi import app as asgi_app
+from config import config
+from stuf import async_0204
+from stuf.cache import get_cache
+from stuf.resilience import get_breaker, get_latencies
+from stuf.scheduler import get_scheduler
+from test_api import _jsonify, response_error, response_fault, response_ok
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    get_cache(config).clear()
+    get_breaker(config).reset()
+    get_latencies(config).reset()
+    get_scheduler(config).reset()
+
+
+def _run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+def _mock_brp(monkeypatch, handler):
+    brp = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(async_0204, "get_client", lambda config: brp)
+
+
+async def _request(method, url, **kwargs):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=asgi_app), base_url="http://testserver") as client:
+        return await client.request(method, url, **kwargs)
+
+
+def test_asgi_responses(monkeypatch):
+    content = {"response": response_ok}
+    _mock_brp(monkeypatch, lambda request: httpx.Response(200, content=content["response"]))
+
+    response = _run(_request("GET", "/brp_brandweer/0363200000399540"))
+    assert response.status_code == 200
+    assert response.headers["X-BRP-Source"] == "brp"
+    assert response.content == _jsonify(response.json(), True)
+    assert response.json() == {
+        'locatie': {
+            'bag_id': '0363200000399540'
+        },
+        'indicatoren': [{
+            'waarschuwingsniveau': 3,
+            'indicator': 'Kwetsbare personen',
+            'label': 'Leeftijd',
+            'aanvullende_informatie': 'Ingeschrevenen 0-12 jaar: 0 pers., 13-69 jaar: 1 pers., 70+ jaar: 0 pers.'
+        }]
+    }
+
+    content["response"] = response_error
+    response = _run(_request("GET", "/brp_brandweer/0363200000399540", headers={"X-Requested-With": "XMLHttpRequest"}))
+    assert response.content == _jsonify(response.json(), False)
+    assert response.headers["X-BRP-Source"] == "cache"
+    assert response.headers["Age"] == "0"
+    assert _run(_request("DELETE", "/brp_brandweer/cache/0363200000399540")).status_code == 204
+    assert _run(_request("GET", "/brp_brandweer/0363200000399540")).status_code == 404
+
+    assert _run(_request("GET", "/static/openapi.yaml")).status_code == 200
+    assert _run(_request("GET", "/static/..%2Fapp.py")).status_code == 404
+    assert _run(_request("PUT", "/brp_brandweer/0363200000399540")).status_code == 405
+
+
+def test_asgi_batch_responses(monkeypatch):
+    bag_ids = []
+
+    async def handler(request):
+        bag_ids.append(request.content)
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, content=response_ok)
+
+    _mock_brp(monkeypatch, handler)
+
+    body = json.dumps(["0363200000399540", "0363200000399541", "0363200000399540"])
+    response = _run(_request("POST", "/brp_brandweer", content=body))
+    assert response.status_code == 200
+    assert [result["locatie"]["bag_id"] for result in response.json()["results"]] == [
+        "0363200000399540", "0363200000399541", "0363200000399540"
+    ]
+    # The duplicate BAG id shares the request for the first one
+    assert len(bag_ids) == 2
+    assert [result["source"] for result in response.json()["results"]] == ["brp", "brp", "brp"]
+
+    assert _run(_request("POST", "/brp_brandweer", content="[1, 2]")).status_code == 400
+    assert _run(_request("POST", "/brp_brandweer", content="no json")).status_code == 400
+    body = json.dumps(["1"] * (config["max_batch_size"] + 1))
+    assert _run(_request("POST", "/brp_brandweer", content=body)).status_code == 413
+
+
+def test_asgi_unreachable(monkeypatch):
+    def unreachable(request):
+        raise httpx.ConnectError("unreachable")
+
+    _mock_brp(monkeypatch, unreachable)
+
+    response = _run(_request("GET", "/brp_brandweer/0363200000399540"))
+    assert response.status_code == 404
+    assert response.json()["error"] == "Bericht kan niet worden opgehaald"
+
+
+def test_asgi_cors():
+    origin = {"Origin": "https://example.com"}
+    response = _run(_request("GET", "/metrics", headers=origin))
+    assert response.headers["Access-Control-Allow-Origin"] == "https://example.com"
+    assert _run(_request("GET", "/metrics")).headers["Access-Control-Allow-Origin"] == "*"
+
+    preflight = dict(origin, **{
+        "Access-Control-Request-Method": "POST",
+        "Access-Control-Request-Headers": "X-Requested-With, Content-Type"
+    })
+    response = _run(_request("OPTIONS", "/brp_brandweer", headers=preflight))
+    assert response.status_code == 200
+    assert response.headers["Allow"] == "OPTIONS, POST"
+    assert response.headers["Access-Control-Allow-Origin"] == "https://example.com"
+    assert "POST" in response.headers["Access-Control-Allow-Methods"]
+    assert response.headers["Access-Control-Allow-Headers"] == "Content-Type, X-Requested-With"
+    assert _run(_request("OPTIONS", "/unknown", headers=preflight)).status_code == 404
+
+    # No cross-origin requests for the admin endpoints
+    response = _run(_request("OPTIONS", "/admin/slow_requests", headers=preflight))
+    assert response.status_code == 200
+    assert "Access-Control-Allow-Origin" not in response.headers
+    assert "Access-Control-Allow-Origin" not in _run(_request("GET", "/admin/slow_requests", headers=origin)).headers
+
+
+def test_asgi_admin_token(monkeypatch):
+    # Disabled without a token
+    monkeypatch.setitem(config, "admin_token", None)
+    assert _run(_request("GET", "/admin/slow_requests", headers={"Authorization": "Bearer "})).status_code == 404
+
+    monkeypatch.setitem(config, "admin_token", "secret")
+    assert _run(_request("GET", "/admin/slow_requests")).status_code == 401
+    response = _run(_request("GET", "/admin/slow_requests", headers={"Authorization": "Bearer other"}))
+    assert response.status_code == 401
+    assert response.headers["WWW-Authenticate"] == "Bearer"
+    # Profiling is disabled
+    assert _run(_request("GET", "/admin/slow_requests", headers={"Authorization": "Bearer secret"})).status_code == 404
+
+    monkeypatch.setitem(config, "profile", dict(config["profile"], threshold=1))
+    response = _run(_request("GET", "/admin/slow_requests", headers={"Authorization": "Bearer secret"}))
+    assert response.status_code == 200
+    assert response.json() == {"threshold": 1, "slow_requests": []}
+
+
+def test_asgi_body_size(monkeypatch):
+    monkeypatch.setitem(config, "max_body_size", 10)
+    response = _run(_request("POST", "/brp_brandweer", content=json.dumps(["0363200000399540"])))
+    assert response.status_code == 413
+    assert response.json()["error"] == "Verzoek is te groot"
+
+
+def test_asgi_fault(monkeypatch):
+    for status_code in [500, 200]:
+        _mock_brp(monkeypatch, lambda request: httpx.Response(status_code, content=response_fault))
+        response = _run(_request("GET", "/brp_brandweer/0363200000399540"))
+        assert response.json()["error"] == "Bericht kan niet worden opgehaald"
+        assert get_cache(config).get("0363200000399540") is None
@@ -0,0 +1,49 @@
+from benchmarks.bench_load import get_percentile, lookup_target, run
+from benchmarks.bench_memory import run as run_memory
+from benchmarks.bench_startup import run as run_startup
+from benchmarks.compare import compare
+from benchmarks.fake_brp import FakeBRP
+from config import config
+
+
+def test_fake_brp(monkeypatch):
+    server = FakeBRP(latency=0, jitter=0, addresses=2, residents=3)
+    monkeypatch.setitem(config, "host", server.start())
+    try:
+        lookup, _ = lookup_target()
+        results = run(lookup, ["0363200000399540", "0363200000399541"], concurrency=2)
+    finally:
+        server.stop()
+
+    assert results["requests"] == 2
+    assert results["errors"] == 0
+    assert results["latency"]["p50"] <= results["latency"]["max"]
+
+
+def test_compare():
+    assert get_percentile([1, 2, 3, 4], 50) == 3
+
+    rows, regressions = compare(
+        {"throughput": 100, "latency": {"p95": 0.1}, "requests": 10},
+        {"throughput": 80, "latency": {"p95": 0.105}, "requests": 20},
+        threshold=10
+    )
+    assert [row[0] for row in rows] == ["latency.p95", "throughput"]
+    assert regressions == ["throughput"]
+
+
+def test_memory():
+    results = run_memory(100, residents=4)
+    assert results["values_packed"] < results["values_lists"]
+    assert results["results_slots"] < results["results_dicts"]
+
+
+def test_startup():
+    server = FakeBRP(latency=0, jitter=0)
+    try:
+        results = run_startup(server.start(), warmup=True, runs=1)
+    finally:
+        server.stop()
+
+    assert 0 < results["load"] < results["first_response"]
+    assert results["first_lookup"] > 0
@@ -0,0 +1,183 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from stuf.cache import Cache, CacheBackend, MemoryBackend, SQLiteBackend, get_backend
+from stuf.parse_0204 import PackedAddresses
+
+
+def test_cache_ttl():
+    cache = Cache(ttl=0.1, refresh=0.1)
+    cache.set("a", [1])
+    assert cache.get("a")[0] == [1]
+    time.sleep(0.1)
+    assert cache.get("a") is None
+
+    cache = Cache(ttl=0)
+    cache.set("a", [1])
+    assert cache.get("a") is None
+
+    # Empty values (no addresses found) expire sooner
+    cache = Cache(ttl=10, refresh=10, negative_ttl=0.1)
+    cache.set("a", [1])
+    cache.set("b", [])
+    time.sleep(0.1)
+    assert cache.get("a")[0] == [1]
+    assert cache.get("b") is None
+    assert cache.lookup("b", lambda: [2]) == ([2], None)
+
+
+def test_cache_lru():
+    cache = Cache(backend=MemoryBackend(size=2))
+    cache.set("a", [1])
+    cache.set("b", [2])
+    cache.get("a")
+    cache.set("c", [3])
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+    assert cache.stats()["evictions"] == 1
+
+    cache = Cache(backend=MemoryBackend(memory=1000))
+    cache.set("a", list(range(100)))
+    assert cache.get("a") is None
+    assert cache.stats()["memory"] == 0
+
+
+def test_cache_purge():
+    cache = Cache()
+    cache.set("a", [1])
+    assert cache.purge("a")
+    assert not cache.purge("a")
+    assert cache.get("a") is None
+
+
+def test_cache_lookup():
+    cache = Cache(ttl=10, refresh=0.05)
+    fetched = threading.Event()
+    values = iter([[1], [2]])
+
+    def fetch():
+        value = next(values)
+        fetched.set()
+        return value
+
+    assert cache.lookup("a", fetch) == ([1], None)
+    value, age = cache.lookup("a", fetch)
+    assert value == [1] and age < 0.05
+
+    # A stale entry is served and refreshed in the background
+    fetched.clear()
+    time.sleep(0.05)
+    assert cache.lookup("a", fetch)[0] == [1]
+    assert fetched.wait(1)
+    for _ in range(100):
+        if cache.get("a")[0] == [2]:
+            break
+        time.sleep(0.01)
+    assert cache.get("a")[0] == [2]
+    assert cache.stats()["refreshes"] == 1
+
+
+def test_cache_refresh_bounded():
+    cache = Cache(ttl=10, refresh=0, max_refreshes=6)
+    release = threading.Event()
+    threads = set()
+    refreshed = []
+
+    def fetch(key):
+        threads.add(threading.current_thread().name)
+        release.wait(1)
+        refreshed.append(key)
+        return [2]
+
+    for key in range(10):
+        cache.set(str(key), [1])
+    for key in list(range(10)) * 3:
+        assert cache.lookup(str(key), lambda key=key: fetch(key))[0] == [1]
+    release.set()
+    for _ in range(100):
+        if not cache._refreshing:
+            break
+        time.sleep(0.01)
+
+    # Each key is refreshed once at a time, at most max_refreshes keys are waiting for a refresh
+    assert sorted(refreshed) == list(range(6))
+    assert len(threads) <= 4 and all(name.startswith("brp_cache_refresh") for name in threads)
+
+
+def test_cache_lookup_async_blocking_backend():
+    # The calls of a blocking backend do not run on the thread of the event loop
+    threads = set()
+
+    class BlockingBackend(MemoryBackend):
+        blocking = True
+
+        def get(self, key):
+            threads.add(threading.get_ident())
+            return super().get(key)
+
+        def set(self, key, value, stored):
+            threads.add(threading.get_ident())
+            super().set(key, value, stored)
+
+    async def fetch():
+        return [1]
+
+    cache = Cache(backend=BlockingBackend(), ttl=10)
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(cache.lookup_async("a", fetch)) == ([1], None)
+        assert loop.run_until_complete(cache.lookup_async("a", fetch))[0] == [1]
+    finally:
+        loop.close()
+    assert threads and threading.get_ident() not in threads
+
+
+def test_cache_sqlite(tmpdir):
+    path = str(tmpdir.join("cache.sqlite"))
+    backend = SQLiteBackend(path, size=2, mmap_size=1024 * 1024)
+    assert backend._connection().execute("PRAGMA mmap_size").fetchone()[0] == 1024 * 1024
+    cache = Cache(backend=backend, ttl=10, refresh=10)
+    cache.set("a", [[19620412, 20100101], None])
+    assert cache.get("a")[0] == [[19620412, 20100101], None]
+
+    # The entries are shared with any other process on the same file
+    other = Cache(backend=SQLiteBackend(path, size=2), ttl=10, refresh=10)
+    assert other.get("a")[0] == [[19620412, 20100101], None]
+    other.set("b", [])
+    other.set("c", [])
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 2
+
+    assert cache.purge("b")
+    assert other.get("b") is None
+    cache.clear()
+    assert other.get("c") is None
+
+    # Packed values are shared as lists
+    cache.set("a", PackedAddresses([[19620412, 20100101], None]))
+    assert other.get("a")[0] == [[19620412, 20100101], None]
+
+
+def test_cache_sqlite_prune(tmpdir):
+    backend = SQLiteBackend(str(tmpdir.join("cache.sqlite")), size=500)
+    statements = []
+    backend._connection().set_trace_callback(statements.append)
+    for i in range(1000):
+        backend.set(str(i), [], i)
+        assert backend.stats()["entries"] <= 505
+    # The entries are counted every 5 stores, the oldest are removed
+    assert sum(statement.startswith("DELETE") for statement in statements) == 100
+    assert backend.stats()["entries"] == 500
+    assert backend.get("499") is None and backend.get("500") is not None
+
+
+def test_cache_backend():
+    with pytest.raises(TypeError):
+        CacheBackend()
+    assert isinstance(get_backend({}), MemoryBackend)
+    with pytest.raises(ValueError):
+        get_backend({"backend": "unknown"})
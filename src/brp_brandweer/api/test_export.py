@@ -0,0 +1,71 @@
+import io
+import json
+
+from requests.sessions import Session
+
+from config import config, required_env_vars
+from export import RateLimiter, export, main
+from stuf.cache import get_cache
+from stuf.snapshot import Snapshot, SnapshotWriter
+from test_api import MockResponse, response_ok
+
+
+def mockreturn(*args, **kwargs):
+    response = MockResponse()
+    response.content = response_ok
+    return response
+
+
+def test_export(tmpdir, monkeypatch):
+    monkeypatch.setattr(Session, "request", mockreturn)
+    get_cache(config).clear()
+
+    output = io.StringIO()
+    assert export(["1\n", "\n", "2\n"], output) == 3
+    assert [json.loads(line)["locatie"]["bag_id"] for line in output.getvalue().splitlines()] == ["1", "2"]
+
+
+def test_export_resume(tmpdir, monkeypatch):
+    monkeypatch.setattr(Session, "request", mockreturn)
+    for var in required_env_vars:
+        monkeypatch.setenv(var, "any value")
+    get_cache(config).clear()
+
+    bag_ids = tmpdir.join("bag_ids.txt")
+    bag_ids.write("".join(f"{i}\n" for i in range(10)))
+    output = tmpdir.join("output.jsonl")
+    checkpoint = tmpdir.join("checkpoint")
+
+    # An interrupted export, with output after its last checkpoint
+    with open(str(output), "w") as file:
+        export(["0\n", "1\n", "2\n", "3\n"], file, checkpoint=str(checkpoint), interval=3)
+    checkpoint.write(json.dumps({"lines": 3, "size": len(output.read()) // 4 * 3}))
+
+    snapshot = str(tmpdir.join("snapshot.sqlite"))
+    main(["--input", str(bag_ids), "--output", str(output), "--checkpoint", str(checkpoint), "--snapshot", snapshot])
+    assert [json.loads(line)["locatie"]["bag_id"] for line in output.readlines()] == [str(i) for i in range(10)]
+    assert json.loads(checkpoint.read())["lines"] == 10
+    assert Snapshot(snapshot).get("9")[0] == [[19620412]]
+
+
+def test_export_snapshot_checkpoint(tmpdir, monkeypatch):
+    monkeypatch.setattr(Session, "request", mockreturn)
+    get_cache(config).clear()
+
+    # The birthdates of the lines before a checkpoint are committed, even when the export is interrupted after it
+    path = str(tmpdir.join("snapshot.sqlite"))
+    snapshot = SnapshotWriter(path, commit_interval=1000)
+    with open(str(tmpdir.join("output.jsonl")), "w") as file:
+        export(["0\n", "1\n", "2\n"], file, checkpoint=str(tmpdir.join("checkpoint")), interval=2,
+               concurrency=1, snapshot=snapshot)
+    assert Snapshot(path).get("2")[0] == [[19620412]]
+
+
+def test_rate_limiter(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr("time.sleep", sleeps.append)
+    limiter = RateLimiter(10)
+    for _ in range(3):
+        limiter.wait()
+    assert len(sleeps) == 2
+    assert 0.1 < sum(sleeps) <= 0.3
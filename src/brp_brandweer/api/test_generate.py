@@ -0,0 +1,72 @@
+import datetime
+import random
+import xml.etree.ElementTree as ET
+
+from stuf.config_0204 import ns
+from stuf.generate_0204 import La01Generator
+from stuf.parse_0204 import La01Parser, _age_category_table, _get_ages, parse_birthdates
+
+
+def _feed(parser, message, rnd):
+    # Feed the message in chunks of random sizes, splitting elements anywhere
+    position = 0
+    while position < len(message):
+        size = rnd.randint(1, 4096)
+        parser.feed(message[position:position + size])
+        position += size
+    return parser.close()
+
+
+def test_generated_messages():
+    rnd = random.Random(0)
+    for seed in range(100):
+        generator = La01Generator(
+            seed=seed,
+            addresses=rnd.randint(0, 5),
+            residents=(0, rnd.randint(0, 30)),
+            deceased=rnd.random(),
+            malformed=rnd.choice([0, 0.01, 0.1, 0.5])
+        )
+        message = generator.message()
+        expected = generator.addresses()
+
+        assert _feed(La01Parser(), message, rnd) == expected
+
+        body = ET.fromstring(message).find(".//ns:body", ns)
+        assert [parse_birthdates(address) for address in body.findall("./ns:ADR", ns)] == expected
+
+
+def test_generated_messages_are_reproducible():
+    assert La01Generator(seed=1, residents=5).message() == La01Generator(seed=1, residents=5).message()
+    assert La01Generator(seed=1, residents=5).message() != La01Generator(seed=2, residents=5).message()
+    # Also on another day
+    assert La01Generator(seed=1, residents=5).message() == \
+        La01Generator(seed=1, residents=5, reference_date=datetime.date(2018, 1, 30)).message()
+
+    generator = La01Generator(seed=1, addresses=3, residents=4, deceased=1)
+    assert generator.addresses() == [[], [], []]
+
+
+def test_generated_ages():
+    # The birthdates go back 100 years from the reference date, within the age categories today
+    for reference_date in [datetime.date(2018, 1, 30), datetime.date.today()]:
+        generator = La01Generator(addresses=100, residents=20, deceased=0, reference_date=reference_date)
+        birthdates = [birthdate for address in generator.addresses() for birthdate in address]
+        assert all(age in _age_category_table for age in _get_ages(birthdates))
+        assert 0 <= min(_get_ages(birthdates, reference_date)) and max(_get_ages(birthdates, reference_date)) <= 100
+
+
+def test_large_generated_message(tmpdir):
+    generator = La01Generator(addresses=10, residents=500, deceased=0.2)
+    path = tmpdir.join("La01.xml")
+    with open(str(path), "wb") as file:
+        size = generator.write(file, chunk_size=16 * 1024)
+    assert size == generator.size() == path.size()
+
+    parser = La01Parser()
+    with open(str(path), "rb") as file:
+        for chunk in iter(lambda: file.read(16 * 1024), b""):
+            parser.feed(chunk)
+    addresses = parser.close()
+    assert addresses == generator.addresses()
+    assert 3000 < sum(len(birthdates) for birthdates in addresses) < 5000
@@ -0,0 +1,58 @@
+from stuf.metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_counter():
+    counter = Counter("errors_total", "Errors", labels=("error",))
+    counter.inc("ParseError")
+    counter.inc("ParseError")
+    counter.inc('say "hi"', amount=2)
+    assert counter.get("ParseError") == 2
+    assert counter.render() == [
+        'errors_total{error="ParseError"} 2',
+        'errors_total{error="say \\"hi\\""} 2',
+    ]
+
+
+def test_gauge():
+    gauge = Gauge("startup_seconds", "Startup", labels=("phase",))
+    gauge.set(0.5, "load")
+    gauge.set(0.25, "load")
+    assert gauge.get("load") == 0.25
+    assert gauge.render() == ['startup_seconds{phase="load"} 0.25']
+
+
+def test_histogram():
+    histogram = Histogram("latency_seconds", "Latency", buckets=(0.1, 1), labels=("stage",))
+    histogram.observe(0.05, "parse")
+    histogram.observe(0.1, "parse")
+    histogram.observe(5, "parse")
+    assert histogram.get("parse") == (3, 5.15)
+    assert histogram.get("message") == (0, 0)
+    assert histogram.render() == [
+        'latency_seconds_bucket{stage="parse",le="0.1"} 2',
+        'latency_seconds_bucket{stage="parse",le="1.0"} 2',
+        'latency_seconds_bucket{stage="parse",le="+Inf"} 3',
+        'latency_seconds_sum{stage="parse"} 5.15',
+        'latency_seconds_count{stage="parse"} 3',
+    ]
+
+    with histogram.time("message"):
+        pass
+    assert histogram.get("message")[0] == 1
+
+
+def test_registry():
+    registry = Registry()
+    counter = registry.register(Counter("calls_total", "Calls"))
+    counter.inc()
+    assert registry.render([("pool_size", "gauge", "Pool size", [({"pool": "brp"}, 10)])]) == "\n".join([
+        "# HELP calls_total Calls",
+        "# TYPE calls_total counter",
+        "calls_total 1",
+        "# HELP pool_size Pool size",
+        "# TYPE pool_size gauge",
+        'pool_size{pool="brp"} 10',
+    ]) + "\n"
+
+    registry.reset()
+    assert counter.get() == 0
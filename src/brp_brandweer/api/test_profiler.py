@@ -0,0 +1,53 @@
+import json
+import threading
+import time
+
+from stuf.profiler import Profiler, add_error, add_stage, bind, current, redact, redact_bag_id
+
+
+def test_redact():
+    assert redact_bag_id("0363200000399540") == redact_bag_id("0363200000399540")
+    assert redact_bag_id("0363200000399540") != redact_bag_id("0363200000399541")
+    assert "200000399540" not in redact_bag_id("0363200000399540")
+    assert redact("No address 0363200000399540 born 19620412 at line 1") == \
+        "No address <redacted> born <redacted> at line 1"
+
+
+def _work():
+    add_stage("work", 0.05, items=2)
+    time.sleep(0.05)
+
+
+def test_profiler(tmpdir):
+    path = str(tmpdir.join("slow_requests.jsonl"))
+    profiler = Profiler(threshold=0.02, size=2, interval=0.001, path=path)
+
+    trace = profiler.start("GET /fast")
+    assert current() is trace
+    assert profiler.finish(trace) is None
+    assert current() is None
+    # Nothing is recorded outside of a trace
+    add_stage("work", 1)
+
+    for name in ["first", "second", "third"]:
+        trace = profiler.start(name)
+        thread = threading.Thread(target=bind(_work), name="worker")
+        thread.start()
+        thread.join()
+        add_error(ValueError("Invalid birthdate 19620412"))
+        slow_request = profiler.finish(trace, status=200)
+
+    assert slow_request["name"] == "third"
+    assert slow_request["status"] == 200
+    assert slow_request["seconds"] >= 0.05
+    work, error = slow_request["stages"]
+    assert work["stage"] == "work" and work["thread"] == "worker" and work["items"] == 2
+    assert error["error"] == "ValueError" and error["message"] == "Invalid birthdate <redacted>"
+    # The stacks of the worker thread are sampled
+    assert slow_request["samples"] > 0
+    assert any("test_profiler.py:_work" in stack["stack"] for stack in slow_request["stacks"])
+
+    # The last slow requests are kept, and appended to the file
+    assert [slow_request["name"] for slow_request in profiler.slow_requests()] == ["second", "third"]
+    with open(path) as file:
+        assert [json.loads(line)["name"] for line in file] == ["first", "second", "third"]
@@ -0,0 +1,77 @@
+import datetime
+import io
+import json
+
+from requests import ConnectionError
+from requests.sessions import Session
+
+from config import config, required_env_vars
+from refresh import main, read_feed, refresh
+from stuf.cache import get_cache
+from stuf.snapshot import Snapshot, SnapshotWriter
+from test_api import MockResponse, _get_La01, response_ok
+
+
+def mockreturn(*args, **kwargs):
+    response = MockResponse()
+    response.content = response_ok
+    return response
+
+
+def test_read_feed(tmpdir):
+    tmpdir.join("1").write("1\n2\n\n")
+    tmpdir.join("2").write("2\n3\n")
+    tmpdir.join("3.tmp").write("4\n")
+    tmpdir.join(".4").write("5\n")
+    files, bag_ids = read_feed(str(tmpdir))
+    assert [file.rsplit("/", 1)[-1] for file in files] == ["1", "2"]
+    assert bag_ids == ["1", "2", "3"]
+
+
+def test_refresh(tmpdir, monkeypatch):
+    monkeypatch.setattr(Session, "request", mockreturn)
+    get_cache(config).clear()
+    reference_date = datetime.date(2020, 6, 1)
+
+    path = str(tmpdir.join("snapshot.sqlite"))
+    with SnapshotWriter(path) as snapshot:
+        # A person that turns 13 on June 2 2020, and one that will not change category for a long time
+        snapshot.put("1", [[20070602]], stored=1, reference_date=reference_date)
+        snapshot.put("2", [[19900101]], stored=1, reference_date=reference_date)
+
+    snapshot = SnapshotWriter(path)
+    output = io.StringIO()
+    assert refresh(["3"], output, snapshot, reference_date + datetime.timedelta(days=1)) == []
+    snapshot.close()
+
+    lines = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [line["locatie"]["bag_id"] for line in lines] == ["3", "1"]
+    assert lines[1]["indicatoren"][0]["aanvullende_informatie"] == \
+        "Ingeschrevenen 0-12 jaar: 0 pers., 13-69 jaar: 1 pers., 70+ jaar: 0 pers."
+
+    assert Snapshot(path).get("3")[0] == [[19620412]]
+    assert get_cache(config).get("3")[0] == [[19620412]]
+    assert SnapshotWriter(path).due(reference_date + datetime.timedelta(days=1)) == []
+
+
+def test_refresh_feed(tmpdir, monkeypatch):
+    for var in required_env_vars:
+        monkeypatch.setenv(var, "any value")
+    get_cache(config).clear()
+
+    def unreachable(self, method, url, data=None, **kwargs):
+        if b"0363200000000002" in data:
+            raise ConnectionError()
+        response = MockResponse()
+        response.content = _get_La01([(19620412, False)])
+        return response
+
+    monkeypatch.setattr(Session, "request", unreachable)
+
+    feed = tmpdir.mkdir("feed")
+    feed.join("changes").write("0363200000000001\n0363200000000002\n")
+    output = tmpdir.join("changes.jsonl")
+    main(["--feed", str(feed), "--output", str(output)])
+
+    assert [json.loads(line)["locatie"]["bag_id"] for line in output.readlines()] == ["0363200000000001"]
+    assert read_feed(str(feed))[1] == ["0363200000000002"]
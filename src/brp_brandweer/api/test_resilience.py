@@ -0,0 +1,312 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from requests import RequestException
+
+from stuf.async_0204 import _hedge, _single_flight
+from stuf.cache import Cache
+from stuf.resilience import CircuitBreaker, LatencyTracker, get_hedge_stats, hedge
+from stuf.scheduler import BACKGROUND, INTERACTIVE, RateLimitedError, Scheduler, SharedScheduler
+
+
+def test_latency_tracker():
+    latencies = LatencyTracker(size=100)
+    assert latencies.percentile(95) is None
+    for latency in range(200):
+        latencies.add(latency)
+    assert latencies.percentile(50) == 150
+    assert latencies.percentile(100) == 199
+
+
+def test_hedge():
+    calls = []
+
+    def fn():
+        calls.append(None)
+        if len(calls) == 1:
+            time.sleep(0.5)
+            return "slow"
+        return "fast"
+
+    hedged = get_hedge_stats()["hedged"]
+    assert hedge(fn, 0.05) == "fast"
+    assert get_hedge_stats()["hedged"] == hedged + 1
+
+    calls.clear()
+    assert hedge(fn, None) == "slow"
+
+    # Not hedged without a token of the scheduler
+    calls.clear()
+    scheduler = Scheduler(rate=1, burst=1, reserve=0)
+    assert hedge(fn, 0.05, scheduler.try_acquire) == "fast"
+    calls.clear()
+    assert hedge(fn, 0.05, scheduler.try_acquire) == "slow"
+    assert len(calls) == 1
+
+    def fail():
+        raise RequestException()
+
+    with pytest.raises(RequestException):
+        hedge(fail, 0.05)
+
+
+def test_hedge_async_scheduler():
+    calls = []
+
+    async def fn():
+        calls.append(None)
+        if len(calls) == 1:
+            await asyncio.sleep(0.5)
+            return "slow"
+        return "fast"
+
+    scheduler = Scheduler(rate=1, burst=1, reserve=0)
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(_hedge(fn, 0.05, scheduler.try_acquire_async)) == "fast"
+        calls.clear()
+        # Not hedged without a token of the scheduler
+        assert loop.run_until_complete(_hedge(fn, 0.05, scheduler.try_acquire_async)) == "slow"
+    finally:
+        loop.close()
+
+
+def test_hedge_failure():
+    calls = []
+    lock = threading.Lock()
+
+    def fn():
+        with lock:
+            calls.append(None)
+            first = len(calls) == 1
+        time.sleep(0.1)
+        if first:
+            raise RequestException()
+        return "hedged"
+
+    # A failing first call does not hide the result of the hedged call
+    assert hedge(fn, 0.05) == "hedged"
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(window=4, error_rate=0.5, latency=1, reset_timeout=0.1)
+    for success, latency in [(True, 0), (False, 0), (True, 0)]:
+        assert breaker.allow()
+        breaker.record(success, latency)
+
+    # A slow request counts as a failure
+    breaker.record(True, 2)
+    assert breaker.stats() == {"state": "open", "trips": 1, "rejected": 0}
+    assert not breaker.allow()
+
+    # A single trial request is allowed after the reset timeout
+    time.sleep(0.1)
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record(False, 0)
+    assert breaker.stats()["state"] == "open"
+
+    # A trial request whose outcome is never recorded does not keep the breaker half open
+    time.sleep(0.1)
+    assert breaker.allow()
+    assert not breaker.allow()
+    time.sleep(0.1)
+    assert breaker.allow()
+    breaker.record(True, 0)
+    assert breaker.stats() == {"state": "closed", "trips": 2, "rejected": 3}
+
+
+def test_cache_stale_if_error():
+    cache = Cache(ttl=0.05, refresh=0.05, stale_if_error=10)
+    cache.set("a", [1])
+    time.sleep(0.05)
+
+    def fail():
+        raise RequestException()
+
+    value, age = cache.lookup("a", fail)
+    assert value == [1] and age >= 0.05
+    assert cache.stats()["stale_if_error"] == 1
+
+    cache.stale_if_error = 0
+    with pytest.raises(RequestException):
+        cache.lookup("a", fail)
+
+
+def test_scheduler_rate():
+    scheduler = Scheduler(rate=20, burst=1, reserve=0)
+    start = time.monotonic()
+    for _ in range(5):
+        scheduler.acquire()
+    assert 0.19 < time.monotonic() - start < 0.5
+
+    # Background requests leave a reserve for interactive requests
+    scheduler = Scheduler(rate=1, burst=2, reserve=1)
+    scheduler.acquire(BACKGROUND, timeout=0.1)
+    with pytest.raises(RateLimitedError):
+        scheduler.acquire(BACKGROUND, timeout=0.1)
+    assert scheduler.acquire(INTERACTIVE, timeout=0.1) < 0.1
+    with pytest.raises(RateLimitedError):
+        scheduler.acquire(INTERACTIVE, timeout=0.1)
+    assert scheduler.stats()["rejected"] == 2
+
+
+def test_scheduler_priority():
+    scheduler = Scheduler(rate=10, burst=1, reserve=0)
+    scheduler.acquire()
+    order = []
+
+    def acquire(priority):
+        scheduler.acquire(priority)
+        order.append(priority)
+
+    background = threading.Thread(target=acquire, args=(BACKGROUND,))
+    background.start()
+    time.sleep(0.02)
+    assert scheduler.stats()["waiting"] == {INTERACTIVE: 0, BACKGROUND: 1}
+    interactive = threading.Thread(target=acquire, args=(INTERACTIVE,))
+    interactive.start()
+    background.join()
+    interactive.join()
+    assert order == [INTERACTIVE, BACKGROUND]
+    assert scheduler.stats()["waiting"] == {INTERACTIVE: 0, BACKGROUND: 0}
+
+
+def test_scheduler_adaptive_rate():
+    scheduler = Scheduler(rate=8, min_rate=1, max_rate=10, latency=1, cooldown=10)
+    scheduler.record(False, 0.1)
+    assert scheduler.rate == 4
+    # At most one decrease per cooldown
+    scheduler.record(True, 2)
+    assert scheduler.rate == 4
+    assert scheduler.stats()["decreases"] == 1
+
+    time.sleep(0.1)
+    scheduler.record(True, 0.1)
+    assert 4 < scheduler.rate < 4.5
+
+    scheduler.reset()
+    assert scheduler.rate == 8
+
+
+def test_scheduler_async():
+    scheduler = Scheduler(rate=20, burst=1, reserve=0)
+
+    async def acquire_all():
+        return await asyncio.gather(*[scheduler.acquire_async() for _ in range(3)])
+
+    loop = asyncio.new_event_loop()
+    try:
+        waited = loop.run_until_complete(acquire_all())
+        assert 0.09 < max(waited) < 0.5
+        with pytest.raises(RateLimitedError):
+            loop.run_until_complete(scheduler.acquire_async(BACKGROUND, timeout=0))
+    finally:
+        loop.close()
+
+
+def test_shared_scheduler(tmpdir):
+    # Two processes that share the bucket
+    path = str(tmpdir.join("scheduler.sqlite"))
+    first = SharedScheduler(path, "brp", rate=10, burst=2, reserve=0)
+    second = SharedScheduler(path, "brp", rate=10, burst=2, reserve=0)
+
+    first.acquire(INTERACTIVE)
+    first.acquire(INTERACTIVE)
+    with pytest.raises(RateLimitedError):
+        second.acquire(INTERACTIVE, timeout=0.01)
+
+    # A background request of one process waits while an interactive request of another process is waiting
+    second.reset()
+    first.acquire(INTERACTIVE)
+    first.acquire(INTERACTIVE)
+    with pytest.raises(RateLimitedError):
+        first.acquire(INTERACTIVE, timeout=0.01)
+    time.sleep(0.15)
+    assert not second.try_acquire(BACKGROUND)
+    assert second.try_acquire(INTERACTIVE)
+
+    # The rate is shared, the adjustments of a process are added with its next lease
+    second.reset()
+    first.record(False, 0)
+    assert second.stats()["rate"] == 10
+    first.stats()
+    assert second.stats()["rate"] == 5
+
+
+def test_shared_scheduler_lease(tmpdir):
+    transactions = []
+
+    class Shared(SharedScheduler):
+        def _transact(self, *args, **kwargs):
+            transactions.append(args)
+            return super()._transact(*args, **kwargs)
+
+    path = str(tmpdir.join("scheduler.sqlite"))
+    first = Shared(path, "brp", rate=100, burst=100, reserve=0, lease=0.1)
+    second = Shared(path, "brp", rate=100, burst=100, reserve=0, lease=0.1)
+    transactions.clear()
+
+    # Tokens are leased 10 (0.1 seconds at 100 per second) at a time
+    for _ in range(20):
+        first.acquire(INTERACTIVE, timeout=0)
+    assert len(transactions) == 2
+    assert second.stats()["tokens"] < 90
+
+    # Leased tokens expire
+    time.sleep(0.1)
+    first.acquire(INTERACTIVE, timeout=0)
+    assert len(transactions) == 4
+
+    # Threads take the leased tokens while another thread of the process is leasing
+    threads = [threading.Thread(target=first.acquire, args=(INTERACTIVE, 1)) for _ in range(50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(transactions) < 4 + 20
+
+
+def test_shared_scheduler_async(tmpdir):
+    # The shared bucket is not read on the thread of the event loop
+    threads = set()
+
+    class Shared(SharedScheduler):
+        def _take(self, priority):
+            threads.add(threading.get_ident())
+            return super()._take(priority)
+
+    scheduler = Shared(str(tmpdir.join("scheduler.sqlite")), "brp", rate=10, burst=1, reserve=0)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(scheduler.acquire_async())
+        loop.run_until_complete(scheduler.record_async(True, 0))
+        with pytest.raises(RateLimitedError):
+            loop.run_until_complete(scheduler.acquire_async(timeout=0))
+    finally:
+        loop.close()
+    assert threads and threading.get_ident() not in threads
+
+
+def test_single_flight_async_cancelled():
+    async def request():
+        await asyncio.sleep(1)
+
+    async def cancel_leader():
+        leader = asyncio.ensure_future(_single_flight("a", request))
+        await asyncio.sleep(0.01)
+        follower = asyncio.ensure_future(_single_flight("a", request))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        # The follower does not wait forever, for the follower the request failed
+        with pytest.raises(RequestException):
+            await asyncio.wait_for(follower, 0.5)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(cancel_leader())
+    finally:
+        loop.close()
@@ -0,0 +1,45 @@
+from benchmarks.fake_brp import FakeBRP
+from config import config
+from stuf import startup
+from stuf.metrics import registry, stage_seconds, startup_seconds, time_to_first_response_seconds
+from stuf.pool import get_pool_stats
+from stuf.stuf_0204 import connect_Lv01, lookup_Lv01, warm_up_Lv01
+
+
+def test_warm_up(monkeypatch):
+    server = FakeBRP(latency=0, jitter=0, residents=3)
+    monkeypatch.setitem(config, "host", server.start())
+    registry.reset()
+    try:
+        assert startup.warm_up(config)
+        connections = get_pool_stats()["new_connections"]
+        hits = get_pool_stats()["hits"]
+
+        lookup, = lookup_Lv01(["0363200000399540"], config)
+    finally:
+        server.stop()
+
+    assert lookup.source == "brp"
+    assert not lookup.results[0].error
+    # The first lookup is sent over the connection of the warm-up
+    assert get_pool_stats()["new_connections"] == connections
+    assert get_pool_stats()["hits"] == hits + 1
+    assert startup_seconds.get("warmup") > 0
+    assert startup_seconds.get("connect") > 0
+
+
+def test_warm_up_without_brp(monkeypatch):
+    monkeypatch.setitem(config, "host", "http://127.0.0.1:9")
+    registry.reset()
+    warm_up_Lv01(config)
+    # Nothing is counted as a lookup
+    assert stage_seconds.get("parse") == (0, 0)
+    assert not connect_Lv01(config)
+
+
+def test_first_response(monkeypatch):
+    monkeypatch.setitem(startup._responded, "pid", None)
+    uptime = startup.record_response()
+    assert 0 < uptime <= startup.get_uptime()
+    assert time_to_first_response_seconds.get() == uptime
+    assert startup.record_response() is None